@@ -0,0 +1,70 @@
+"""
+Times a replay of an action tape with the cadCAD and the REPLAY engines of sim_runner.run, for each decoding type.
+
+    python -m benchmarks.replay_engine [path_to_action_json] [--steps 2000] [--repeat 3]
+
+Without a tape, the 0x8b6 sample tape of tests/data is repeated up to --steps actions. The times are the best of --repeat runs of
+the simulation alone (the blocks and their ActionDecoder are built for every run, as a notebook would, post_processing() isn't
+timed).
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from cadCAD.configuration.utils import config_sim
+
+from model.genesis_states import generate_initial_state
+from model.partial_state_update_block import generate_partial_state_update_blocks
+from model.sim_runner import SimulationEngine, SimulationRunner
+from model.parts.system_policies import ActionDecodingType
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+INITIAL_STATE_JSON = os.path.join(ROOT, 'data', '0x8b6e6e7b5b3801fed2cafd4b22b8a16c2f2db21a-initial_pool_states-prices.json')
+SAMPLE_ACTIONS_JSON = os.path.join(ROOT, 'tests', 'data', '0x8b6e6e7b5b3801fed2cafd4b22b8a16c2f2db21a-actions-sample.json')
+
+
+def repeat_sample_tape(path: str, steps: int):
+    with open(SAMPLE_ACTIONS_JSON) as f:
+        actions = json.load(f)
+    body = actions[1:]
+    with open(path, 'w') as f:
+        json.dump([actions[0]] + (body * (steps // len(body) + 1))[:steps], f)
+
+
+def time_run(initial_state: dict, path_to_action_json: str, decoding_type: str, engine: str, repeat: int) -> float:
+    runner = SimulationRunner()
+    best = None
+    for _ in range(repeat):
+        result = generate_partial_state_update_blocks(path_to_action_json)
+        sim_configs = config_sim({'N': 1, 'T': range(result['steps_number'] - 1),
+                                  'M': {'spot_price_reference': ['DAI'], 'decoding_type': [decoding_type]}})
+        start = time.perf_counter()
+        runner.run(initial_state, result['partial_state_update_blocks'], sim_configs, engine=engine)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path_to_action_json', nargs='?')
+    parser.add_argument('--steps', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    initial_state = generate_initial_state(initial_values_json=INITIAL_STATE_JSON, spot_price_base_currency='DAI')
+    with tempfile.TemporaryDirectory() as directory:
+        path = args.path_to_action_json
+        if path is None:
+            path = os.path.join(directory, 'actions.json')
+            repeat_sample_tape(path, args.steps)
+        for decoding_type in ActionDecodingType:
+            times = {engine: time_run(initial_state, path, decoding_type.value, engine.value, args.repeat) for engine in SimulationEngine}
+            print(f'{decoding_type.value:14} cadCAD {times[SimulationEngine.cadcad]:.3f}s  REPLAY {times[SimulationEngine.replay]:.3f}s  '
+                  f'{times[SimulationEngine.cadcad] / times[SimulationEngine.replay]:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
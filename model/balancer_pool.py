@@ -1,9 +1,14 @@
+import copy
+from collections import OrderedDict
 from decimal import Decimal
 
+import numpy as np
+
 from model.parts.balancer_constants import MAX_TOTAL_WEIGHT, MAX_WEIGHT, MIN_BALANCE, MIN_FEE, MAX_BOUND_TOKENS, INIT_POOL_SUPPLY, EXIT_FEE, MAX_IN_RATIO, \
     MAX_OUT_RATIO, MIN_WEIGHT
 from model.parts.balancer_math import BalancerMath
 from dataclasses import dataclass
+import typing
 
 
 @dataclass
@@ -26,7 +31,48 @@ class SwapOutResult:
     spot_price_after: Decimal
 
 
+SINGLE_ASSET_OPERATIONS = ('join_swap_extern_amount_in', 'join_swap_pool_amount_out', 'exit_swap_pool_amount_in',
+                           'exit_swap_extern_amount_out')
+
+
+@dataclass
+class OperationBatch:
+    """
+    Columns of a batch for BalancerPool.apply_batch(). kind is the name of the pool method. amount is token_amount_in for
+    swap_exact_amount_in and token_amount_out for swap_exact_amount_out, limit_amount is min_amount_out and max_amount_in. The
+    join_swap_* and exit_swap_* kinds use token_in or token_out, amount and limit_amount in the order of their method arguments.
+    """
+    kind: typing.List[str]
+    token_in: typing.List[str]
+    token_out: typing.List[str]
+    amount: typing.List[Decimal]
+    limit_amount: typing.List[Decimal]
+    max_price: typing.List[Decimal]
+
+
+# Error codes of BatchResult.error_code, 0 is no error
+BATCH_ERRORS = (None, 'ERR_NOT_BOUND', 'ERR_MAX_IN_RATIO', 'ERR_MAX_OUT_RATIO', 'ERR_BAD_LIMIT_PRICE', 'ERR_LIMIT_OUT',
+                'ERR_LIMIT_IN', 'ERR_LIMIT_PRICE', 'LIMIT PRICE', 'ERR_MATH_APPROX', 'ERR_UNKNOWN_OPERATION')
+
+
+@dataclass
+class BatchResult:
+    # Object arrays of Decimal. token_amount_out, token_amount_in or the return value of the method, None for a failed operation
+    amount: np.ndarray
+    # Only set for swaps
+    spot_price_after: np.ndarray
+    # Index in error_table of the error of each operation
+    error_code: np.ndarray
+    # BATCH_ERRORS, then the other errors met in the batch
+    error_table: typing.List[typing.Optional[str]]
+
+    def errors(self) -> typing.List[typing.Optional[str]]:
+        return [self.error_table[code] for code in self.error_code]
+
+
 class BalancerPool(BalancerMath):
+    # Number of quotes kept per pool
+    quote_cache_size = 256
 
     def __init__(self, initial_pool_supply: Decimal = INIT_POOL_SUPPLY):
         self._swap_fee = MIN_FEE
@@ -34,6 +80,215 @@ class BalancerPool(BalancerMath):
         self.total_weight = Decimal('0')
         self._pool_token_supply = initial_pool_supply
         self.factory_fees = Decimal('0')
+        # Undo entries (target, attribute, old value) while a snapshot is open, None otherwise
+        self._journal = None
+        # Length of the journal when each open snapshot was taken, outermost first
+        self._snapshots = []
+        # Bumped by every write, the quotes are cached for one version
+        self._version = 0
+        self._quotes_version = 0
+        self._quotes = OrderedDict()
+
+    def snapshot(self) -> int:
+        """
+        Starts recording writes to the pool and returns a token for rollback() and commit(), the depth of the new snapshot.
+        Snapshots can be nested, a trial trade then costs one journal entry per field it writes instead of a copy of the pool.
+        """
+        if self._journal is None:
+            self._journal = []
+        self._snapshots.append(len(self._journal))
+        return len(self._snapshots) - 1
+
+    def _close(self, snapshot: typing.Optional[int]) -> int:
+        # Closes the given snapshot (the innermost one by default) and the ones nested in it, returns its journal length
+        if snapshot is None:
+            snapshot = len(self._snapshots) - 1
+        if not 0 <= snapshot < len(self._snapshots):
+            raise Exception('ERR_NO_SNAPSHOT')
+        start = self._snapshots[snapshot]
+        del self._snapshots[snapshot:]
+        return start
+
+    def rollback(self, snapshot: int):
+        """
+        Undoes every write made since snapshot() returned the given token and closes that snapshot. The recording stops with the
+        outermost snapshot.
+        """
+        start = self._close(snapshot)
+        journal = self._journal
+        while len(journal) > start:
+            target, attribute, old_value = journal.pop()
+            setattr(target, attribute, old_value)
+        self._version += 1
+        if not self._snapshots:
+            self._journal = None
+
+    def commit(self, snapshot: typing.Optional[int] = None):
+        """
+        Keeps the writes made since the given snapshot (the innermost open one by default) and closes it. An enclosing snapshot can
+        still roll them back, the recording stops with the outermost snapshot.
+        """
+        self._close(snapshot)
+        if not self._snapshots:
+            self._journal = None
+
+    def _write(self, target, attribute: str, value):
+        self._version += 1
+        if self._journal is not None:
+            self._journal.append((target, attribute, getattr(target, attribute)))
+        setattr(target, attribute, value)
+
+    def _writable_records(self) -> dict:
+        # bind() and unbind() change the dict itself, so the journal keeps the old dict and the pool gets a copy
+        self._version += 1
+        if self._journal is not None:
+            self._journal.append((self, '_records', self._records))
+            self._records = dict(self._records)
+        return self._records
+
+    def _quote(self, method, *args):
+        if self._quotes_version != self._version:
+            self._quotes.clear()
+            self._quotes_version = self._version
+        key = (method.__name__,) + args
+        quote = self._quotes.get(key)
+        if quote is not None:
+            self._quotes.move_to_end(key)
+            # SwapInResult and SwapOutResult are mutable, every caller gets its own
+            return copy.copy(quote)
+        # Run the trade itself so the quote goes through the same checks, then undo it
+        version = self._version
+        snapshot = self.snapshot()
+        try:
+            quote = method(*args)
+        finally:
+            self.rollback(snapshot)
+            self._version = version
+        self._quotes[key] = quote
+        if len(self._quotes) > self.quote_cache_size:
+            self._quotes.popitem(last=False)
+        return copy.copy(quote)
+
+    def quote_swap_exact_amount_in(self, token_in: str, token_amount_in: Decimal, token_out: str, min_amount_out: Decimal,
+                                   max_price: Decimal) -> SwapInResult:
+        return self._quote(self.swap_exact_amount_in, token_in, token_amount_in, token_out, min_amount_out, max_price)
+
+    def quote_swap_exact_amount_out(self, token_in: str, max_amount_in: Decimal, token_out: str, token_amount_out: Decimal,
+                                    max_price: Decimal) -> SwapOutResult:
+        return self._quote(self.swap_exact_amount_out, token_in, max_amount_in, token_out, token_amount_out, max_price)
+
+    def quote_join_swap_extern_amount_in(self, token_in: str, token_amount_in: Decimal, min_pool_amount_out: Decimal) -> Decimal:
+        return self._quote(self.join_swap_extern_amount_in, token_in, token_amount_in, min_pool_amount_out)
+
+    def quote_join_swap_pool_amount_out(self, token_in: str, pool_amount_out: Decimal, max_amount_in: Decimal) -> Decimal:
+        return self._quote(self.join_swap_pool_amount_out, token_in, pool_amount_out, max_amount_in)
+
+    def quote_exit_swap_pool_amount_in(self, token_out: str, pool_amount_in: Decimal, min_amount_out: Decimal) -> Decimal:
+        return self._quote(self.exit_swap_pool_amount_in, token_out, pool_amount_in, min_amount_out)
+
+    def quote_exit_swap_extern_amount_out(self, token_out: str, token_amount_out: Decimal, max_pool_amount_in: Decimal) -> Decimal:
+        return self._quote(self.exit_swap_extern_amount_out, token_out, token_amount_out, max_pool_amount_in)
+
+    def apply_batch(self, batch: OperationBatch) -> BatchResult:
+        """
+        Applies the operations of a batch in sequence with the checks and error codes of the single methods. Like a reverted
+        transaction, a failed operation leaves the pool as it was and the batch goes on with the next one. Swaps are done inline
+        without allocating results, and reuse the spot price after the previous swap on the same pair as their spot price before.
+        Swaps of a token for itself go through the single methods.
+        """
+        size = len(batch.kind)
+        amounts = np.empty(size, dtype=object)
+        spot_prices_after = np.empty(size, dtype=object)
+        error_codes = np.zeros(size, dtype=np.int32)
+        error_table = list(BATCH_ERRORS)
+        codes = {error: code for code, error in enumerate(error_table)}
+        records = self._records
+        calc_spot_price = self.calc_spot_price
+        last_pair = None
+        last_spot_price = None
+        for n, (kind, token_in, token_out, amount, limit_amount, max_price) in enumerate(zip(
+                batch.kind, batch.token_in, batch.token_out, batch.amount, batch.limit_amount, batch.max_price)):
+            try:
+                if kind == 'swap_exact_amount_in' or kind == 'swap_exact_amount_out':
+                    in_record = records.get(token_in)
+                    out_record = records.get(token_out)
+                    if in_record is None or out_record is None or not in_record.bound or not out_record.bound:
+                        raise Exception('ERR_NOT_BOUND')
+                    if in_record is out_record:
+                        # Both balance writes go to the same record, the method does them in its order
+                        if kind == 'swap_exact_amount_in':
+                            swap = self._apply_single(kind, token_in, amount, token_out, limit_amount, max_price)
+                            amounts[n] = swap.token_amount_out
+                        else:
+                            swap = self._apply_single(kind, token_in, limit_amount, token_out, amount, max_price)
+                            amounts[n] = swap.token_amount_in
+                        spot_prices_after[n] = swap.spot_price_after
+                        last_pair = None
+                        continue
+                    balance_in, weight_in = in_record.balance, in_record.denorm
+                    balance_out, weight_out = out_record.balance, out_record.denorm
+                    swap_fee = self._swap_fee
+                    if kind == 'swap_exact_amount_in':
+                        if amount > balance_in * MAX_IN_RATIO:
+                            raise Exception('ERR_MAX_IN_RATIO')
+                    elif amount > balance_out * MAX_OUT_RATIO:
+                        raise Exception('ERR_MAX_OUT_RATIO')
+                    if last_pair == (token_in, token_out):
+                        spot_price_before = last_spot_price
+                    else:
+                        spot_price_before = calc_spot_price(balance_in, weight_in, balance_out, weight_out, swap_fee)
+                    if spot_price_before > max_price:
+                        raise Exception('ERR_BAD_LIMIT_PRICE')
+                    if kind == 'swap_exact_amount_in':
+                        token_amount_in = amount
+                        token_amount_out = self.calc_out_given_in(amount, balance_in, weight_in, balance_out, weight_out, swap_fee).result
+                        if token_amount_out < limit_amount:
+                            raise Exception('ERR_LIMIT_OUT')
+                    else:
+                        token_amount_out = amount
+                        token_amount_in = self.calc_in_given_out(balance_out, balance_in, amount, weight_in, weight_out, swap_fee).result
+                        if token_amount_in > limit_amount:
+                            raise Exception('ERR_LIMIT_IN')
+                    balance_in += token_amount_in
+                    balance_out -= token_amount_out
+                    spot_price_after = calc_spot_price(balance_in, weight_in, balance_out, weight_out, swap_fee)
+                    if spot_price_after < spot_price_before:
+                        raise Exception('ERR_MATH_APPROX')
+                    if spot_price_after > max_price:
+                        raise Exception('ERR_LIMIT_PRICE' if kind == 'swap_exact_amount_in' else 'LIMIT PRICE')
+                    if spot_price_before > (token_amount_in / token_amount_out):
+                        raise Exception('ERR_MATH_APPROX')
+                    self._write(in_record, 'balance', balance_in)
+                    self._write(out_record, 'balance', balance_out)
+                    amounts[n] = token_amount_out if kind == 'swap_exact_amount_in' else token_amount_in
+                    spot_prices_after[n] = spot_price_after
+                    last_pair, last_spot_price = (token_in, token_out), spot_price_after
+                elif kind in SINGLE_ASSET_OPERATIONS:
+                    token = token_in if kind.startswith('join') else token_out
+                    amounts[n] = self._apply_single(kind, token, amount, limit_amount)
+                    last_pair = None
+                else:
+                    raise Exception('ERR_UNKNOWN_OPERATION')
+            except Exception as e:
+                error = str(e.args[0]) if e.args else type(e).__name__
+                code = codes.get(error)
+                if code is None:
+                    code = codes[error] = len(error_table)
+                    error_table.append(error)
+                error_codes[n] = code
+        return BatchResult(amounts, spot_prices_after, error_codes, error_table)
+
+    def _apply_single(self, kind: str, *args):
+        # The single methods can fail after a write, so they run in a snapshot of their own. Committing it leaves a snapshot the
+        # caller opened around the batch open
+        snapshot = self.snapshot()
+        try:
+            result = getattr(self, kind)(*args)
+        except Exception:
+            self.rollback(snapshot)
+            raise
+        self.commit(snapshot)
+        return result
 
     def get_total_denorm_weight(self):
         return self.total_weight
@@ -51,6 +306,9 @@ class BalancerPool(BalancerMath):
         else:
             return 0
 
+    def tokens(self) -> typing.List[str]:
+        return list(self._records)
+
     def get_num_tokens(self):
         return len(self._records)
 
@@ -58,13 +316,16 @@ class BalancerPool(BalancerMath):
         return self._pool_token_supply
 
     def _mint_pool_share(self, amount: Decimal):
-        self._pool_token_supply += amount
+        self._write(self, '_pool_token_supply', self._pool_token_supply + amount)
 
     def _burn_pool_share(self, amount: Decimal):
-        self._pool_token_supply -= amount
+        self._write(self, '_pool_token_supply', self._pool_token_supply - amount)
+
+    def get_swap_fee(self) -> Decimal:
+        return self._swap_fee
 
     def set_swap_fee(self, amount: Decimal):
-        self._swap_fee = amount
+        self._write(self, '_swap_fee', amount)
 
     def bind(self, token: str, balance: Decimal, denorm: int) -> Decimal:
 
@@ -73,7 +334,7 @@ class BalancerPool(BalancerMath):
         # TODO limit number of tokens to MAX_BOUND_TOKENS
         if len(self._records) >= MAX_BOUND_TOKENS:
             raise Exception("ERR_MAX_TOKENS")
-        self._records[token] = TokenRecord(True, token, 0, 0)
+        self._writable_records()[token] = TokenRecord(True, token, 0, 0)
         return self.rebind(token, balance, denorm)
 
     def rebind(self, token: str, balance: Decimal, denorm: int) -> Decimal:
@@ -89,21 +350,21 @@ class BalancerPool(BalancerMath):
             raise Exception("ERR_MIN_BALANCE")
         old_weight = self._records[token].denorm
         if denorm > old_weight:
-            self.total_weight = self.total_weight + (denorm - old_weight)
+            self._write(self, 'total_weight', self.total_weight + (denorm - old_weight))
             if self.total_weight > MAX_TOTAL_WEIGHT:
                 raise Exception("ERR_MAX_TOTAL_WEIGHT")
         elif denorm < old_weight:
-            self.total_weight = self.total_weight + (old_weight - denorm)
-        self._records[token].denorm = denorm
+            self._write(self, 'total_weight', self.total_weight + (old_weight - denorm))
+        self._write(self._records[token], 'denorm', denorm)
         old_balance = self._records[token].balance
-        self._records[token].balance = balance
+        self._write(self._records[token], 'balance', balance)
         if balance > old_balance:
             return - (balance - old_balance)
         elif balance < old_balance:
             # In this case liquidity is being withdrawn, so charge EXIT_FEE
             token_balance_withdrawn = old_balance - balance
             token_exit_fee = token_balance_withdrawn * EXIT_FEE
-            self.factory_fees += token_exit_fee
+            self._write(self, 'factory_fees', self.factory_fees + token_exit_fee)
             return token_balance_withdrawn - token_exit_fee
 
     def unbind(self, token: str) -> dict:
@@ -114,9 +375,9 @@ class BalancerPool(BalancerMath):
         token_balance = record.balance
         token_exit_fee = token_balance * EXIT_FEE
 
-        self.total_weight -= record.denorm
-        del self._records[token]
-        self.factory_fees += token_exit_fee
+        self._write(self, 'total_weight', self.total_weight - record.denorm)
+        del self._writable_records()[token]
+        self._write(self, 'factory_fees', self.factory_fees + token_exit_fee)
         return {token: token_balance - token_exit_fee}
 
     def get_spot_price(self, token_in: str, token_out: str) -> Decimal:
@@ -141,7 +402,7 @@ class BalancerPool(BalancerMath):
                 return Exception("ERR_MATH_APPROX")
             if token_amount_in > max_amounts_in[token]:
                 raise Exception('ERR_LIMIT_IN')
-            record.balance += token_amount_in
+            self._write(record, 'balance', record.balance + token_amount_in)
             results[token] = token_amount_in
         self._mint_pool_share(pool_amount_out)
         return results
@@ -164,7 +425,7 @@ class BalancerPool(BalancerMath):
                 raise Exception("ERR_MATH_APPROX")
             if token_amount_out < min_amounts_out[token]:
                 raise Exception("ERR_LIMIT_OUT")
-            record.balance -= token_amount_out
+            self._write(record, 'balance', record.balance - token_amount_out)
             return_dict[token] = token_amount_out
         return return_dict
 
@@ -202,8 +463,8 @@ class BalancerPool(BalancerMath):
         if token_amount_out < min_amount_out:
             raise Exception('ERR_LIMIT_OUT')
 
-        min_pool_amount_out.balance += token_amount_in
-        out_record.balance -= token_amount_out
+        self._write(min_pool_amount_out, 'balance', min_pool_amount_out.balance + token_amount_in)
+        self._write(out_record, 'balance', out_record.balance - token_amount_out)
 
         spot_price_after = self.calc_spot_price(
             token_balance_in=min_pool_amount_out.balance,
@@ -256,8 +517,8 @@ class BalancerPool(BalancerMath):
         if token_amount_in > max_amount_in:
             raise Exception('ERR_LIMIT_IN')
 
-        min_pool_amount_out.balance += token_amount_in
-        out_record.balance -= token_amount_out
+        self._write(min_pool_amount_out, 'balance', min_pool_amount_out.balance + token_amount_in)
+        self._write(out_record, 'balance', out_record.balance - token_amount_out)
 
         spot_price_after = self.calc_spot_price(
             token_balance_in=min_pool_amount_out.balance,
@@ -308,7 +569,7 @@ class BalancerPool(BalancerMath):
         if pool_amount_out < min_pool_amount_out:
             raise Exception("ERR_LIMIT_OUT")
 
-        in_record.balance += token_amount_in
+        self._write(in_record, 'balance', in_record.balance + token_amount_in)
 
         self._mint_pool_share(pool_amount_out)
         # NOTE user balance can be inferred from params (substract tai), pool out is already returning
@@ -339,7 +600,7 @@ class BalancerPool(BalancerMath):
         if token_amount_in > in_record.balance * MAX_IN_RATIO:
             raise Exception("ERR_MAX_IN_RATIO")
 
-        in_record.balance = in_record.balance + token_amount_in
+        self._write(in_record, 'balance', in_record.balance + token_amount_in)
         self._mint_pool_share(pool_amount_out)
         # NOTE not modeling balance change for sender
         # _pushPoolShare(msg.sender, poolAmountOut)
@@ -366,7 +627,7 @@ class BalancerPool(BalancerMath):
         if token_amount_out > out_record.balance * MAX_OUT_RATIO:
             raise Exception("ERR_MAX_OUT_RATIO")
 
-        out_record.balance = out_record.balance - token_amount_out
+        self._write(out_record, 'balance', out_record.balance - token_amount_out)
 
         exit_fee = pool_amount_in * EXIT_FEE
         self._burn_pool_share(pool_amount_in - exit_fee)
@@ -397,7 +658,7 @@ class BalancerPool(BalancerMath):
         if pool_amount_in > max_pool_amount_in:
             raise Exception("ERR_LIMIT_IN")
 
-        out_record.balance -= token_amount_out
+        self._write(out_record, 'balance', out_record.balance - token_amount_out)
 
         exitFee = pool_amount_in * EXIT_FEE
         self._burn_pool_share(pool_amount_in - exitFee)
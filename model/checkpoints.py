@@ -0,0 +1,130 @@
+"""
+Checkpoints for the replay engine. Every `interval` timesteps the rows recorded since the previous checkpoint are written to a
+chunk file, then the latest state is written to checkpoint.pickle, each run (subset, run) in its own directory. Both writes go to
+a temporary file that is renamed into place, so a crash leaves the previous checkpoint intact. The cost of a checkpoint is the
+pickling of its own rows and of one state.
+
+A run with a checkpoint in its directory resumes from the latest one. Resuming only reads the state of the checkpoint, the rows of
+the earlier chunks are read back in front of the new ones unless load_records is False (see read_records()). Checkpoints also
+store the params, a digest of the initial state (initial_state_digest) and a digest of the actions played so far
+(ActionDecoder.prefix_digest), and are only used if all three still match.
+After pulldata.py appends actions to a tape, a finished run therefore continues from its final state and only simulates the new
+actions, while a tape that changed anywhere else is simulated from the start.
+"""
+import hashlib
+import json
+import os
+import pickle
+import typing
+
+from model.parts.system_policies import ActionDecoder
+
+CHECKPOINT_FILE = 'checkpoint.pickle'
+
+
+def atomic_pickle(obj, path: str):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def read_pickle(path: str):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def initial_state_digest(initial_state: dict) -> str:
+    """
+    sha256 of what a run starts from: the tokens, swap fee and pool shares of the pool and the token prices. A run whose initial
+    pool JSON changed doesn't resume the checkpoints of the old one.
+    """
+    pool = initial_state['pool']
+    tokens = {symbol: [str(token.balance), str(token.denorm_weight), str(token.weight), token.bound]
+              for symbol, token in pool['tokens'].items()}
+    genesis = {'tokens': tokens, 'swap_fee': str(pool['swap_fee']), 'pool_shares': str(pool.get('pool_shares')),
+               'token_prices': initial_state.get('token_prices')}
+    return hashlib.sha256(json.dumps(genesis, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class Checkpointer:
+    def __init__(self, directory: str, interval: int = 1000, load_records: bool = True):
+        """
+        With load_records=False a resumed run only returns the rows simulated after its checkpoint, the earlier ones stay in the
+        chunk files.
+        """
+        if interval < 1:
+            raise Exception('checkpoint interval must be at least 1 timestep')
+        self.directory = directory
+        self.interval = interval
+        self.load_records = load_records
+        # (subset, run) -> chunk files of the latest checkpoint, set by resume()
+        self._chunks = {}
+
+    def run_directory(self, subset: int, run: int) -> str:
+        return os.path.join(self.directory, f'subset-{subset}-run-{run}')
+
+    def is_due(self, timestep: int) -> bool:
+        return timestep % self.interval == 0
+
+    def save(self, subset: int, run: int, state: dict, records: typing.List[dict], params, action_decoder: ActionDecoder,
+             initial_digest: str, done: bool = False):
+        """
+        records are the rows since the previous checkpoint of this run, state is the last of them. initial_digest is the
+        initial_state_digest() of the initial state of the run.
+        """
+        run_directory = self.run_directory(subset, run)
+        os.makedirs(run_directory, exist_ok=True)
+        chunks = self._chunks.get((subset, run), [])
+        # Nothing new when the run ends right after a checkpoint
+        if records:
+            chunk = f"chunk-{state['timestep']:010d}.pickle"
+            atomic_pickle(records, os.path.join(run_directory, chunk))
+            chunks = chunks + [chunk]
+        checkpoint = {
+            'state': state,
+            # Row label in ActionDecoder.action_df of the next action to play
+            'tape_offset': state['timestep'] + 1,
+            'tape_digest': action_decoder.prefix_digest(state['timestep']),
+            'params': params,
+            'initial_digest': initial_digest,
+            'done': done,
+            'chunks': chunks,
+        }
+        atomic_pickle(checkpoint, os.path.join(run_directory, CHECKPOINT_FILE))
+        self._chunks[(subset, run)] = checkpoint['chunks']
+
+    def has_checkpoint(self, subset: int, run: int) -> bool:
+        return os.path.exists(os.path.join(self.run_directory(subset, run), CHECKPOINT_FILE))
+
+    def load_checkpoint(self, subset: int, run: int) -> dict:
+        return read_pickle(os.path.join(self.run_directory(subset, run), CHECKPOINT_FILE))
+
+    def resume(self, subset: int, run: int, params, action_decoder: ActionDecoder,
+               initial_digest: str) -> typing.Optional[typing.Tuple[dict, bool]]:
+        """
+        (latest state, whether the run finished) or None when the run has no usable checkpoint: none yet, or one made with other
+        params, another initial state or another tape. Only the checkpoint file is read, whatever the length of the run.
+        """
+        self._chunks[(subset, run)] = []
+        if not self.has_checkpoint(subset, run):
+            return None
+        checkpoint = self.load_checkpoint(subset, run)
+        if checkpoint['params'] != params or checkpoint.get('initial_digest') != initial_digest:
+            return None
+        if checkpoint['tape_digest'] != action_decoder.prefix_digest(checkpoint['state']['timestep']):
+            return None
+        self._chunks[(subset, run)] = checkpoint['chunks']
+        return checkpoint['state'], checkpoint['done']
+
+    def read_records(self, subset: int, run: int) -> typing.List[dict]:
+        """
+        Every row recorded up to the latest checkpoint of the run. Chunks written after it (a crash between the two writes) are
+        ignored.
+        """
+        if not self.has_checkpoint(subset, run):
+            return []
+        records = []
+        for chunk in self.load_checkpoint(subset, run)['chunks']:
+            records.extend(read_pickle(os.path.join(self.run_directory(subset, run), chunk)))
+        return records
@@ -0,0 +1,366 @@
+"""
+Compact variant of BalancerPool for agent-based runs with thousands of pools. Token symbols are interned to small integer ids when
+they are bound, and the balances and denorms are kept in two lists indexed by id instead of a dict of TokenRecord dataclasses, in a
+class with __slots__. The symbol -> id mapping is interned too: pools with the same tokens bound in the same order share one
+TokenLayout. A call does one dict lookup per token symbol and then only list reads and writes. The public API and the results are
+the same as BalancerPool's.
+"""
+import typing
+import weakref
+from decimal import Decimal
+
+from model.balancer_pool import SwapInResult, SwapOutResult
+from model.parts.balancer_constants import MAX_TOTAL_WEIGHT, MAX_WEIGHT, MIN_BALANCE, MIN_FEE, MAX_BOUND_TOKENS, INIT_POOL_SUPPLY, \
+    EXIT_FEE, MAX_IN_RATIO, MAX_OUT_RATIO, MIN_WEIGHT
+from model.parts.balancer_math import BalancerMath
+
+
+class TokenLayout:
+    __slots__ = ('symbols', 'ids', '__weakref__')
+
+    def __init__(self, symbols: typing.Tuple[str, ...]):
+        self.symbols = symbols
+        # symbol -> id, the index of the token in the balance and denorm lists of the pools
+        self.ids = {symbol: i for i, symbol in enumerate(symbols)}
+
+
+# Only the layouts that pools still use, the others are dropped with their last pool
+_layouts = weakref.WeakValueDictionary()
+
+
+def token_layout(symbols: typing.Tuple[str, ...]) -> TokenLayout:
+    layout = _layouts.get(symbols)
+    if layout is None:
+        layout = _layouts[symbols] = TokenLayout(symbols)
+    return layout
+
+
+class CompactBalancerPool(BalancerMath):
+    __slots__ = ('_swap_fee', '_layout', '_ids', '_symbols', '_denorms', '_balances', 'total_weight', '_pool_token_supply',
+                 'factory_fees')
+
+    def __init__(self, initial_pool_supply: Decimal = INIT_POOL_SUPPLY):
+        self._swap_fee = MIN_FEE
+        # Tokens are bound while they are in the layout, unbind() removes them
+        self._set_layout(token_layout(()))
+        self._denorms = []
+        self._balances = []
+        self.total_weight = Decimal('0')
+        self._pool_token_supply = initial_pool_supply
+        self.factory_fees = Decimal('0')
+
+    def _set_layout(self, layout: TokenLayout):
+        self._layout = layout
+        # Shortcuts to the shared layout
+        self._ids = layout.ids
+        self._symbols = layout.symbols
+
+    def token_id(self, token: str) -> int:
+        return self._ids[token]
+
+    def tokens(self) -> typing.List[str]:
+        return list(self._symbols)
+
+    def get_total_denorm_weight(self):
+        return self.total_weight
+
+    def get_denorm_weight(self, token: str):
+        return self._denorms[self._ids[token]]
+
+    def get_normal_weight(self, token: str):
+        return self._denorms[self._ids[token]] / self.total_weight
+
+    def get_balance(self, token: str):
+        i = self._ids.get(token)
+        if i is not None:
+            return self._balances[i]
+        else:
+            return 0
+
+    def get_num_tokens(self):
+        return len(self._symbols)
+
+    def get_pool_token_supply(self):
+        return self._pool_token_supply
+
+    def _mint_pool_share(self, amount: Decimal):
+        self._pool_token_supply += amount
+
+    def _burn_pool_share(self, amount: Decimal):
+        self._pool_token_supply -= amount
+
+    def get_swap_fee(self) -> Decimal:
+        return self._swap_fee
+
+    def set_swap_fee(self, amount: Decimal):
+        self._swap_fee = amount
+
+    def _bound_id(self, token: str) -> int:
+        i = self._ids.get(token)
+        if i is None:
+            raise Exception('ERR_NOT_BOUND')
+        return i
+
+    def bind(self, token: str, balance: Decimal, denorm: int) -> Decimal:
+        if token in self._ids:
+            raise Exception('ERR_IS_BOUND')
+        if len(self._symbols) >= MAX_BOUND_TOKENS:
+            raise Exception("ERR_MAX_TOKENS")
+        self._set_layout(token_layout(self._symbols + (token,)))
+        self._denorms.append(0)
+        self._balances.append(0)
+        return self.rebind(token, balance, denorm)
+
+    def rebind(self, token: str, balance: Decimal, denorm: int) -> Decimal:
+        i = self._bound_id(token)
+        if denorm < MIN_WEIGHT:
+            raise Exception("ERR_MIN_WEIGHT")
+        if denorm > MAX_WEIGHT:
+            raise Exception("ERR_MAX_WEIGHT")
+        if balance < MIN_BALANCE:
+            raise Exception("ERR_MIN_BALANCE")
+        old_weight = self._denorms[i]
+        if denorm > old_weight:
+            self.total_weight = self.total_weight + (denorm - old_weight)
+            if self.total_weight > MAX_TOTAL_WEIGHT:
+                raise Exception("ERR_MAX_TOTAL_WEIGHT")
+        elif denorm < old_weight:
+            self.total_weight = self.total_weight + (old_weight - denorm)
+        self._denorms[i] = denorm
+        old_balance = self._balances[i]
+        self._balances[i] = balance
+        if balance > old_balance:
+            return - (balance - old_balance)
+        elif balance < old_balance:
+            # In this case liquidity is being withdrawn, so charge EXIT_FEE
+            token_balance_withdrawn = old_balance - balance
+            token_exit_fee = token_balance_withdrawn * EXIT_FEE
+            self.factory_fees += token_exit_fee
+            return token_balance_withdrawn - token_exit_fee
+
+    def unbind(self, token: str) -> dict:
+        i = self._bound_id(token)
+
+        token_balance = self._balances[i]
+        token_exit_fee = token_balance * EXIT_FEE
+
+        self.total_weight -= self._denorms[i]
+        # Like BPool.unbind, the last token takes the id of the unbound one so the ids stay 0..n-1
+        symbols = list(self._symbols)
+        for values in (symbols, self._denorms, self._balances):
+            values[i] = values[-1]
+            values.pop()
+        self._set_layout(token_layout(tuple(symbols)))
+        self.factory_fees += token_exit_fee
+        return {token: token_balance - token_exit_fee}
+
+    def get_spot_price(self, token_in: str, token_out: str) -> Decimal:
+        i, o = self._ids[token_in], self._ids[token_out]
+        return self.calc_spot_price(self._balances[i], self._denorms[i], self._balances[o], self._denorms[o], self._swap_fee)
+
+    def get_spot_price_sans_fee(self, token_in: str, token_out: str) -> Decimal:
+        i, o = self._ids[token_in], self._ids[token_out]
+        return self.calc_spot_price(self._balances[i], self._denorms[i], self._balances[o], self._denorms[o], Decimal('0'))
+
+    def join_pool(self, pool_amount_out: Decimal, max_amounts_in: dict) -> dict:
+        ratio = pool_amount_out / self._pool_token_supply
+        if ratio == 0:
+            return Exception("ERR_MATH_APPROX")
+        results = {}
+        balances = self._balances
+        for i, token in enumerate(self._symbols):
+            token_amount_in = ratio * balances[i]
+            if token_amount_in == 0:
+                return Exception("ERR_MATH_APPROX")
+            if token_amount_in > max_amounts_in[token]:
+                raise Exception('ERR_LIMIT_IN')
+            balances[i] += token_amount_in
+            results[token] = token_amount_in
+        self._mint_pool_share(pool_amount_out)
+        return results
+
+    def exit_pool(self, pool_amount_in: Decimal, min_amounts_out: dict) -> dict:
+        pool_total = self._pool_token_supply
+        exit_fee = pool_amount_in * EXIT_FEE
+        pool_amount_in_afer_exit_fee = pool_amount_in - exit_fee
+        ratio = pool_amount_in_afer_exit_fee / pool_total
+
+        return_dict = {
+            "exit_fee_pool_token": exit_fee
+        }
+        self._burn_pool_share(pool_amount_in_afer_exit_fee)
+
+        balances = self._balances
+        for i, token in enumerate(self._symbols):
+            token_amount_out = ratio * balances[i]
+            if token_amount_out == 0:
+                raise Exception("ERR_MATH_APPROX")
+            if token_amount_out < min_amounts_out[token]:
+                raise Exception("ERR_LIMIT_OUT")
+            balances[i] -= token_amount_out
+            return_dict[token] = token_amount_out
+        return return_dict
+
+    def swap_exact_amount_in(self, token_in: str, token_amount_in: Decimal, token_out: str, min_amount_out: Decimal,
+                             max_price: Decimal) -> SwapInResult:
+        i = self._bound_id(token_in)
+        o = self._bound_id(token_out)
+        balances = self._balances
+        weight_in, weight_out = self._denorms[i], self._denorms[o]
+
+        if token_amount_in > balances[i] * MAX_IN_RATIO:
+            raise Exception("ERR_MAX_IN_RATIO")
+
+        spot_price_before = self.calc_spot_price(balances[i], weight_in, balances[o], weight_out, self._swap_fee)
+        if spot_price_before > max_price:
+            raise Exception("ERR_BAD_LIMIT_PRICE")
+        token_amount_out = self.calc_out_given_in(
+            token_balance_in=balances[i],
+            token_weight_in=weight_in,
+            token_balance_out=balances[o],
+            token_weight_out=weight_out,
+            token_amount_in=token_amount_in,
+            swap_fee=self._swap_fee
+        ).result
+
+        if token_amount_out < min_amount_out:
+            raise Exception('ERR_LIMIT_OUT')
+
+        balances[i] += token_amount_in
+        balances[o] -= token_amount_out
+
+        spot_price_after = self.calc_spot_price(balances[i], weight_in, balances[o], weight_out, self._swap_fee)
+        if spot_price_after < spot_price_before:
+            raise Exception("ERR_MATH_APPROX")
+        if spot_price_after > max_price:
+            raise Exception("ERR_LIMIT_PRICE")
+        if spot_price_before > (token_amount_in / token_amount_out):
+            raise Exception("ERR_MATH_APPROX")
+        return SwapInResult(token_amount_out, spot_price_after)
+
+    def swap_exact_amount_out(self, token_in: str, max_amount_in: Decimal, token_out: str, token_amount_out: Decimal,
+                              max_price: Decimal) -> SwapOutResult:
+        i = self._bound_id(token_in)
+        o = self._bound_id(token_out)
+        balances = self._balances
+        weight_in, weight_out = self._denorms[i], self._denorms[o]
+
+        if token_amount_out > (balances[o] * MAX_OUT_RATIO):
+            raise Exception("ERR_MAX_OUT_RATIO")
+
+        spot_price_before = self.calc_spot_price(balances[i], weight_in, balances[o], weight_out, self._swap_fee)
+        if spot_price_before > max_price:
+            raise Exception('ERR_BAD_LIMIT_PRICE')
+
+        token_amount_in = self.calc_in_given_out(
+            token_balance_in=balances[i],
+            token_weight_in=weight_in,
+            token_balance_out=balances[o],
+            token_weight_out=weight_out,
+            token_amount_out=token_amount_out,
+            swap_fee=self._swap_fee
+        ).result
+        if token_amount_in > max_amount_in:
+            raise Exception('ERR_LIMIT_IN')
+
+        balances[i] += token_amount_in
+        balances[o] -= token_amount_out
+
+        spot_price_after = self.calc_spot_price(balances[i], weight_in, balances[o], weight_out, self._swap_fee)
+        if spot_price_after < spot_price_before:
+            raise Exception('ERR_MATH_APPROX')
+        if spot_price_after > max_price:
+            raise Exception('LIMIT PRICE')
+        if spot_price_before > (token_amount_in / token_amount_out):
+            raise Exception('ERR_MATH_APPROX')
+
+        return SwapOutResult(token_amount_in=token_amount_in, spot_price_after=spot_price_after)
+
+    def join_swap_extern_amount_in(self, token_in: str, token_amount_in: Decimal, min_pool_amount_out: Decimal) -> Decimal:
+        i = self._bound_id(token_in)
+        if token_amount_in > self._balances[i] * MAX_IN_RATIO:
+            raise Exception("ERR_MAX_IN_RATIO")
+
+        pool_amount_out = self.calc_pool_out_given_single_in(
+            token_balance_in=self._balances[i],
+            token_weight_in=self._denorms[i],
+            pool_supply=self._pool_token_supply,
+            total_weight=self.total_weight,
+            token_amount_in=token_amount_in,
+            swap_fee=self._swap_fee
+        ).result
+
+        if pool_amount_out < min_pool_amount_out:
+            raise Exception("ERR_LIMIT_OUT")
+
+        self._balances[i] += token_amount_in
+        self._mint_pool_share(pool_amount_out)
+        return pool_amount_out
+
+    def join_swap_pool_amount_out(self, token_in: str, pool_amount_out: Decimal, max_amount_in: Decimal) -> Decimal:
+        i = self._bound_id(token_in)
+
+        token_amount_in = self.calc_single_in_given_pool_out(
+            token_balance_in=self._balances[i],
+            token_weight_in=self._denorms[i],
+            pool_supply=self._pool_token_supply,
+            total_weight=self.total_weight,
+            pool_amount_out=pool_amount_out,
+            swap_fee=self._swap_fee).result
+
+        if token_amount_in == 0:
+            raise Exception("ERR_MATH_APPROX")
+        if token_amount_in > max_amount_in:
+            raise Exception("ERR_LIMIT_IN")
+        if token_amount_in > self._balances[i] * MAX_IN_RATIO:
+            raise Exception("ERR_MAX_IN_RATIO")
+
+        self._balances[i] = self._balances[i] + token_amount_in
+        self._mint_pool_share(pool_amount_out)
+        return token_amount_in
+
+    def exit_swap_pool_amount_in(self, token_out: str, pool_amount_in: Decimal, min_amount_out: Decimal) -> Decimal:
+        o = self._bound_id(token_out)
+
+        token_amount_out = self.calc_single_out_given_pool_in(
+            token_balance_out=self._balances[o],
+            token_weight_out=self._denorms[o],
+            pool_supply=self._pool_token_supply,
+            total_weight=self.total_weight,
+            pool_amount_in=pool_amount_in,
+            swap_fee=self._swap_fee).result
+
+        if token_amount_out < min_amount_out:
+            raise Exception("ERR_LIMIT_OUT")
+        if token_amount_out > self._balances[o] * MAX_OUT_RATIO:
+            raise Exception("ERR_MAX_OUT_RATIO")
+
+        self._balances[o] = self._balances[o] - token_amount_out
+
+        exit_fee = pool_amount_in * EXIT_FEE
+        self._burn_pool_share(pool_amount_in - exit_fee)
+        return token_amount_out
+
+    def exit_swap_extern_amount_out(self, token_out: str, token_amount_out: Decimal, max_pool_amount_in: Decimal) -> Decimal:
+        o = self._bound_id(token_out)
+        if token_amount_out > self._balances[o] * MAX_OUT_RATIO:
+            raise Exception("ERR_MAX_OUT_RATIO")
+
+        pool_amount_in = self.calc_pool_in_given_single_out(
+            token_balance_out=self._balances[o],
+            token_weight_out=self._denorms[o],
+            pool_supply=self._pool_token_supply,
+            total_weight=self.total_weight,
+            token_amount_out=token_amount_out,
+            swap_fee=self._swap_fee
+        ).result
+        if pool_amount_in == 0:
+            raise Exception("ERR_MATH_APPROX")
+        if pool_amount_in > max_pool_amount_in:
+            raise Exception("ERR_LIMIT_IN")
+
+        self._balances[o] -= token_amount_out
+
+        exit_fee = pool_amount_in * EXIT_FEE
+        self._burn_pool_share(pool_amount_in - exit_fee)
+        return pool_amount_in
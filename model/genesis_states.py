@@ -8,11 +8,19 @@ from decimal import Decimal
 
 from model.parts.balancer_math import BalancerMath
 from model.models import Token
+from model.parts.pool_state_updates import (calculate_spot_price_matrix, calculate_spot_prices, calculate_total_denorm_weight,
+                                            copy_pool, set_token_denorm_weight)
 
 
-def generate_initial_state(initial_values_json: str, spot_price_base_currency: str) -> typing.Dict:
+def generate_initial_state(initial_values_json: str, spot_price_base_currency: str, spot_price_matrix: bool = False) -> typing.Dict:
     with open(initial_values_json, "r") as f:
         initial_values = json.load(f, object_hook=token_finding_hook)
+    # Amounts are strings in the JSON, convert them once here instead of in every state update
+    pool = initial_values['pool']
+    pool['generated_fees'] = {symbol: Decimal(fee) for symbol, fee in pool['generated_fees'].items()}
+    pool['pool_shares'] = Decimal(pool['pool_shares'])
+    pool['swap_fee'] = Decimal(pool['swap_fee'])
+    pool['total_denorm_weight'] = calculate_total_denorm_weight(pool)
     # Figure out the tokens that are NOT the spot_price_base_currency
     other_tokens = [*initial_values['pool']['tokens'].keys()]
     other_tokens.remove(spot_price_base_currency)
@@ -28,10 +36,30 @@ def generate_initial_state(initial_values_json: str, spot_price_base_currency: s
                                                       token_weight_out=Decimal(other_token.denorm_weight),
                                                       swap_fee=Decimal(initial_values['pool']['swap_fee']))
     initial_values["spot_prices"] = spot_prices
+    if spot_price_matrix:
+        # Needs s_update_spot_price_matrix in the PSUB, see generate_partial_state_update_blocks()
+        initial_values["spot_price_matrix"] = calculate_spot_price_matrix(pool)
+    return initial_values
+
+
+def apply_pool_params(initial_values: typing.Dict, params: typing.Dict, spot_price_base_currency: str) -> typing.Dict:
+    """
+    Returns a copy of initial_values with the pool parameters that are present in params overridden, so that a parameter sweep can
+    vary them per subset: 'swap_fee' and 'denorm_weights' ({symbol: denorm_weight}, normalized weights are recomputed).
+    """
+    pool = copy_pool(initial_values['pool'])
+    if 'swap_fee' in params:
+        pool['swap_fee'] = Decimal(params['swap_fee'])
+    if 'denorm_weights' in params:
+        for symbol, denorm_weight in params['denorm_weights'].items():
+            set_token_denorm_weight(pool, symbol, denorm_weight)
+    initial_values = {**initial_values, 'pool': pool, 'spot_prices': calculate_spot_prices(pool, spot_price_base_currency)}
+    if 'spot_price_matrix' in initial_values:
+        initial_values['spot_price_matrix'] = calculate_spot_price_matrix(pool)
     return initial_values
 
 
 def token_finding_hook(k):
     if "weight" in k and "denorm_weight" in k and "balance" in k and "bound" in k:
-        return Token(weight=k["weight"], denorm_weight=k["denorm_weight"], balance=Decimal(k["balance"]), bound=k["bound"])
+        return Token(weight=Decimal(k["weight"]), denorm_weight=Decimal(k["denorm_weight"]), balance=Decimal(k["balance"]), bound=k["bound"])
     return k
@@ -0,0 +1,115 @@
+"""
+Keyframes for window studies. A KeyframeIndex is built once per tape by replaying it in the cheap REPLAY_OUTPUT mode (the pool
+takes the amounts recorded on the tape instead of recomputing them) and keeping the state every `interval` timesteps. A window of
+the tape, given in timesteps, timestamps or block numbers, is then simulated in any decoding mode from the latest keyframe at or
+before its start, so only up to interval - 1 actions are replayed before the window instead of everything since pool_creation.
+
+The state at the start of a window is therefore the historical one rebuilt from the recorded outputs, and the window itself is
+simulated with the decoding mode of the params.
+"""
+import typing
+
+import pandas as pd
+
+from model.checkpoints import atomic_pickle, read_pickle
+from model.parts.system_policies import ActionDecoder, ActionDecodingType, find_action_decoder
+from model.replay_engine import simulate
+
+
+class KeyframeRecorder:
+    # Used as the records of the replay engine, keeps only the states of the keyframe timesteps
+    def __init__(self, interval: int):
+        self.interval = interval
+        self.keyframes = {}
+        self.rows = 0
+
+    def __len__(self):
+        return self.rows
+
+    def append(self, state: dict):
+        if state['timestep'] % self.interval == 0:
+            self.keyframes[state['timestep']] = state
+        self.rows += 1
+
+
+class KeyframeIndex:
+    def __init__(self, interval: int, keyframes: typing.Dict[int, dict], timesteps: int, tape_digest: str):
+        self.interval = interval
+        # timestep -> state before the action of that timestep is played
+        self.keyframes = keyframes
+        # Number of timesteps the index covers and digest of their actions, see ActionDecoder.prefix_digest()
+        self.timesteps = timesteps
+        self.tape_digest = tape_digest
+
+    @classmethod
+    def build(cls, initial_state: dict, partial_state_update_blocks: typing.List[dict], params: dict,
+              interval: int = 1000) -> 'KeyframeIndex':
+        """
+        Replays the whole tape of the blocks in REPLAY_OUTPUT mode, whatever the decoding_type of params, so the keyframe pools have
+        the balances and pool shares recorded on the tape.
+        """
+        if interval < 1:
+            raise Exception('keyframe interval must be at least 1 timestep')
+        action_decoder = find_action_decoder(partial_state_update_blocks)
+        params = {**params, 'decoding_type': ActionDecodingType.replay_output.value}
+        timesteps = len(action_decoder) - 1
+        recorder = KeyframeRecorder(interval)
+        simulate(initial_state, partial_state_update_blocks, params, range(timesteps), records=recorder)
+        return cls(interval, recorder.keyframes, timesteps, action_decoder.prefix_digest(timesteps))
+
+    def save(self, path: str):
+        atomic_pickle(self, path)
+
+    @staticmethod
+    def load(path: str) -> 'KeyframeIndex':
+        return read_pickle(path)
+
+    def check_tape(self, action_decoder: ActionDecoder):
+        if action_decoder.prefix_digest(self.timesteps) != self.tape_digest:
+            raise Exception('the keyframe index was built from another tape')
+
+    def nearest(self, timestep: int) -> dict:
+        # Latest keyframe at or before timestep
+        keyframe_timestep = min(timestep, self.timesteps) // self.interval * self.interval
+        return self.keyframes[keyframe_timestep]
+
+
+def window_timesteps(action_decoder: ActionDecoder, start, end, by: str = 'timestep') -> range:
+    """
+    Timesteps whose actions are in [start, end], with start and end given as timesteps, 'timestamp's or 'block_number's of the
+    actions. Price updates have no block number, the ones between the first and last action of the block range are included.
+    """
+    if by == 'timestep':
+        return range(start, end + 1)
+    if by == 'timestamp':
+        values = action_decoder.action_df['timestamp']
+        start, end = pd.Timestamp(start), pd.Timestamp(end)
+        if values.dt.tz is not None:
+            start = start.tz_localize('UTC') if start.tz is None else start
+            end = end.tz_localize('UTC') if end.tz is None else end
+    elif by == 'block_number':
+        values = pd.to_numeric(action_decoder.action_df['block_number'], errors='coerce')
+    else:
+        raise Exception("by must be 'timestep', 'timestamp' or 'block_number'")
+    labels = values.index[(values >= start) & (values <= end)]
+    if len(labels) == 0:
+        raise Exception(f'no actions between {start} and {end}')
+    # action_df is indexed from 1 after dropping the pool creation, so action n is played at timestep n - 1
+    return range(labels.min() - 1, labels.max())
+
+
+def simulate_window(index: KeyframeIndex, partial_state_update_blocks: typing.List[dict], params: dict, start, end,
+                    by: str = 'timestep', compaction: typing.Optional[int] = None) -> pd.DataFrame:
+    """
+    Simulates the actions in [start, end] of the tape of the blocks (see window_timesteps) from the nearest keyframe and returns the raw frame of run()
+    for the window: the state before its first action, then the state after each action.
+    """
+    action_decoder = find_action_decoder(partial_state_update_blocks)
+    index.check_tape(action_decoder)
+    timesteps = window_timesteps(action_decoder, start, end, by=by)
+    if timesteps.start < 0 or timesteps.stop > index.timesteps:
+        raise Exception(f'the window must be within the {index.timesteps} timesteps of the tape')
+    keyframe = index.nearest(timesteps.start)
+    records = simulate(keyframe, partial_state_update_blocks, params, range(keyframe['timestep'], timesteps.stop),
+                       compaction=compaction)
+    return pd.DataFrame([state for state in records if state['timestep'] >= timesteps.start])
@@ -8,11 +8,15 @@ def ensure_type(value, types):
             value=value, value_type=type(value), types=types))
 
 class Token:
+    """
+    Immutable, so that consecutive pool states can share the Token objects of the tokens an update didn't touch. Use replace() to get
+    a Token with some fields changed.
+    """
     def __init__(self, weight: Decimal, denorm_weight: Decimal, balance: Decimal, bound: bool):
-        self.weight = weight
-        self.denorm_weight = denorm_weight
-        self.balance = balance
-        self.bound = bound
+        self.__dict__['weight'] = weight
+        self.__dict__['denorm_weight'] = denorm_weight
+        self.__dict__['balance'] = ensure_type(balance, Decimal)
+        self.__dict__['bound'] = bound
 
     def __repr__(self):
         return "Token weight: {}, denorm_weight: {}, balance: {}, bound: {}".format(self.weight, self.denorm_weight, self.balance, self.bound)
@@ -22,14 +26,20 @@ class Token:
             return (self.weight == other.weight) and (self.denorm_weight == other.denorm_weight) and (self.balance == other.balance) and (self.bound == other.bound)
         return NotImplemented
 
-    def add(self, num):
-        self.amount = self.amount + num
-        return self.amount
+    def __setattr__(self, key, value):
+        raise AttributeError(f'Token is immutable, use Token.replace({key}=...) instead')
 
-    @property
-    def balance(self):
-        return self.__dict__['balance']
+    # Nothing to copy for an immutable object, this also keeps cadCAD's per-substep deepcopy of the state from copying every token
+    def __copy__(self):
+        return self
 
-    @balance.setter
-    def balance(self, value):
-        self.__dict__['balance'] = ensure_type(value, Decimal)
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return Token, (self.weight, self.denorm_weight, self.balance, self.bound)
+
+    def replace(self, **changes) -> 'Token':
+        fields = dict(weight=self.weight, denorm_weight=self.denorm_weight, balance=self.balance, bound=self.bound)
+        fields.update(changes)
+        return Token(**fields)
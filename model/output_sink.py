@@ -0,0 +1,100 @@
+"""
+Streaming output for long replays and sweeps. An OutputSink takes the place of the list of states in the replay engine: every
+state is written into a StateRecorder of row_group_size rows, and each time it is full the rows are written to disk as one row
+group (Parquet) or record batch (Arrow IPC), so memory stays bounded by row_group_size whatever the length of the tape.
+
+Files are partitioned by subset and run, <directory>/subset=<subset>/run=<run>/part-0.parquet, and hold the same columns as
+StateRecorder.to_dataframe(), with subset and run in the path only. read_output() scans them lazily: only the requested columns
+and partitions are read.
+"""
+import os
+import typing
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from model.state_recorder import StateRecorder
+
+FILE_FORMATS = {'parquet': 'parquet', 'arrow': 'ipc'}
+
+
+class OutputSink:
+    def __init__(self, directory: str, token_symbols: typing.List[str], spot_price_symbols: typing.List[str],
+                 row_group_size: int = 50000, file_format: str = 'parquet'):
+        if file_format not in FILE_FORMATS:
+            raise Exception(f'file_format must be one of {list(FILE_FORMATS)}')
+        if row_group_size < 1:
+            raise Exception('row_group_size must be at least 1 row')
+        self.directory = directory
+        self.file_format = file_format
+        self.buffer = StateRecorder(token_symbols, spot_price_symbols, row_group_size)
+        # (subset, run) of the partition being written
+        self.partition = None
+        self.writer = None
+        # Schema of the first row group, the later ones are cast to it
+        self.schema = None
+        self.rows_written = 0
+
+    @classmethod
+    def from_initial_state(cls, directory: str, initial_state: dict, row_group_size: int = 50000,
+                           file_format: str = 'parquet') -> 'OutputSink':
+        return cls(directory, list(initial_state['pool']['tokens'].keys()), list(initial_state['spot_prices'].keys()),
+                   row_group_size=row_group_size, file_format=file_format)
+
+    def partition_path(self, subset: int, run: int) -> str:
+        extension = 'parquet' if self.file_format == 'parquet' else 'arrow'
+        return os.path.join(self.directory, f'subset={subset}', f'run={run}', f'part-0.{extension}')
+
+    def __len__(self):
+        return self.rows_written + len(self.buffer)
+
+    def append(self, state: dict):
+        partition = (state['subset'], state['run'])
+        if partition != self.partition:
+            self.close()
+            self.partition = partition
+        elif len(self.buffer) == self.buffer.rows:
+            self.flush()
+        self.buffer.append(state)
+
+    def flush(self):
+        if not len(self.buffer):
+            return
+        table = pa.Table.from_pandas(self.buffer.to_dataframe().drop(columns=['subset', 'run']), preserve_index=False)
+        if self.writer is None:
+            path = self.partition_path(*self.partition)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.schema = table.schema
+            if self.file_format == 'parquet':
+                self.writer = pq.ParquetWriter(path, self.schema)
+            else:
+                self.writer = pa.ipc.new_file(path, self.schema)
+        table = table.cast(self.schema)
+        if self.file_format == 'parquet':
+            self.writer.write_table(table, row_group_size=len(table))
+        else:
+            self.writer.write_table(table, max_chunksize=len(table))
+        self.rows_written += len(table)
+        self.buffer.clear()
+
+    def close(self):
+        """
+        Writes the remaining rows of the current partition and closes its file. Must be called once the simulation is done.
+        """
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        self.partition = None
+
+
+def read_output(directory: str, columns: typing.Optional[typing.List[str]] = None, filter=None,
+                file_format: str = 'parquet') -> pd.DataFrame:
+    """
+    Reads the files written by an OutputSink. columns limits the columns that are read (subset and run can be included), filter is
+    a pyarrow expression, e.g. (ds.field('subset') == 1) & (ds.field('timestep') > 1000), used to skip partitions and row groups.
+    """
+    dataset = ds.dataset(directory, format=FILE_FORMATS[file_format], partitioning='hive')
+    return dataset.to_table(columns=columns, filter=filter).to_pandas()
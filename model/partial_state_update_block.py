@@ -1,16 +1,25 @@
+from model.parts.agent_policies import p_arbitrageur
 from model.parts.system_policies import ActionDecoder
 from model.parts.general_state_updates import s_update_change_datetime, s_update_action_type
-from model.parts.pool_state_updates import s_update_pool, s_update_spot_prices
+from model.parts.pool_state_updates import s_update_pool, s_update_spot_price_matrix, s_update_spot_prices
 from model.parts.external_price_feed_state_updates import s_update_external_price_feeds
 
 
-def generate_partial_state_update_blocks(path_to_action_json: str) -> dict:
-    steps_number = ActionDecoder.load_actions(path_to_action_json)
-    return {
+def generate_partial_state_update_blocks(path_to_action_json: str, spot_price_matrix: bool = False, arbitrage: bool = False) -> dict:
+    """
+    spot_price_matrix also keeps the spot prices of every pair of tokens in the spot_price_matrix state variable, the initial state
+    needs it too (generate_initial_state(..., spot_price_matrix=True)).
+    arbitrage adds an arbitrageur that trades the pool back to the external prices on every price update, in the row of the price
+    update (see agent_policies.p_arbitrageur).
+    """
+    # Every call gets its own decoder, so the blocks of different tapes can be used side by side
+    action_decoder = ActionDecoder(path_to_action_json)
+    steps_number = len(action_decoder)
+    result = {
         'partial_state_update_blocks': [
             {
                 'policies': {
-                    'user_action': ActionDecoder.p_action_decoder,
+                    'user_action': action_decoder.p_action_decoder,
                 },
                 'variables': {
                     'pool': s_update_pool,
@@ -23,3 +32,9 @@ def generate_partial_state_update_blocks(path_to_action_json: str) -> dict:
         ],
         'steps_number': steps_number,
     }
+    if arbitrage:
+        result['partial_state_update_blocks'][0]['policies']['arbitrageur'] = p_arbitrageur
+    if spot_price_matrix:
+        for block in result['partial_state_update_blocks']:
+            block['variables']['spot_price_matrix'] = s_update_spot_price_matrix
+    return result
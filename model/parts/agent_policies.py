@@ -0,0 +1,85 @@
+import itertools
+import typing
+from decimal import Decimal
+
+from model.parts.balancer_constants import MAX_IN_RATIO
+from model.parts.balancer_math import BalancerMath
+from model.parts.pool_method_entities import SwapExactAmountInInput, TokenAmount
+from model.parts.pool_state_updates import s_pool_update_fee, s_swap_exact_amount_in
+
+
+# **********************************************************************************************
+# optimalArbitrageAmountIn                                                                  //
+# aI = token_amount_in               /  /     pO      \   (wO / (wI + wO))     \               //
+# bI = token_balance_in         bI * |  | ----------  | ^                  - 1  |              //
+# pI = price of token_in             \  \  pI * sP    /                        /               //
+# pO = price of token_out  aI = ----------------------------------------------                 //
+# sP = spot price with fee                            ( 1 - sF )                                //
+# sF = swap_fee                                                                               //
+# **********************************************************************************************/
+def optimal_arbitrage_amount_in(token_balance_in: Decimal, token_weight_in: Decimal, token_balance_out: Decimal,
+                                token_weight_out: Decimal, swap_fee: Decimal, token_price_in: Decimal,
+                                token_price_out: Decimal) -> Decimal:
+    """
+    The amount of token_in that maximizes token_price_out * amount_out - token_price_in * amount_in, where the marginal price of the
+    trade with fee reaches token_price_out / token_price_in (the spot price of the pool after it differs by the fee kept in the
+    pool). 0 when the pool price is already within the fee of the external price in this direction.
+    """
+    spot_price = BalancerMath.calc_spot_price(token_balance_in, token_weight_in, token_balance_out, token_weight_out, swap_fee)
+    price_ratio = token_price_out / (token_price_in * spot_price)
+    if price_ratio <= 1:
+        return Decimal('0')
+    exponent = token_weight_out / (token_weight_in + token_weight_out)
+    return token_balance_in * (pow(price_ratio, exponent) - 1) / (1 - swap_fee)
+
+
+def arbitrage_trades(params, substep, state_history, pool: dict, token_prices: dict) -> typing.Tuple[typing.List[tuple], dict]:
+    """
+    The arbitrage swaps of pool for token_prices, as (SwapExactAmountInInput, None) pool updates, and the pool after them with the
+    sum of their fees as generated_fees. Pairs are arbitraged one after the other, each on the pool left by the previous ones, so
+    with two tokens there is a single exact trade.
+    """
+    trades = []
+    fees = {}
+    pairs = [(token_a, token_b) for token_a, token_b in itertools.combinations(list(pool['tokens']), 2)
+             if token_a in token_prices and token_b in token_prices]
+    for token_a, token_b in pairs:
+        for token_in, token_out in ((token_a, token_b), (token_b, token_a)):
+            record_in = pool['tokens'][token_in]
+            record_out = pool['tokens'][token_out]
+            if not record_in.bound or not record_out.bound:
+                continue
+            token_amount_in = optimal_arbitrage_amount_in(record_in.balance, Decimal(record_in.denorm_weight), record_out.balance,
+                                                          Decimal(record_out.denorm_weight), Decimal(pool['swap_fee']),
+                                                          Decimal(str(token_prices[token_in])), Decimal(str(token_prices[token_out])))
+            if token_amount_in == 0:
+                continue
+            # Same limit as s_swap_exact_amount_in
+            token_amount_in = min(token_amount_in, record_in.balance * MAX_IN_RATIO)
+            # s_swap_exact_amount_in computes the amount out, the trade has no recorded output
+            trade = (SwapExactAmountInInput(token_in=TokenAmount(token_in, token_amount_in), min_token_out=TokenAmount(token_out, Decimal('0'))),
+                     None)
+            trades.append(trade)
+            pool = s_swap_exact_amount_in(params, substep, state_history, {'pool': pool}, *trade)
+            for token, fee in pool['generated_fees'].items():
+                fees[token] = fees.get(token, Decimal('0')) + fee
+            # At most one direction of a pair is profitable
+            break
+    if trades:
+        _, pool = s_pool_update_fee(pool, fees)
+    return trades, pool
+
+
+def arbitrage(params, substep, state_history, pool: dict, token_prices: dict) -> dict:
+    _, pool = arbitrage_trades(params, substep, state_history, pool, token_prices)
+    return pool
+
+
+def p_arbitrageur(params, substep, state_history, current_state):
+    """
+    Arbitrages the pool against the external prices of every external_price_update of the tape, in the same substep. The new
+    prices are only in the policy input of the action decoder, so the policy hands over the arbitrage and updated_pool applies it
+    to the pool of the price update. The trades go through s_swap_exact_amount_in whatever the decoding_type, they are not on the
+    tape so there is no recorded output to replay.
+    """
+    return {'arbitrage': arbitrage}
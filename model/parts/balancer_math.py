@@ -15,6 +15,8 @@ class BalancerMathResult:
 
 
 class BalancerMath:
+    # No instance state, so that pools with __slots__ (CompactBalancerPool) don't get a __dict__
+    __slots__ = ()
 
     # **********************************************************************************************
     # calcSpotPrice                                                                             //
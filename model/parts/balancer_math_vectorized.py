@@ -0,0 +1,112 @@
+import numpy as np
+from attr import dataclass
+
+from . import balancer_constants
+
+# Batch counterpart of BalancerMath: every argument may be a scalar or a NumPy array (anything np.asarray accepts, including
+# lists of Decimals), arguments are broadcast against each other and evaluated in float64.
+#
+# Error bound against the Decimal path (prec=28): the pow() terms are rewritten as expm1(w * log1p(x)) so that small trades do
+# not cancel catastrophically in 1 - y^w. For inputs inside the contract's domain (amount_in <= MAX_IN_RATIO * balance,
+# amount_out <= MAX_OUT_RATIO * balance, denorm weights between MIN_WEIGHT and MAX_WEIGHT, swap_fee <= MAX_FEE) the relative
+# error of every result and fee is below FLOAT64_RELATIVE_ERROR_BOUND. Outside that domain (e.g. exits that burn almost the
+# whole supply of a low weight token) the exponent magnifies the rounding error and the bound no longer holds.
+# Fees are computed directly from the fee factor instead of as a difference of two nearly equal amounts.
+FLOAT64_RELATIVE_ERROR_BOUND = 1e-12
+
+_EXIT_FEE = float(balancer_constants.EXIT_FEE)
+
+
+@dataclass
+class BalancerMathBatchResult:
+    # The relevant result of the operation, one entry per trade
+    result: np.ndarray
+    # Amount of tokens the pool keeps, one entry per trade (see BalancerMathResult)
+    fee: np.ndarray
+
+
+def _f64(value) -> np.ndarray:
+    return np.asarray(value, dtype=np.float64)
+
+
+class BalancerMathVectorized:
+
+    # sP = (bI / wI) / (bO / wO) * 1 / (1 - sF), see BalancerMath.calc_spot_price
+    @staticmethod
+    def calc_spot_price(token_balance_in, token_weight_in, token_balance_out, token_weight_out, swap_fee) -> np.ndarray:
+        numer = _f64(token_balance_in) / _f64(token_weight_in)
+        denom = _f64(token_balance_out) / _f64(token_weight_out)
+        return numer / denom / (1.0 - _f64(swap_fee))
+
+    # aO = bO * (1 - (bI / (bI + aI * (1 - sF))) ^ (wI / wO)), see BalancerMath.calc_out_given_in
+    @staticmethod
+    def calc_out_given_in(token_amount_in, token_balance_in, token_weight_in, token_balance_out, token_weight_out,
+                          swap_fee) -> BalancerMathBatchResult:
+        token_amount_in = _f64(token_amount_in)
+        weight_ratio = _f64(token_weight_in) / _f64(token_weight_out)
+        adjusted_in = token_amount_in * (1.0 - _f64(swap_fee))
+        # log(y) = log(bI / (bI + adjusted_in)) = -log1p(adjusted_in / bI)
+        log_y = -np.log1p(adjusted_in / _f64(token_balance_in))
+        token_amount_out = _f64(token_balance_out) * -np.expm1(weight_ratio * log_y)
+        return BalancerMathBatchResult(token_amount_out, token_amount_in * _f64(swap_fee))
+
+    # aI = bI * ((bO / (bO - aO)) ^ (wO / wI) - 1) / (1 - sF), see BalancerMath.calc_in_given_out
+    @staticmethod
+    def calc_in_given_out(token_balance_out, token_balance_in, token_amount_out, token_weight_in, token_weight_out,
+                          swap_fee) -> BalancerMathBatchResult:
+        weight_ratio = _f64(token_weight_out) / _f64(token_weight_in)
+        # log(y) = log(bO / (bO - aO)) = -log1p(-aO / bO)
+        log_y = -np.log1p(-_f64(token_amount_out) / _f64(token_balance_out))
+        token_amount_in_no_fee = _f64(token_balance_in) * np.expm1(weight_ratio * log_y)
+        token_amount_in = token_amount_in_no_fee / (1.0 - _f64(swap_fee))
+        return BalancerMathBatchResult(token_amount_in, token_amount_in * _f64(swap_fee))
+
+    # pAo = ((tBi + tAi * (1 - (1 - wI / tW) * sF)) / tBi) ^ (wI / tW) * pS - pS, see BalancerMath.calc_pool_out_given_single_in
+    @staticmethod
+    def calc_pool_out_given_single_in(token_balance_in, token_weight_in, pool_supply, total_weight, token_amount_in,
+                                      swap_fee) -> BalancerMathBatchResult:
+        token_amount_in = _f64(token_amount_in)
+        normalized_weight = _f64(token_weight_in) / _f64(total_weight)
+        zaz = (1.0 - normalized_weight) * _f64(swap_fee)
+        token_amount_in_after_fee = token_amount_in * (1.0 - zaz)
+        log_token_in_ratio = np.log1p(token_amount_in_after_fee / _f64(token_balance_in))
+        pool_amount_out = _f64(pool_supply) * np.expm1(normalized_weight * log_token_in_ratio)
+        return BalancerMathBatchResult(pool_amount_out, token_amount_in * zaz)
+
+    # tAi = (((pS + pAo) / pS) ^ (tW / wI) * bI - bI) / (1 - (1 - wI / tW) * sF), see BalancerMath.calc_single_in_given_pool_out
+    @staticmethod
+    def calc_single_in_given_pool_out(token_balance_in, token_weight_in, pool_supply, total_weight, pool_amount_out,
+                                      swap_fee) -> BalancerMathBatchResult:
+        normalized_weight = _f64(token_weight_in) / _f64(total_weight)
+        log_pool_ratio = np.log1p(_f64(pool_amount_out) / _f64(pool_supply))
+        token_amount_in_after_fee = _f64(token_balance_in) * np.expm1(log_pool_ratio / normalized_weight)
+        zar = (1.0 - normalized_weight) * _f64(swap_fee)
+        token_amount_in = token_amount_in_after_fee / (1.0 - zar)
+        return BalancerMathBatchResult(token_amount_in, token_amount_in * zar)
+
+    # tAo = (bO - ((pS - pAi * (1 - eF)) / pS) ^ (tW / wO) * bO) * (1 - (1 - wO / tW) * sF),
+    # see BalancerMath.calc_single_out_given_pool_in
+    @staticmethod
+    def calc_single_out_given_pool_in(token_balance_out, token_weight_out, pool_supply, total_weight, pool_amount_in,
+                                      swap_fee) -> BalancerMathBatchResult:
+        normalized_weight = _f64(token_weight_out) / _f64(total_weight)
+        pool_amount_in_after_exit_fee = _f64(pool_amount_in) * (1.0 - _EXIT_FEE)
+        log_pool_ratio = np.log1p(-pool_amount_in_after_exit_fee / _f64(pool_supply))
+        token_amount_out_before_swap_fee = _f64(token_balance_out) * -np.expm1(log_pool_ratio / normalized_weight)
+        zaz = (1.0 - normalized_weight) * _f64(swap_fee)
+        token_amount_out = token_amount_out_before_swap_fee * (1.0 - zaz)
+        return BalancerMathBatchResult(token_amount_out, token_amount_out_before_swap_fee * zaz)
+
+    # pAi = (pS - ((bO - tAo / (1 - (1 - wO / tW) * sF)) / bO) ^ (wO / tW) * pS) / (1 - eF),
+    # see BalancerMath.calc_pool_in_given_single_out
+    @staticmethod
+    def calc_pool_in_given_single_out(token_balance_out, token_weight_out, pool_supply, total_weight, token_amount_out,
+                                      swap_fee) -> BalancerMathBatchResult:
+        token_amount_out = _f64(token_amount_out)
+        normalized_weight = _f64(token_weight_out) / _f64(total_weight)
+        zar = (1.0 - normalized_weight) * _f64(swap_fee)
+        token_amount_out_before_swap_fee = token_amount_out / (1.0 - zar)
+        log_token_out_ratio = np.log1p(-token_amount_out_before_swap_fee / _f64(token_balance_out))
+        pool_amount_in_after_exit_fee = _f64(pool_supply) * -np.expm1(normalized_weight * log_token_out_ratio)
+        pool_amount_in = pool_amount_in_after_exit_fee / (1.0 - _EXIT_FEE)
+        return BalancerMathBatchResult(pool_amount_in, token_amount_out_before_swap_fee * zar)
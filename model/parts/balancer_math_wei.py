@@ -0,0 +1,276 @@
+from decimal import Decimal
+
+from . import balancer_constants
+from .balancer_math import BalancerMathResult
+
+# Port of the BNum/BMath contracts (balancer-core) on Python ints scaled by 1e18. Every operation rounds exactly like the
+# Solidity code, so results are bit-exact with on-chain amounts as long as the inputs are the on-chain wei values.
+
+BONE = 10 ** 18
+MAX_UINT256 = 2 ** 256 - 1
+
+
+def to_wei(amount) -> int:
+    return int(Decimal(amount).scaleb(18).to_integral_value())
+
+
+def from_wei(amount: int) -> Decimal:
+    return Decimal(amount).scaleb(-18)
+
+
+EXIT_FEE = to_wei(balancer_constants.EXIT_FEE)
+MIN_BPOW_BASE = to_wei(balancer_constants.MIN_BPOW_BASE)
+MAX_BPOW_BASE = to_wei(balancer_constants.MAX_BPOW_BASE)
+BPOW_PRECISION = to_wei(balancer_constants.BPOW_PRECISION)
+
+
+def btoi(a: int) -> int:
+    return a // BONE
+
+
+def bfloor(a: int) -> int:
+    return btoi(a) * BONE
+
+
+def badd(a: int, b: int) -> int:
+    c = a + b
+    if c > MAX_UINT256:
+        raise Exception("ERR_ADD_OVERFLOW")
+    return c
+
+
+def bsub(a: int, b: int) -> int:
+    c, flag = bsub_sign(a, b)
+    if flag:
+        raise Exception("ERR_SUB_UNDERFLOW")
+    return c
+
+
+def bsub_sign(a: int, b: int) -> (int, bool):
+    if a >= b:
+        return a - b, False
+    else:
+        return b - a, True
+
+
+def bmul(a: int, b: int) -> int:
+    c0 = a * b
+    if c0 > MAX_UINT256:
+        raise Exception("ERR_MUL_OVERFLOW")
+    c1 = c0 + (BONE // 2)
+    if c1 > MAX_UINT256:
+        raise Exception("ERR_MUL_OVERFLOW")
+    return c1 // BONE
+
+
+def bdiv(a: int, b: int) -> int:
+    if b == 0:
+        raise Exception("ERR_DIV_ZERO")
+    c0 = a * BONE
+    if c0 > MAX_UINT256:
+        raise Exception("ERR_DIV_INTERNAL")
+    c1 = c0 + (b // 2)
+    if c1 > MAX_UINT256:
+        raise Exception("ERR_DIV_INTERNAL")
+    return c1 // b
+
+
+# DSMath.wpow
+def bpowi(a: int, n: int) -> int:
+    z = a if n % 2 != 0 else BONE
+    n //= 2
+    while n != 0:
+        a = bmul(a, a)
+        if n % 2 != 0:
+            z = bmul(z, a)
+        n //= 2
+    return z
+
+
+# Compute b^(e.w) by splitting it into (b^e)*(b^0.w).
+# Use `bpowi` for `b^e` and `bpow_approx` for b^0.w
+def bpow(base: int, exp: int) -> int:
+    if base < MIN_BPOW_BASE:
+        raise Exception("ERR_BPOW_BASE_TOO_LOW")
+    if base > MAX_BPOW_BASE:
+        raise Exception("ERR_BPOW_BASE_TOO_HIGH")
+
+    whole = bfloor(exp)
+    remain = bsub(exp, whole)
+
+    whole_pow = bpowi(base, btoi(whole))
+
+    if remain == 0:
+        return whole_pow
+
+    partial_result = bpow_approx(base, remain, BPOW_PRECISION)
+    return bmul(whole_pow, partial_result)
+
+
+# Binomial series for base^exp with 0 <= exp < 1, stopping once a term drops below precision
+def bpow_approx(base: int, exp: int, precision: int) -> int:
+    a = exp
+    x, xneg = bsub_sign(base, BONE)
+    term = BONE
+    total = term
+    negative = False
+
+    # term(k) = numer / denom
+    #         = (product(a - i - 1, i=1-->k) * x^k) / (k!)
+    # each iteration, multiply previous term by (a-(k-1)) * x / k
+    # continue until term is less than precision
+    i = 1
+    while term >= precision:
+        big_k = i * BONE
+        c, cneg = bsub_sign(a, bsub(big_k, BONE))
+        term = bmul(term, bmul(c, x))
+        term = bdiv(term, big_k)
+        if term == 0:
+            break
+
+        if xneg:
+            negative = not negative
+        if cneg:
+            negative = not negative
+        if negative:
+            total = bsub(total, term)
+        else:
+            total = badd(total, term)
+        i += 1
+
+    return total
+
+
+class BalancerMathWei:
+    # Same signatures as BalancerMath, but every amount, weight and fee is an int in wei (see to_wei/from_wei)
+
+    @staticmethod
+    def calc_spot_price(
+            token_balance_in: int,
+            token_weight_in: int,
+            token_balance_out: int,
+            token_weight_out: int,
+            swap_fee: int) -> int:
+        numer = bdiv(token_balance_in, token_weight_in)
+        denom = bdiv(token_balance_out, token_weight_out)
+        ratio = bdiv(numer, denom)
+        scale = bdiv(BONE, bsub(BONE, swap_fee))
+        return bmul(ratio, scale)
+
+    @staticmethod
+    def calc_out_given_in(
+            token_amount_in: int,
+            token_balance_in: int,
+            token_weight_in: int,
+            token_balance_out: int,
+            token_weight_out: int,
+            swap_fee: int) -> BalancerMathResult:
+        weight_ratio = bdiv(token_weight_in, token_weight_out)
+        adjusted_in = bmul(token_amount_in, bsub(BONE, swap_fee))
+        y = bdiv(token_balance_in, badd(token_balance_in, adjusted_in))
+        foo = bpow(y, weight_ratio)
+        bar = bsub(BONE, foo)
+        token_amount_out = bmul(token_balance_out, bar)
+        return BalancerMathResult(token_amount_out, token_amount_in - adjusted_in)
+
+    @staticmethod
+    def calc_in_given_out(
+            token_balance_out: int,
+            token_balance_in: int,
+            token_amount_out: int,
+            token_weight_in: int,
+            token_weight_out: int,
+            swap_fee: int) -> BalancerMathResult:
+        weight_ratio = bdiv(token_weight_out, token_weight_in)
+        diff = bsub(token_balance_out, token_amount_out)
+        y = bdiv(token_balance_out, diff)
+        foo = bpow(y, weight_ratio)
+        foo = bsub(foo, BONE)
+        token_amount_in_no_fee = bmul(token_balance_in, foo)
+        token_amount_in = bdiv(token_amount_in_no_fee, bsub(BONE, swap_fee))
+        return BalancerMathResult(token_amount_in, token_amount_in - token_amount_in_no_fee)
+
+    @staticmethod
+    def calc_pool_out_given_single_in(
+            token_balance_in: int,
+            token_weight_in: int,
+            pool_supply: int,
+            total_weight: int,
+            token_amount_in: int,
+            swap_fee: int) -> BalancerMathResult:
+        normalized_weight = bdiv(token_weight_in, total_weight)
+        zaz = bmul(bsub(BONE, normalized_weight), swap_fee)
+        token_amount_in_after_fee = bmul(token_amount_in, bsub(BONE, zaz))
+
+        new_token_balance_in = badd(token_balance_in, token_amount_in_after_fee)
+        token_in_ratio = bdiv(new_token_balance_in, token_balance_in)
+
+        pool_ratio = bpow(token_in_ratio, normalized_weight)
+        new_pool_supply = bmul(pool_ratio, pool_supply)
+        pool_amount_out = bsub(new_pool_supply, pool_supply)
+        return BalancerMathResult(pool_amount_out, token_amount_in - token_amount_in_after_fee)
+
+    @staticmethod
+    def calc_single_in_given_pool_out(
+            token_balance_in: int,
+            token_weight_in: int,
+            pool_supply: int,
+            total_weight: int,
+            pool_amount_out: int,
+            swap_fee: int) -> BalancerMathResult:
+        normalized_weight = bdiv(token_weight_in, total_weight)
+        new_pool_supply = badd(pool_supply, pool_amount_out)
+        pool_ratio = bdiv(new_pool_supply, pool_supply)
+
+        boo = bdiv(BONE, normalized_weight)
+        token_in_ratio = bpow(pool_ratio, boo)
+        new_token_balance_in = bmul(token_in_ratio, token_balance_in)
+        token_amount_in_after_fee = bsub(new_token_balance_in, token_balance_in)
+
+        zar = bmul(bsub(BONE, normalized_weight), swap_fee)
+        token_amount_in = bdiv(token_amount_in_after_fee, bsub(BONE, zar))
+        return BalancerMathResult(token_amount_in, token_amount_in - token_amount_in_after_fee)
+
+    @staticmethod
+    def calc_single_out_given_pool_in(
+            token_balance_out: int,
+            token_weight_out: int,
+            pool_supply: int,
+            total_weight: int,
+            pool_amount_in: int,
+            swap_fee: int) -> BalancerMathResult:
+        normalized_weight = bdiv(token_weight_out, total_weight)
+        pool_amount_in_after_exit_fee = bmul(pool_amount_in, bsub(BONE, EXIT_FEE))
+        new_pool_supply = bsub(pool_supply, pool_amount_in_after_exit_fee)
+        pool_ratio = bdiv(new_pool_supply, pool_supply)
+
+        token_out_ratio = bpow(pool_ratio, bdiv(BONE, normalized_weight))
+        new_token_balance_out = bmul(token_out_ratio, token_balance_out)
+        token_amount_out_before_swap_fee = bsub(token_balance_out, new_token_balance_out)
+
+        zaz = bmul(bsub(BONE, normalized_weight), swap_fee)
+        token_amount_out = bmul(token_amount_out_before_swap_fee, bsub(BONE, zaz))
+        return BalancerMathResult(token_amount_out, token_amount_out_before_swap_fee - token_amount_out)
+
+    @staticmethod
+    def calc_pool_in_given_single_out(
+            token_balance_out: int,
+            token_weight_out: int,
+            pool_supply: int,
+            total_weight: int,
+            token_amount_out: int,
+            swap_fee: int) -> BalancerMathResult:
+        normalized_weight = bdiv(token_weight_out, total_weight)
+        zoo = bsub(BONE, normalized_weight)
+        zar = bmul(zoo, swap_fee)
+        token_amount_out_before_swap_fee = bdiv(token_amount_out, bsub(BONE, zar))
+
+        new_token_balance_out = bsub(token_balance_out, token_amount_out_before_swap_fee)
+        token_out_ratio = bdiv(new_token_balance_out, token_balance_out)
+
+        pool_ratio = bpow(token_out_ratio, normalized_weight)
+        new_pool_supply = bmul(pool_ratio, pool_supply)
+        pool_amount_in_after_exit_fee = bsub(pool_supply, new_pool_supply)
+
+        pool_amount_in = bdiv(pool_amount_in_after_exit_fee, bsub(BONE, EXIT_FEE))
+        return BalancerMathResult(pool_amount_in, token_amount_out_before_swap_fee - token_amount_out)
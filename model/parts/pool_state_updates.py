@@ -1,7 +1,8 @@
+import threading
 from decimal import Decimal
 
-from model.parts.balancer_constants import (EXIT_FEE, MAX_IN_RATIO,
-                                            MAX_OUT_RATIO)
+from model.parts.balancer_constants import (EXIT_FEE, MAX_BOUND_TOKENS,
+                                            MAX_IN_RATIO, MAX_OUT_RATIO)
 from model.parts.balancer_math import BalancerMath
 from model.parts.pool_method_entities import (
     ExitPoolInput, ExitPoolOutput, ExitSwapPoolAmountInInput,
@@ -16,65 +17,146 @@ from model.parts.utils import get_param
 
 VERBOSE = False
 
-def s_update_pool(params, substep, state_history, previous_state, policy_input):
-    pool = policy_input.get('pool_update')
-    # Here the contents of pool should be e.g. (SwapExactAmountInInput, SwapExactAmountInOutput)
-    if pool is None:
-        # This means there is no change to the pool. Return the pool but with 0 generated fees.
-        return s_pool_update_fee(previous_state['pool'], {})
+def copy_pool(pool: dict) -> dict:
+    # The Token objects are immutable and stay shared with the previous state until set_token_balance() replaces the changed ones
+    pool = pool.copy()
+    pool['tokens'] = pool['tokens'].copy()
+    return pool
+
+
+def set_token_balance(pool: dict, symbol: str, balance: Decimal):
+    pool['tokens'][symbol] = pool['tokens'][symbol].replace(balance=balance)
 
-    decoding_type = get_param(params, "decoding_type")
-    if decoding_type == ActionDecodingType.replay_output:
-        pool_operation_suf = pool_replay_output_mappings[type(pool[0])]
+
+# Caches of the last pool update and spot prices. They are per thread, so that simulations running in other threads (see
+# sim_runner.run_concurrently) don't evict each other's entries
+_cache = threading.local()
+
+
+def updated_pool(params, substep, state_history, previous_state, policy_input) -> dict:
+    """
+    The pool after applying this substep's pool_update. Pool updates don't modify previous_state, so s_update_spot_prices needs
+    the updated pool too: the result is kept for the (previous pool, policy_input) objects of the substep, and whichever of
+    s_update_pool and s_update_spot_prices runs second gets it without recomputing.
+    """
+    # (previous pool, policy_input, updated pool) of the last update
+    previous_pool, last_policy_input, pool = getattr(_cache, 'last_pool_update', (None, None, None))
+    if previous_pool is previous_state['pool'] and last_policy_input is policy_input:
+        return pool
+
+    pool_update = policy_input.get('pool_update')
+    # Here the contents of pool_update should be e.g. (SwapExactAmountInInput, SwapExactAmountInOutput)
+    if pool_update is None:
+        # This means there is no change to the pool. Return the pool but with 0 generated fees.
+        _, pool = s_pool_update_fee(previous_state['pool'], {})
     else:
-        pool_operation_suf = pool_operation_mappings[type(pool[0])]
+        decoding_type = get_param(params, "decoding_type")
+        if ActionDecodingType(decoding_type) == ActionDecodingType.replay_output:
+            pool_operation_suf = pool_replay_output_mappings[type(pool_update[0])]
+        else:
+            pool_operation_suf = pool_operation_mappings[type(pool_update[0])]
+        pool = pool_operation_suf(params, substep, state_history, previous_state, pool_update[0], pool_update[1])
+    arbitrage = policy_input.get('arbitrage')
+    if arbitrage is not None and policy_input.get('external_price_update') is not None:
+        # See agent_policies.p_arbitrageur
+        pool = arbitrage(params, substep, state_history, pool, policy_input['external_price_update'])
+
+    _cache.last_pool_update = (previous_state['pool'], policy_input, pool)
+    return pool
+
 
-    pool = pool_operation_suf(params, substep, state_history, previous_state, pool[0], pool[1])
-    return 'pool', pool
+def s_update_pool(params, substep, state_history, previous_state, policy_input):
+    return 'pool', updated_pool(params, substep, state_history, previous_state, policy_input)
 
 
 def calculate_spot_prices(pool: dict, ref_token: str):
+    """
+    Pool updates replace the Token objects whose balance or weight they change (see set_token_balance), so the price of a token is
+    only recomputed if it or ref_token isn't the same object as in the pool of the last call.
+    """
+    # (pool, ref_token, spot_prices) of the last call
+    last_pool, last_ref_token, last_spot_prices = getattr(_cache, 'last_spot_prices', (None, None, None))
+    tokens = pool['tokens']
     swap_fee = pool['swap_fee']
-    balance_in = pool['tokens'][ref_token].balance
-    weight_in = pool['tokens'][ref_token].weight
+    ref = tokens[ref_token]
+    last_tokens = last_pool['tokens'] if (last_pool is not None and last_ref_token == ref_token and last_pool['swap_fee'] == swap_fee
+                                          and last_pool['tokens'].get(ref_token) is ref) else {}
     spot_prices = {}
-    for token in pool['tokens']:
+    for token in tokens:
         if token == ref_token:
             continue
-        balance_out = pool['tokens'][token].balance
-        weight_out = pool['tokens'][token].weight
-
-        price = BalancerMath.calc_spot_price(token_balance_in=Decimal(balance_in),
-                                             token_weight_in=Decimal(weight_in),
-                                             token_balance_out=Decimal(balance_out),
-                                             token_weight_out=Decimal(weight_out),
+        if last_tokens.get(token) is tokens[token]:
+            spot_prices[token] = last_spot_prices[token]
+            continue
+        price = BalancerMath.calc_spot_price(token_balance_in=Decimal(ref.balance),
+                                             token_weight_in=Decimal(ref.weight),
+                                             token_balance_out=Decimal(tokens[token].balance),
+                                             token_weight_out=Decimal(tokens[token].weight),
                                              swap_fee=Decimal(swap_fee))
         spot_prices[token] = price
+    _cache.last_spot_prices = (pool, ref_token, spot_prices)
     return spot_prices
 
 
 def s_update_spot_prices(params, substep, state_history, previous_state, policy_input):
-    pool = previous_state["pool"]
-
-    if isinstance(params, list):
-        # 1 param
-        ref_token = params[0]['spot_price_reference']
-    else:
-        # Parameter sweep
-        ref_token = params['spot_price_reference']
-
-
+    pool = updated_pool(params, substep, state_history, previous_state, policy_input)
+    ref_token = get_param(params, 'spot_price_reference')
     spot_prices = calculate_spot_prices(pool, ref_token)
     return 'spot_prices', spot_prices
 
 
+def calculate_spot_price_matrix(pool: dict) -> dict:
+    """
+    matrix[token_in][token_out] is the spot price of token_out in token_in, for every pair of tokens. Like calculate_spot_prices(),
+    only the rows and columns of the tokens that changed since the last call are recomputed, O(changed tokens * N).
+    """
+    tokens = pool['tokens']
+    if len(tokens) > MAX_BOUND_TOKENS:
+        raise Exception("ERR_MAX_TOKENS")
+    # (pool, spot_price_matrix) of the last call
+    last_pool, last_matrix = getattr(_cache, 'last_spot_price_matrix', (None, None))
+    if last_pool is None or last_pool['swap_fee'] != pool['swap_fee'] or last_pool['tokens'].keys() != tokens.keys():
+        changed = set(tokens)
+    else:
+        changed = {symbol for symbol, token in tokens.items() if last_pool['tokens'][symbol] is not token}
+        if not changed:
+            return last_matrix
+
+    swap_fee = Decimal(pool['swap_fee'])
+    matrix = {}
+    for token_in, record_in in tokens.items():
+        row = {}
+        for token_out, record_out in tokens.items():
+            if token_out == token_in:
+                continue
+            if token_in in changed or token_out in changed:
+                row[token_out] = BalancerMath.calc_spot_price(token_balance_in=Decimal(record_in.balance),
+                                                              token_weight_in=Decimal(record_in.weight),
+                                                              token_balance_out=Decimal(record_out.balance),
+                                                              token_weight_out=Decimal(record_out.weight),
+                                                              swap_fee=swap_fee)
+            else:
+                row[token_out] = last_matrix[token_in][token_out]
+        matrix[token_in] = row
+    _cache.last_spot_price_matrix = (pool, matrix)
+    return matrix
+
+
+def s_update_spot_price_matrix(params, substep, state_history, previous_state, policy_input):
+    pool = updated_pool(params, substep, state_history, previous_state, policy_input)
+    return 'spot_price_matrix', calculate_spot_price_matrix(pool)
+
+
 def s_pool_update_fee(pool, fees_per_token = dict()):
-    for token in pool['generated_fees']:
-        pool['generated_fees'][token] = fees_per_token.get(token, Decimal('0'))
-    return "pool", pool
+    generated_fees = {token: fees_per_token.get(token, Decimal('0')) for token in pool['generated_fees']}
+    return "pool", {**pool, 'generated_fees': generated_fees}
 
 
 def calculate_total_denorm_weight(pool) -> Decimal:
+    # Kept in the pool like BPool._totalWeight (see set_token_denorm_weight), pools built without it are summed
+    total_weight = pool.get('total_denorm_weight')
+    if total_weight is not None:
+        return total_weight
     total_weight = Decimal('0')
     for token_symbol in pool['tokens']:
         if pool['tokens'][token_symbol].bound:
@@ -82,9 +164,23 @@ def calculate_total_denorm_weight(pool) -> Decimal:
     return total_weight
 
 
+def set_token_denorm_weight(pool: dict, symbol: str, denorm_weight: Decimal):
+    """
+    Like BPool.rebind: changes the denorm weight of a token, then updates the total denorm weight and the normalized weight of
+    every token. This is the only place where weights change, the pool updates of the actions read the cached values.
+    """
+    tokens = pool['tokens']
+    tokens[symbol] = tokens[symbol].replace(denorm_weight=Decimal(denorm_weight))
+    pool.pop('total_denorm_weight', None)
+    total_weight = calculate_total_denorm_weight(pool)
+    for token_symbol, token in tokens.items():
+        tokens[token_symbol] = token.replace(weight=Decimal(token.denorm_weight) / total_weight)
+    pool['total_denorm_weight'] = total_weight
+
+
 def s_swap_exact_amount_in(params, step, history, current_state, input_params: SwapExactAmountInInput,
                            output_params: SwapExactAmountInOutput) -> dict:
-    pool = current_state['pool'].copy()
+    pool = copy_pool(current_state['pool'])
     # Parse action params
     token_in_symbol = input_params.token_in.symbol
     token_amount_in = input_params.token_in.amount
@@ -111,16 +207,14 @@ def s_swap_exact_amount_in(params, step, history, current_state, input_params: S
     )
 
     _, pool = s_pool_update_fee(pool, {token_in_symbol: swap_result.fee})
-    pool_in_balance = pool_token_in.balance + token_amount_in
-    pool_token_in.balance = pool_in_balance
-    pool_out_balance = out_record.balance - swap_result.result
-    out_record.balance = pool_out_balance
+    set_token_balance(pool, token_in_symbol, pool['tokens'][token_in_symbol].balance + token_amount_in)
+    set_token_balance(pool, token_out, pool['tokens'][token_out].balance - swap_result.result)
     return pool
 
 
 def s_swap_exact_amount_out(params, step, history, current_state, input_params: SwapExactAmountOutInput,
                             output_params: SwapExactAmountOutOutput) -> dict:
-    pool = current_state['pool'].copy()
+    pool = copy_pool(current_state['pool'])
     # Parse action params
     token_in_symbol = input_params.max_token_in.symbol
     token_amount_out = input_params.token_out.amount
@@ -151,8 +245,8 @@ def s_swap_exact_amount_out(params, step, history, current_state, input_params:
 
     _, pool = s_pool_update_fee(pool, {token_in_symbol: swap_result.fee})
 
-    pool_token_in.balance = pool_token_in.balance + token_amount_in
-    pool_token_out.balance = pool_token_out.balance - token_amount_out
+    set_token_balance(pool, token_in_symbol, pool['tokens'][token_in_symbol].balance + token_amount_in)
+    set_token_balance(pool, token_out_symbol, pool['tokens'][token_out_symbol].balance - token_amount_out)
 
     return pool
 
@@ -161,7 +255,7 @@ def s_join_pool(params, step, history, current_state, input_params: JoinParamsIn
     """
     Join a pool by providing liquidity for all token_symbols.
     """
-    pool = current_state['pool'].copy()
+    pool = copy_pool(current_state['pool'])
 
     # tokens_in is a suggestion. The real fixed input is pool_amount_out - how many pool shares does the user want.
     # tokens_in will then be recalculated and that value used instead.
@@ -179,7 +273,7 @@ def s_join_pool(params, step, history, current_state, input_params: JoinParamsIn
             print("WARNING: calculated that user should get {} {} but input specified that he should get {} {} instead".format(amount, symbol,
                                                                                                                                amount_expected,
                                                                                                                                symbol))
-        pool['tokens'][symbol].balance += amount
+        set_token_balance(pool, symbol, pool['tokens'][symbol].balance + amount)
     pool['pool_shares'] += pool_amount_out
 
     return pool
@@ -190,7 +284,7 @@ def s_join_swap_extern_amount_in(params, step, history, current_state, input_par
     """
     Join a pool by providing liquidity for a single token_symbol.
     """
-    pool = current_state['pool'].copy()
+    pool = copy_pool(current_state['pool'])
     tokens_in_symbol = input_params.token_in.symbol
     token_in_amount = input_params.token_in.amount
     pool_amount_out_expected = output_params.pool_amount_out
@@ -216,14 +310,14 @@ def s_join_swap_extern_amount_in(params, step, history, current_state, input_par
                 pool_amount_out, pool_amount_out_expected))
 
     pool['pool_shares'] = Decimal(pool['pool_shares']) + pool_amount_out
-    pool['tokens'][tokens_in_symbol].balance += token_in_amount
+    set_token_balance(pool, tokens_in_symbol, pool['tokens'][tokens_in_symbol].balance + token_in_amount)
 
     return pool
 
 
 def s_join_swap_pool_amount_out(params, step, history, current_state, input_params: JoinSwapPoolAmountOutInput,
                                 output_params: JoinSwapPoolAmountOutOutput):
-    pool = current_state['pool'].copy()
+    pool = copy_pool(current_state['pool'])
     max_token_in_amount = input_params.max_token_in.symbol
     tokens_in_symbol = input_params.max_token_in.symbol
     pool_amount_out = input_params.pool_amount_out
@@ -248,7 +342,7 @@ def s_join_swap_pool_amount_out(params, step, history, current_state, input_para
                 pool_amount_out, max_token_in_amount))
 
     pool['pool_shares'] = Decimal(pool['pool_shares']) + pool_amount_out
-    pool['tokens'][tokens_in_symbol].balance += token_in_amount
+    set_token_balance(pool, tokens_in_symbol, pool['tokens'][tokens_in_symbol].balance + token_in_amount)
 
     return pool
 
@@ -258,7 +352,7 @@ def s_exit_swap_extern_amount_out(params, step, history, current_state, input_pa
     """
     Exit a pool by withdrawing liquidity for a single token_symbol.
     """
-    pool = current_state['pool'].copy()
+    pool = copy_pool(current_state['pool'])
     swap_fee = pool['swap_fee']
     token_out_symbol = input_params.token_out.symbol
     # Check that all tokens_out are bound
@@ -291,7 +385,7 @@ def s_exit_swap_extern_amount_out(params, step, history, current_state, input_pa
                 pool_amount_in, output_params.pool_amount_in))
 
     # Decrease token_symbol (give it to user)
-    pool['tokens'][token_out_symbol].balance -= token_amount_out
+    set_token_balance(pool, token_out_symbol, pool['tokens'][token_out_symbol].balance - token_amount_out)
     # Burn the user's incoming pool shares - exit fee
     exit_fee = pool_amount_in * EXIT_FEE
     pool['pool_shares'] = Decimal(pool['pool_shares']) - pool_amount_in - exit_fee
@@ -301,7 +395,7 @@ def s_exit_swap_extern_amount_out(params, step, history, current_state, input_pa
 
 def s_exit_swap_pool_amount_in(params, step, history, current_state, input_params: ExitSwapPoolAmountInInput,
                                output_params: ExitSwapPoolAmountInOutput) -> dict:
-    pool = current_state['pool'].copy()
+    pool = copy_pool(current_state['pool'])
     swap_fee = pool['swap_fee']
     pool_token_out = pool['tokens'][output_params.token_out.symbol]
     if not pool_token_out.bound:
@@ -321,10 +415,11 @@ def s_exit_swap_pool_amount_in(params, step, history, current_state, input_param
     if token_amount_out > pool_token_out.balance * MAX_OUT_RATIO:
         raise Exception("ERR_MAX_OUT_RATIO")
 
-    generated_fees = pool['generated_fees']
+    generated_fees = pool['generated_fees'].copy()
     generated_fees[output_params.token_out.symbol] = Decimal(generated_fees[output_params.token_out.symbol]) + exit_swap.fee
+    pool['generated_fees'] = generated_fees
 
-    pool['tokens'][output_params.token_out.symbol].balance -= token_amount_out
+    set_token_balance(pool, output_params.token_out.symbol, pool_token_out.balance - token_amount_out)
 
     # Burn the user's incoming pool shares - exit fee
     exit_fee = pool_amount_in * EXIT_FEE
@@ -337,7 +432,7 @@ def s_exit_pool(params, step, history, current_state, input_params: ExitPoolInpu
     """
     Exit a pool by withdrawing liquidity for all token_symbol.
     """
-    pool = current_state['pool'].copy()
+    pool = copy_pool(current_state['pool'])
     pool_shares = Decimal(pool['pool_shares'])
     pool_amount_in = input_params.pool_amount_in
 
@@ -352,7 +447,7 @@ def s_exit_pool(params, step, history, current_state, input_params: ExitPoolInpu
         token_amount_out = ratio * pool['tokens'][token_symbol].balance
         if token_amount_out == Decimal('0'):
             raise Exception("ERR_MATH_APPROX")
-        pool['tokens'][token_symbol].balance -= token_amount_out
+        set_token_balance(pool, token_symbol, pool['tokens'][token_symbol].balance - token_amount_out)
 
     return pool
 
@@ -360,42 +455,42 @@ def s_exit_pool(params, step, history, current_state, input_params: ExitPoolInpu
 # PLOT OUTPUT
 
 def s_join_pool_plot_output(params, step, history, current_state, input_params: JoinParamsInput, output_params: JoinParamsOutput) -> dict:
-    pool = current_state['pool'].copy()
+    pool = copy_pool(current_state['pool'])
     pool_amount_out = input_params.pool_amount_out
     for token in output_params.tokens_in:
-        pool['tokens'][token.symbol].balance += token.amount
+        set_token_balance(pool, token.symbol, pool['tokens'][token.symbol].balance + token.amount)
     pool['pool_shares'] += pool_amount_out
     return pool
 
 
 def s_swap_plot_output(params, step, history, current_state, input_params: SwapExactAmountInInput,
                        output_params: SwapExactAmountInOutput) -> dict:
-    pool = current_state['pool'].copy()
-    pool_token_in = pool['tokens'][input_params.token_in.symbol]
-    pool_token_out = pool['tokens'][output_params.token_out.symbol]
+    pool = copy_pool(current_state['pool'])
+    token_in_symbol = input_params.token_in.symbol
+    token_out_symbol = output_params.token_out.symbol
 
-    pool_token_in.balance = pool_token_in.balance + input_params.token_in.amount
-    pool_token_out.balance = pool_token_out.balance - output_params.token_out.amount
+    set_token_balance(pool, token_in_symbol, pool['tokens'][token_in_symbol].balance + input_params.token_in.amount)
+    set_token_balance(pool, token_out_symbol, pool['tokens'][token_out_symbol].balance - output_params.token_out.amount)
     return pool
 
 
 def s_join_swap_plot_output(params, step, history, current_state, input_params: JoinSwapExternAmountInInput,
                             output_params: JoinSwapExternAmountInOutput) -> dict:
-    pool = current_state['pool'].copy()
+    pool = copy_pool(current_state['pool'])
     tokens_in_symbol = input_params.token_in.symbol
     pool['pool_shares'] = Decimal(pool['pool_shares']) + output_params.pool_amount_out
-    pool['tokens'][tokens_in_symbol].balance += input_params.token_in.amount
+    set_token_balance(pool, tokens_in_symbol, pool['tokens'][tokens_in_symbol].balance + input_params.token_in.amount)
     return pool
 
 
 def s_exit_swap_plot_output(params, step, history, current_state, input_params, output_params):
-    pool = current_state['pool'].copy()
+    pool = copy_pool(current_state['pool'])
     pool_token_out = pool['tokens'][output_params.token_out.symbol]
     if not pool_token_out.bound:
         raise Exception("ERR_NOT_BOUND")
     pool_amount_in = input_params.pool_amount_in
 
-    pool['tokens'][output_params.token_out.symbol].balance -= output_params.token_out.amount
+    set_token_balance(pool, output_params.token_out.symbol, pool_token_out.balance - output_params.token_out.amount)
 
     # Burn the user's incoming pool shares - exit fee
     exit_fee = pool_amount_in * EXIT_FEE
@@ -405,7 +500,7 @@ def s_exit_swap_plot_output(params, step, history, current_state, input_params,
 
 
 def s_exit_pool_plot_output(params, step, history, current_state, input_params, output_params):
-    pool = current_state['pool'].copy()
+    pool = copy_pool(current_state['pool'])
     pool_shares = Decimal(pool['pool_shares'])
     pool_amount_in = input_params.pool_amount_in
 
@@ -417,7 +512,7 @@ def s_exit_pool_plot_output(params, step, history, current_state, input_params,
     pool['pool_shares'] = pool_shares - pool_amount_in_afer_exit_fee
 
     for token in output_params.tokens_out:
-        pool['tokens'][token.symbol].balance -= token.amount
+        set_token_balance(pool, token.symbol, pool['tokens'][token.symbol].balance - token.amount)
 
     return pool
 
@@ -1,3 +1,7 @@
+import hashlib
+import io
+import json
+import threading
 import typing
 from decimal import Decimal, getcontext
 # import ipdb
@@ -24,19 +28,55 @@ class ActionDecodingType(Enum):
 
 
 class ActionDecoder:
-    action_df = None
-    decoding_type = ActionDecodingType.simplified
-
-    @classmethod
-    def load_actions(cls, path_to_action_file: str) -> int:
-        ActionDecoder.action_df = pd.read_json(path_to_action_file).drop(0)
-        return len(ActionDecoder.action_df)
+    """
+    The action tape of one pool and its decoded policy outputs. generate_partial_state_update_blocks() binds the p_action_decoder of
+    its own ActionDecoder into the partial state update blocks, so simulations of several tapes can run side by side in one process
+    (see sim_runner.run_concurrently). find_action_decoder() gets it back from the blocks.
+    """
+    # Class level, cadCAD deep copies the blocks and with them the decoder
+    _digest_lock = threading.Lock()
+
+    def __init__(self, path_to_action_file: str):
+        with open(path_to_action_file) as f:
+            text = f.read()
+        self.action_df = pd.read_json(io.StringIO(text)).drop(0)
+        # The JSON entries of the actions as they are in the file, prefix_digest() hashes these
+        self.actions = json.loads(text)[1:]
+        self.decoding_type = ActionDecodingType.simplified
+        # Policy outputs decoded once per decoding type, tapes[decoding_type][timestep] is the output for that timestep
+        self.tapes = {}
+        # digests[n] is the hash of the first n actions, extended as far as prefix_digest() was asked
+        self.digests = [hashlib.sha256().hexdigest()]
+
+    def __len__(self):
+        return len(self.action_df)
+
+    def prefix_digest(self, n: int) -> typing.Optional[str]:
+        """
+        sha256 chained over the JSON entries of the first n actions of the tape (the actions played by timesteps 0..n-1), or None if
+        the tape is shorter. The entries are hashed as they are in the file, not after pandas parsed the whole tape, so a tape that
+        only had actions appended gives the same digest for every prefix of the old one.
+        """
+        if n > len(self.actions):
+            return None
+        with self._digest_lock:
+            while len(self.digests) <= n:
+                entry = json.dumps(self.actions[len(self.digests) - 1], sort_keys=True)
+                self.digests.append(hashlib.sha256((self.digests[-1] + entry).encode()).hexdigest())
+        return self.digests[n]
+
+    def compile_tape(self, decoding_type: ActionDecodingType) -> typing.List[dict]:
+        actions = self.action_df['action'].tolist()
+        timestamps = self.action_df['timestamp'].tolist()
+        if decoding_type == ActionDecodingType.contract_call:
+            contract_calls = self.action_df['contract_call'].tolist()
+            return [ActionDecoder.decode_contract_call_action(action, timestamp, contract_call)
+                    for action, timestamp, contract_call in zip(actions, timestamps, contract_calls)]
+        # REPLAY_OUTPUT decodes the same parameters as SIMPLIFIED, the difference is in the pool state update functions
+        return [ActionDecoder.decode_simplified_action(action, timestamp) for action, timestamp in zip(actions, timestamps)]
 
     @staticmethod
-    def p_simplified_action_decoder(idx, params, step, history, current_state):
-        action = ActionDecoder.action_df['action'][idx]
-        timestamp = ActionDecoder.action_df['timestamp'][idx]
-        tx_hash = ActionDecoder.action_df['tx_hash'][idx]
+    def decode_simplified_action(action: dict, timestamp) -> dict:
         if action['type'] == 'swap':
             pool_method_params = PoolMethodParamsDecoder.swap_exact_amount_in_simplified(action)
         elif action['type'] == 'join':
@@ -55,16 +95,11 @@ class ActionDecoder:
         return {'pool_update': pool_method_params, 'change_datetime_update': timestamp, 'action_type': action['type']}
 
     @staticmethod
-    def p_contract_call_action_decoder(idx, params, step, history, current_state):
-        action = ActionDecoder.action_df['action'][idx]
-        timestamp = ActionDecoder.action_df['timestamp'][idx]
-        tx_hash = ActionDecoder.action_df['tx_hash'][idx]
-        contract_call = None
-        if action['type'] != 'external_price_update':
-            contract_call = ActionDecoder.action_df['contract_call'][idx][0]
-        else:
+    def decode_contract_call_action(action: dict, timestamp, contract_calls: typing.List[dict]) -> dict:
+        if action['type'] == 'external_price_update':
             return {'external_price_update': action['tokens'], 'change_datetime_update': timestamp, 'action_type': action['type'],
                     'pool_update': None}
+        contract_call = contract_calls[0]
         if contract_call['type'] == 'joinswapExternAmountIn':
             pool_method_params = PoolMethodParamsDecoder.join_swap_extern_amount_in_contract_call(action, contract_call)
         elif contract_call['type'] == 'joinPool':
@@ -83,42 +118,25 @@ class ActionDecoder:
             raise Exception("Action type {} unimplemented".format(action['type']))
         return {'pool_update': pool_method_params, 'change_datetime_update': timestamp, 'action_type': action['type']}
 
-    @staticmethod
-    def p_plot_output_action_decoder(idx, params, step, history, current_state):
-        action = ActionDecoder.action_df['action'][idx]
-        timestamp = ActionDecoder.action_df['timestamp'][idx]
-        if action['type'] == 'swap':
-            pool_method_params = PoolMethodParamsDecoder.swap_exact_amount_in_simplified(action)
-        elif action['type'] == 'join':
-            pool_method_params = PoolMethodParamsDecoder.join_pool_simplified(action)
-        elif action['type'] == 'join_swap':
-            pool_method_params = PoolMethodParamsDecoder.join_swap_extern_amount_in_simplified(action)
-        elif action['type'] == 'exit_swap':
-            pool_method_params = PoolMethodParamsDecoder.exit_swap_pool_amount_in_simplified(action)
-        elif action['type'] == 'exit':
-            pool_method_params = PoolMethodParamsDecoder.exit_pool_simplified(action)
-        elif action['type'] == 'external_price_update':
-            return {'external_price_update': action['tokens'], 'change_datetime_update': timestamp, 'action_type': action['type'], 'pool_update': None}
-        else:
-            raise Exception("Action type {} unimplemented".format(action['type']))
-        return {'pool_update': pool_method_params, 'change_datetime_update': timestamp, 'action_type': action['type']}
-
-    @staticmethod
-    def p_action_decoder(params, step, history, current_state):
-        if ActionDecoder.action_df is None:
-            raise Exception('call ActionDecoder.load_actions(path_to_action.json) first')
+    def p_action_decoder(self, params, step, history, current_state):
         '''
         In this simplified model of Balancer, we have not modeled user behavior. Instead, we map events to actions.
         '''
-        decoding_type = get_param(params, 'decoding_type')
-
-        ActionDecoder.decoding_type = ActionDecodingType(decoding_type)
-        idx = current_state['timestep'] + 1
-        if ActionDecoder.decoding_type == ActionDecodingType.simplified:
-            return ActionDecoder.p_simplified_action_decoder(idx, params, step, history, current_state)
-        elif ActionDecoder.decoding_type == ActionDecodingType.contract_call:
-            return ActionDecoder.p_contract_call_action_decoder(idx, params, step, history, current_state)
-        elif ActionDecoder.decoding_type == ActionDecodingType.replay_output:
-            return ActionDecoder.p_plot_output_action_decoder(idx, params, step, history, current_state)
-        else:
-            raise Exception(f'unknown decoding type {decoding_type}')
+        # Local, simulations with other decoding types can run on the same decoder in other threads
+        decoding_type = ActionDecodingType(get_param(params, 'decoding_type'))
+        # Last decoding type played, only kept for inspection
+        self.decoding_type = decoding_type
+        tape = self.tapes.get(decoding_type)
+        if tape is None:
+            tape = self.tapes[decoding_type] = self.compile_tape(decoding_type)
+        # action_df is indexed from 1 after dropping the pool creation, so timestep t plays action t + 1
+        return dict(tape[current_state['timestep']])
+
+
+def find_action_decoder(partial_state_update_blocks: typing.List[dict]) -> ActionDecoder:
+    for block in partial_state_update_blocks:
+        for policy in block['policies'].values():
+            decoder = getattr(policy, '__self__', None)
+            if isinstance(decoder, ActionDecoder):
+                return decoder
+    raise Exception('the partial state update blocks have no ActionDecoder.p_action_decoder policy')
@@ -1,6 +1,8 @@
-import pandas as pd
 import typing
 
+import numpy as np
+import pandas as pd
+
 def get_param(params: typing.Dict, key: str):
     # When only 1 param this happens
     if isinstance(params, list):
@@ -10,66 +12,79 @@ def get_param(params: typing.Dict, key: str):
         # Parameter sweep
         return params[key]
 
+def to_float64(values: typing.Iterable, count: int = -1) -> np.ndarray:
+    # Decimal/str/int/float -> float64 in a single pass
+    return np.fromiter(map(float, values), dtype=np.float64, count=count)
+
+
 def unpack_column_tokens(column_tokens: pd.Series, token_symbols: typing.List[str]) -> pd.DataFrame:
+    column_tokens = list(column_tokens)
+    n = len(column_tokens)
     di = {}
     for symbol in token_symbols:
-        di[f'token_{symbol}_balance'] = []
-        di[f'token_{symbol}_denorm_weight'] = []
-        di[f'token_{symbol}_weight'] = []
-        for r in column_tokens:
-            di[f'token_{symbol}_weight'].append(r[symbol.upper()].weight)
-            di[f'token_{symbol}_denorm_weight'].append(r[symbol.upper()].denorm_weight)
-            di[f'token_{symbol}_balance'].append(r[symbol.upper()].balance)
-    return pd.DataFrame.from_dict(di).astype('float64')
+        tokens = [r[symbol.upper()] for r in column_tokens]
+        di[f'token_{symbol}_balance'] = to_float64((t.balance for t in tokens), n)
+        di[f'token_{symbol}_denorm_weight'] = to_float64((t.denorm_weight for t in tokens), n)
+        di[f'token_{symbol}_weight'] = to_float64((t.weight for t in tokens), n)
+    return pd.DataFrame(di, copy=False)
 
 
 def unpack_column_generated_fees(column_fees: pd.Series, token_symbols: typing.List[str]) -> pd.DataFrame:
+    column_fees = list(column_fees)
+    n = len(column_fees)
     di = {}
     for symbol in token_symbols:
-        di[f'generated_fees_{symbol}'] = []
-        for r in column_fees:
-            di[f'generated_fees_{symbol}'].append(r[symbol.upper()])
-    return pd.DataFrame.from_dict(di)
+        di[f'generated_fees_{symbol}'] = to_float64((r[symbol.upper()] for r in column_fees), n)
+    return pd.DataFrame(di, copy=False)
 
 
 def unpack_column_pool(df: pd.DataFrame) -> pd.DataFrame:
-    column_pool = pd.DataFrame.from_records(df["pool"].to_list())
+    pools = df["pool"].tolist()
     token_symbols = assets_in_df(df)
-    column_tokens = column_pool["tokens"]
-    column_tokens_unpacked = unpack_column_tokens(column_tokens, token_symbols)
-    column_fees = column_pool['generated_fees']
-    column_generated_fees_unpacked = unpack_column_generated_fees(column_fees, token_symbols)
-    return column_pool.assign(**column_tokens_unpacked).assign(**column_generated_fees_unpacked).drop("tokens", axis=1)
+    # Every key of the pool dicts except tokens and the cached total weight becomes a column, tokens and generated_fees are also
+    # unpacked per token
+    di = {key: [p[key] for p in pools] for key in pools[0] if key not in ('tokens', 'total_denorm_weight')}
+    column_tokens_unpacked = unpack_column_tokens([p['tokens'] for p in pools], token_symbols)
+    column_generated_fees_unpacked = unpack_column_generated_fees(di['generated_fees'], token_symbols)
+    di.update(column_tokens_unpacked.items())
+    di.update(column_generated_fees_unpacked.items())
+    return pd.DataFrame(di)
 
 
 def unpack_column_token_prices(df: pd.DataFrame) -> pd.DataFrame:
-    column_token_prices = df["token_prices"]
+    column_token_prices = df["token_prices"].tolist()
     token_symbols = assets_in_df(df)
     di = {}
     for symbol in token_symbols:
-        di[f'token_{symbol}_price'] = []
-        for r in column_token_prices:
-            di[f'token_{symbol}_price'].append(r[symbol.upper()])
-    return pd.DataFrame.from_dict(di)
+        di[f'token_{symbol}_price'] = [r[symbol.upper()] for r in column_token_prices]
+    return pd.DataFrame(di)
 
 
 # At this point I should generalize the "unpacking" pattern, but then it'd be even harder to follow once I've forgotten everything
 def unpack_column_spot_prices(df: pd.DataFrame) -> pd.DataFrame:
-    column_spot_prices = df.spot_prices
+    column_spot_prices = df.spot_prices.tolist()
     # Can't assets_in_df() here because this column might not include spot_prices for all assets in df (why?)
     token_symbols = list(column_spot_prices[0].keys())
     token_symbols.sort()
+    n = len(column_spot_prices)
     di = {}
     for symbol in token_symbols:
-        symbol_low = symbol.lower()
-        di[f'token_{symbol_low}_spot_price'] = []
-        for r in column_spot_prices:
-            di[f'token_{symbol_low}_spot_price'].append(r[symbol])
-    return pd.DataFrame.from_dict(di).astype('float64')
+        di[f'token_{symbol.lower()}_spot_price'] = to_float64((r[symbol] for r in column_spot_prices), n)
+    return pd.DataFrame(di, copy=False)
+
+
+def unpack_column_spot_price_matrix(df: pd.DataFrame) -> pd.DataFrame:
+    column_matrix = df.spot_price_matrix.tolist()
+    n = len(column_matrix)
+    di = {}
+    for token_in in sorted(column_matrix[0].keys()):
+        for token_out in sorted(column_matrix[0][token_in].keys()):
+            di[f'token_{token_out.lower()}_spot_price_in_{token_in.lower()}'] = to_float64((r[token_in][token_out] for r in column_matrix), n)
+    return pd.DataFrame(di, copy=False)
 
 
 def assets_in_df(df: pd.DataFrame) -> typing.List[str]:
-    assets = list(df.pool[0]["tokens"].keys())
+    assets = list(df.pool.iloc[0]["tokens"].keys())
     assets.sort()
     assets = [a.lower() for a in assets]
     return assets
@@ -83,40 +98,37 @@ def calc_token_x_value(df: pd.DataFrame) -> pd.DataFrame:
     return pd.DataFrame.from_dict(di)
 
 
-def post_processing(df: pd.DataFrame, include_spot_prices=False) -> pd.DataFrame:
-    unpacked_column_pool = unpack_column_pool(df)
-    unpacked_column_token_prices = unpack_column_token_prices(df)
-
-    df = df.assign(**unpacked_column_pool).assign(**unpacked_column_token_prices)
+def post_processing(df: pd.DataFrame, include_spot_prices=False, include_spot_price_matrix=False) -> pd.DataFrame:
+    symbols = assets_in_df(df)
+    # Columns are collected in one dict and the frame is built once at the end, assigning to an existing key keeps its position
+    columns = {key: df[key] for key in df.columns}
+    unpacked = [unpack_column_pool(df), unpack_column_token_prices(df)]
     if include_spot_prices:
-        unpacked_column_spot_prices = unpack_column_spot_prices(df)
-        df = df.assign(**unpacked_column_spot_prices)
+        unpacked.append(unpack_column_spot_prices(df))
+    if include_spot_price_matrix:
+        unpacked.append(unpack_column_spot_price_matrix(df))
+    for unpacked_columns in unpacked:
+        columns.update((key, column.to_numpy()) for key, column in unpacked_columns.items())
 
     # Convert change_datetime from str to datetime, other columns to float64
-    df["change_datetime"] = pd.to_datetime(df["change_datetime"], utc=True)
-    df = df.astype({"pool_shares": "float64", "swap_fee": "float64"})
+    columns["change_datetime"] = pd.to_datetime(columns["change_datetime"], utc=True)
+    columns["pool_shares"] = to_float64(columns["pool_shares"], len(df))
+    columns["swap_fee"] = to_float64(columns["swap_fee"], len(df))
 
     # Calculate token_{x}_value columns
-    token_x_value = calc_token_x_value(df)
-    df = df.assign(**token_x_value)
+    for s in symbols:
+        columns[f'token_{s}_value'] = columns[f'token_{s}_balance'] * columns[f'token_{s}_price']
 
     # Calculate TVL column
-    symbols = assets_in_df(df)
-    token_value_columns = [f'token_{s}_value' for s in symbols]
-    column_tvl = df[token_value_columns].sum(axis=1)
-    df = df.assign(tvl=column_tvl)
+    columns['tvl'] = pd.DataFrame({s: columns[f'token_{s}_value'] for s in symbols}).sum(axis=1).to_numpy()
 
     # Calculate Invariant column
-    df['invariant'] = 1
+    invariant = 1
     for s in symbols:
-        df['invariant'] *= (df[f'token_{s}_balance'] ** df[f'token_{s}_weight'])
+        invariant = invariant * (columns[f'token_{s}_balance'] ** columns[f'token_{s}_weight'])
+    columns['invariant'] = invariant
 
     # Calculate total_token_balances
-    token_balance_columns = [f'token_{s}_balance' for s in symbols]
-    column_total_token_balances = df[token_balance_columns].sum(axis=1)
-    df = df.assign(total_token_balances=column_total_token_balances)
-
-    # Convert generated_fees_(token) columns from str or Decimal to float64
-    generated_fees_columns = [f'generated_fees_{s}' for s in symbols]
-    for generated_fee_col in generated_fees_columns: df[generated_fee_col] = df[generated_fee_col].astype('float64')
-    return df
+    columns['total_token_balances'] = pd.DataFrame({s: columns[f'token_{s}_balance'] for s in symbols}).sum(axis=1).to_numpy()
+
+    return pd.DataFrame(columns, index=df.index)
@@ -0,0 +1,376 @@
+"""
+Registry of many Balancer pools (BalancerPool or CompactBalancerPool) with an index from token pair to pools, and a smart-order
+router over it. route() looks for direct pools and 2-3 hop paths through the token graph, then splits the trade across them by
+marginal price: the amount is sent in slices, and every slice goes to the path that gives the most out for it at the balances left
+by the previous slices. The pool of each hop of a multi-hop path is picked again for every slice, as the one with the best spot
+price at those balances, so pools of the same hop share the trade too. The used paths and pools end up with equal marginal prices,
+up to the size of one slice.
+
+The candidate paths of a pair only depend on which pools hold which tokens, so they are kept per pair until a pool is added,
+removed or reindexed. Ranking the paths and assigning the slices is done in float64 with BalancerMathVectorized, the amounts of
+the route are then computed with the Decimal math of the pools. Quotes never change the pools.
+"""
+import typing
+from dataclasses import dataclass
+from decimal import Decimal
+
+import numpy as np
+
+from model.parts.balancer_constants import MAX_IN_RATIO
+from model.parts.balancer_math_vectorized import BalancerMathVectorized
+
+# (pool_id, token_in, token_out)
+Hop = typing.Tuple[typing.Hashable, str, str]
+
+_MAX_IN_RATIO = float(MAX_IN_RATIO)
+MAX_HOPS = 3
+
+
+@dataclass
+class RouteLeg:
+    hops: typing.List[Hop]
+    amount_in: Decimal
+    amount_out: Decimal
+
+
+@dataclass
+class Route:
+    token_in: str
+    token_out: str
+    amount_in: Decimal
+    amount_out: Decimal
+    legs: typing.List[RouteLeg]
+
+
+@dataclass
+class CandidatePaths:
+    """
+    The candidate paths of a pair as index arrays. A path is a row of paths with one group per hop, padded with the index one past
+    the last group. A group is a (token_a, token_b) hop of multi-hop paths with every pool of the pair as candidates, or a single
+    direct pool. The candidate hops of a group are contiguous, the last candidate is padding. Candidate hops index keys
+    ((pool, token), the last key is padding) and pool_ids (the last pool is padding).
+
+    The float64 balances, denorm weights and swap fees are those the last query saw, with the Decimals they were converted from:
+    a Decimal is only converted again when the pool holds another object.
+    """
+    keys: typing.List[tuple]
+    # (pool.get_balance, pool.get_denorm_weight, token) of every key
+    getters: typing.List[tuple]
+    pool_ids: typing.List[typing.Hashable]
+    pools: typing.List[typing.Any]
+    group_tokens: typing.List[typing.Tuple[str, str]]
+    group_start: np.ndarray
+    hop_group: np.ndarray
+    hop_in: np.ndarray
+    hop_out: np.ndarray
+    hop_pool: np.ndarray
+    paths: np.ndarray
+    seen_balances: typing.List[typing.Optional[Decimal]]
+    seen_weights: typing.List[typing.Optional[Decimal]]
+    seen_fees: typing.List[typing.Optional[Decimal]]
+    balances: np.ndarray
+    weights: np.ndarray
+    fees: np.ndarray
+
+
+class PoolRegistry:
+    def __init__(self):
+        self.pools = {}
+        # (token_a, token_b) -> ids of the pools holding both, in both orders
+        self._pair_pools = {}
+        # token -> {token: number of pools holding both}
+        self._neighbours = {}
+        # pool_id -> tokens the pool was indexed with
+        self._indexed_tokens = {}
+        # (token_in, token_out, max_hops) -> CandidatePaths
+        self._paths = {}
+
+    def __len__(self):
+        return len(self.pools)
+
+    def add(self, pool_id: typing.Hashable, pool):
+        if pool_id in self.pools:
+            raise Exception('ERR_POOL_EXISTS')
+        self.pools[pool_id] = pool
+        self._index(pool_id)
+
+    def remove(self, pool_id: typing.Hashable):
+        self._unindex(pool_id)
+        return self.pools.pop(pool_id)
+
+    def reindex(self, pool_id: typing.Hashable):
+        # Call after binding or unbinding tokens of a registered pool
+        self._unindex(pool_id)
+        self._index(pool_id)
+
+    def _index(self, pool_id: typing.Hashable):
+        tokens = tuple(self.pools[pool_id].tokens())
+        self._indexed_tokens[pool_id] = tokens
+        for token_a in tokens:
+            neighbours = self._neighbours.setdefault(token_a, {})
+            for token_b in tokens:
+                if token_a != token_b:
+                    self._pair_pools.setdefault((token_a, token_b), []).append(pool_id)
+                    neighbours[token_b] = neighbours.get(token_b, 0) + 1
+        self._paths.clear()
+
+    def _unindex(self, pool_id: typing.Hashable):
+        tokens = self._indexed_tokens.pop(pool_id, None)
+        if tokens is None:
+            raise Exception('ERR_UNKNOWN_POOL')
+        for token_a in tokens:
+            neighbours = self._neighbours[token_a]
+            for token_b in tokens:
+                if token_a != token_b:
+                    pool_ids = self._pair_pools[(token_a, token_b)]
+                    pool_ids.remove(pool_id)
+                    if not pool_ids:
+                        del self._pair_pools[(token_a, token_b)]
+                    neighbours[token_b] -= 1
+                    if neighbours[token_b] == 0:
+                        del neighbours[token_b]
+            if not neighbours:
+                del self._neighbours[token_a]
+        self._paths.clear()
+
+    def pools_for_pair(self, token_a: str, token_b: str) -> typing.List[typing.Hashable]:
+        return list(self._pair_pools.get((token_a, token_b), ()))
+
+    def _candidate_paths(self, token_in: str, token_out: str, max_hops: int) -> CandidatePaths:
+        paths = self._paths.get((token_in, token_out, max_hops))
+        if paths is None:
+            paths = self._paths[(token_in, token_out, max_hops)] = self._build_candidate_paths(token_in, token_out, max_hops)
+        return paths
+
+    def _build_candidate_paths(self, token_in: str, token_out: str, max_hops: int) -> CandidatePaths:
+        # (token_a, token_b, direct pool_id or None) -> group
+        groups = {}
+        group_pools = []
+        group_tokens = []
+
+        def group(token_a: str, token_b: str, pool_id=None) -> int:
+            n = groups.get((token_a, token_b, pool_id))
+            if n is None:
+                n = groups[(token_a, token_b, pool_id)] = len(group_pools)
+                group_pools.append(self._pair_pools[(token_a, token_b)] if pool_id is None else [pool_id])
+                group_tokens.append((token_a, token_b))
+            return n
+
+        paths = [[group(token_in, token_out, pool_id)] for pool_id in self._pair_pools.get((token_in, token_out), ())]
+        neighbours = self._neighbours.get(token_in, {})
+        if max_hops >= 2:
+            for middle in neighbours:
+                if middle != token_out and token_out in self._neighbours[middle]:
+                    paths.append([group(token_in, middle), group(middle, token_out)])
+        if max_hops >= 3:
+            for first in neighbours:
+                if first == token_out:
+                    continue
+                for second in self._neighbours[first]:
+                    if second != token_in and second != token_out and token_out in self._neighbours[second]:
+                        paths.append([group(token_in, first), group(first, second), group(second, token_out)])
+
+        keys = {}
+        pool_ids = {}
+        group_start, hop_group, hop_in, hop_out, hop_pool = [], [], [], [], []
+        for n, ((token_a, token_b), candidates) in enumerate(zip(group_tokens, group_pools)):
+            group_start.append(len(hop_group))
+            for pool_id in candidates:
+                hop_group.append(n)
+                pool = self.pools[pool_id]
+                hop_in.append(keys.setdefault((pool, token_a), len(keys)))
+                hop_out.append(keys.setdefault((pool, token_b), len(keys)))
+                hop_pool.append(pool_ids.setdefault(pool_id, len(pool_ids)))
+        hop_group.append(len(group_tokens))
+        hop_in.append(len(keys))
+        hop_out.append(len(keys))
+        hop_pool.append(len(pool_ids))
+        padded = np.full((len(paths), MAX_HOPS), len(group_tokens), dtype=np.intp)
+        for n, path in enumerate(paths):
+            padded[n, :len(path)] = path
+        # Padding converts to 1.0 balances and weights and a 0.0 fee, and is never converted again
+        getters = [(pool.get_balance, pool.get_denorm_weight, token) for pool, token in keys]
+        return CandidatePaths(list(keys), getters, list(pool_ids), [self.pools[pool_id] for pool_id in pool_ids], group_tokens,
+                              np.array(group_start, dtype=np.intp), np.array(hop_group, dtype=np.intp),
+                              np.array(hop_in, dtype=np.intp), np.array(hop_out, dtype=np.intp), np.array(hop_pool, dtype=np.intp),
+                              padded, [None] * len(keys), [None] * len(keys), [None] * len(pool_ids), np.ones(len(keys) + 1),
+                              np.ones(len(keys) + 1), np.zeros(len(pool_ids) + 1))
+
+    @staticmethod
+    def _float_state(paths: CandidatePaths) -> typing.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # Balances and denorm weights of the keys and swap fees of the pools of paths, padding included
+        seen_balances, seen_weights, balances, weights = paths.seen_balances, paths.seen_weights, paths.balances, paths.weights
+        for n, (get_balance, get_denorm_weight, token) in enumerate(paths.getters):
+            balance = get_balance(token)
+            if balance is not seen_balances[n]:
+                seen_balances[n] = balance
+                balances[n] = float(balance)
+            weight = get_denorm_weight(token)
+            if weight is not seen_weights[n]:
+                seen_weights[n] = weight
+                weights[n] = float(weight)
+        seen_fees, fees = paths.seen_fees, paths.fees
+        for n, pool in enumerate(paths.pools):
+            swap_fee = pool.get_swap_fee()
+            if swap_fee is not seen_fees[n]:
+                seen_fees[n] = swap_fee
+                fees[n] = float(swap_fee)
+        # route() moves the balances along with the slices
+        return balances.copy(), weights, fees
+
+    @staticmethod
+    def _spot_prices(paths: CandidatePaths, balances: np.ndarray, weights: np.ndarray, fees: np.ndarray,
+                     hops=slice(None)) -> np.ndarray:
+        hop_in, hop_out = paths.hop_in[hops], paths.hop_out[hops]
+        return BalancerMathVectorized.calc_spot_price(balances[hop_in], weights[hop_in], balances[hop_out], weights[hop_out],
+                                                      fees[paths.hop_pool[hops]])
+
+    @staticmethod
+    def _best_hops(paths: CandidatePaths, balances: np.ndarray, weights: np.ndarray,
+                   fees: np.ndarray) -> typing.Tuple[np.ndarray, np.ndarray]:
+        # The candidate hop with the lowest spot price of every group, padding group included, and the spot price of every hop
+        spot_prices = PoolRegistry._spot_prices(paths, balances, weights, fees)
+        spot_prices[-1] = 1.0
+        order = np.lexsort((spot_prices, paths.hop_group))
+        best = np.append(order[paths.group_start], len(paths.hop_group) - 1)
+        return best, spot_prices
+
+    def _hops(self, paths: CandidatePaths, path: np.ndarray, best: np.ndarray) -> typing.List[Hop]:
+        return [(paths.pool_ids[paths.hop_pool[best[n]]],) + paths.group_tokens[n] for n in path if n < len(paths.group_tokens)]
+
+    def candidate_paths(self, token_in: str, token_out: str, max_hops: int = 3) -> typing.List[typing.List[Hop]]:
+        """
+        Every direct pool of the pair, and the 2 and 3 hop paths through tokens that share pools, using the pool with the best spot
+        price for each hop.
+        """
+        paths = self._candidate_paths(token_in, token_out, max_hops)
+        if not len(paths.paths):
+            return []
+        best, _ = self._best_hops(paths, *self._float_state(paths))
+        return [self._hops(paths, path, best) for path in paths.paths]
+
+    @staticmethod
+    def _paths_out(amount_in: float, keys: np.ndarray, aliases: np.ndarray, valid: np.ndarray, balances: np.ndarray,
+                   weights: np.ndarray, fees: np.ndarray) -> typing.Tuple[np.ndarray, np.ndarray]:
+        """
+        Amount out of every path for amount_in (-inf when a hop is over MAX_IN_RATIO) and the amount out of each hop. keys holds
+        the (in, out) keys of every hop, aliases[path, column] the columns of keys with the same key: a path can go through the
+        same pool twice.
+        """
+        local = balances[keys]
+        local_weights = weights[keys]
+        amount = np.full(len(keys), amount_in)
+        failed = np.zeros(len(keys), dtype=bool)
+        hop_out = np.zeros(valid.shape)
+        for hop in range(int(valid.sum(axis=1).max())):
+            balance_in = local[:, 2 * hop]
+            amount_out = BalancerMathVectorized.calc_out_given_in(amount, balance_in, local_weights[:, 2 * hop], local[:, 2 * hop + 1],
+                                                                  local_weights[:, 2 * hop + 1], fees[:, hop]).result
+            amount_out = np.where(valid[:, hop], amount_out, 0.0)
+            failed |= valid[:, hop] & (amount > balance_in * _MAX_IN_RATIO)
+            local = local + aliases[:, 2 * hop] * np.where(valid[:, hop], amount, 0.0)[:, None] - \
+                aliases[:, 2 * hop + 1] * amount_out[:, None]
+            hop_out[:, hop] = amount_out
+            amount = np.where(valid[:, hop], amount_out, amount)
+        return np.where(failed, -np.inf, amount), hop_out
+
+    def _balance(self, balances: dict, pool_id: typing.Hashable, token: str) -> Decimal:
+        balance = balances.get((pool_id, token))
+        if balance is None:
+            balance = self.pools[pool_id].get_balance(token)
+        return balance
+
+    def _path_out(self, path: typing.List[Hop], amount_in: Decimal, balances: dict, apply: bool = False) -> typing.Optional[Decimal]:
+        amount = amount_in
+        # Balances after the hops so far, a path can go through the same pool twice
+        updates = {}
+        for pool_id, token_in, token_out in path:
+            pool = self.pools[pool_id]
+            balance_in = updates.get((pool_id, token_in))
+            if balance_in is None:
+                balance_in = self._balance(balances, pool_id, token_in)
+            balance_out = updates.get((pool_id, token_out))
+            if balance_out is None:
+                balance_out = self._balance(balances, pool_id, token_out)
+            if amount > balance_in * MAX_IN_RATIO:
+                return None
+            amount_out = pool.calc_out_given_in(amount, balance_in, pool.get_denorm_weight(token_in), balance_out,
+                                                pool.get_denorm_weight(token_out), pool.get_swap_fee()).result
+            updates[(pool_id, token_in)] = balance_in + amount
+            updates[(pool_id, token_out)] = balance_out - amount_out
+            amount = amount_out
+        if apply:
+            balances.update(updates)
+        return amount
+
+    def route(self, token_in: str, token_out: str, amount_in: Decimal, max_hops: int = 3, max_paths: int = 8,
+              parts: int = 10) -> Route:
+        """
+        Splits amount_in in parts slices over the max_paths candidate paths that give the most out for one slice. The last slice
+        takes the remainder of the division, so the legs add up to amount_in.
+        """
+        paths = self._candidate_paths(token_in, token_out, max_hops)
+        if not len(paths.paths):
+            raise Exception('ERR_NO_ROUTE')
+        balances, weights, fees = self._float_state(paths)
+        best, spot_prices = self._best_hops(paths, balances, weights, fees)
+        selected = paths.paths
+        if len(selected) > 4 * max_paths:
+            # Spot prices are cheap next to a quote, they pick the paths worth quoting
+            path_spot_prices = spot_prices[best][selected].prod(axis=1)
+            selected = selected[np.argsort(path_spot_prices, kind='stable')[:4 * max_paths]]
+
+        part = amount_in / parts
+        slices = [part] * (parts - 1) + [amount_in - part * (parts - 1)]
+
+        def hop_arrays(selected: np.ndarray, best: np.ndarray) -> tuple:
+            candidates = best[selected]
+            keys = np.stack([paths.hop_in[candidates], paths.hop_out[candidates]], axis=2).reshape(len(selected), 2 * MAX_HOPS)
+            return keys, keys[:, :, None] == keys[:, None, :], selected < len(paths.group_tokens), fees[paths.hop_pool[candidates]]
+
+        keys, aliases, valid, hop_fees = hop_arrays(selected, best)
+        quoted, _ = self._paths_out(float(part), keys, aliases, valid, balances, weights, hop_fees)
+        order = np.argsort(-quoted, kind='stable')[:max_paths]
+        order = order[np.isfinite(quoted[order])]
+        if not len(order):
+            raise Exception('ERR_NO_ROUTE')
+        selected = selected[order]
+
+        # Each slice to the path with the most out for it, with the best pool of every hop, on the float balances left by the
+        # previous slices
+        best = best.copy()
+        group_end = np.append(paths.group_start[1:], len(paths.hop_group) - 1)
+        assigned = []
+        for amount in slices:
+            if assigned:
+                # Only the hops on the balances the previous slice moved can get another best pool
+                moved = keys[n][np.repeat(valid[n], 2)]
+                touched = np.flatnonzero(np.isin(paths.hop_in, moved) | np.isin(paths.hop_out, moved))
+                spot_prices[touched] = self._spot_prices(paths, balances, weights, fees, touched)
+                for group in np.unique(paths.hop_group[touched]):
+                    best[group] = paths.group_start[group] + int(np.argmin(spot_prices[paths.group_start[group]:group_end[group]]))
+            keys, aliases, valid, hop_fees = hop_arrays(selected, best)
+            amount_out, hop_out = self._paths_out(float(amount), keys, aliases, valid, balances, weights, hop_fees)
+            n = int(np.argmax(amount_out))
+            if amount_out[n] == -np.inf:
+                raise Exception('ERR_NO_ROUTE')
+            hop_in = float(amount)
+            for hop in range(MAX_HOPS):
+                if valid[n, hop]:
+                    balances[keys[n, 2 * hop]] += hop_in
+                    balances[keys[n, 2 * hop + 1]] -= hop_out[n, hop]
+                    hop_in = hop_out[n, hop]
+            assigned.append((n, self._hops(paths, selected[n], best)))
+
+        decimal_balances = {}
+        # tuple(hops) -> [path, hops, amount in, amount out]
+        legs = {}
+        for amount, (n, hops) in zip(slices, assigned):
+            amount_out = self._path_out(hops, amount, decimal_balances, apply=True)
+            if amount_out is None:
+                raise Exception('ERR_MAX_IN_RATIO')
+            leg = legs.setdefault(tuple(hops), [n, hops, Decimal('0'), Decimal('0')])
+            leg[2] += amount
+            leg[3] += amount_out
+        legs = [RouteLeg(hops, leg_in, leg_out) for _, hops, leg_in, leg_out in sorted(legs.values(), key=lambda leg: leg[0])]
+        return Route(token_in, token_out, amount_in, sum(leg.amount_out for leg in legs), legs)
@@ -0,0 +1,157 @@
+"""
+Native replay loop. Historical replays are a deterministic fold of the partial state update blocks over the action tape, so
+this applies the same policies and state update functions as cadCAD's Executor without its per-substep deepcopy of the whole
+state and history bookkeeping. State update functions never modify the state they are given (pool updates share the unchanged
+Token objects, see pool_state_updates.copy_pool), so a shallow copy per substep is enough. The raw DataFrame it returns has the
+same rows and columns as sim_runner.run with cadCAD, so post_processing() works on either.
+"""
+import typing
+
+import pandas as pd
+
+from model.checkpoints import Checkpointer, initial_state_digest
+from model.output_sink import OutputSink
+from model.parts.system_policies import find_action_decoder
+from model.state_recorder import StateRecorder
+
+
+def aggregate_policies(policies: typing.Dict[str, typing.Callable], params, substep: int, state: dict) -> dict:
+    if len(policies) == 1:
+        # Nothing to add up, policy inputs are only read
+        policy, = policies.values()
+        return policy(params, substep, [], state)
+    policy_input = {}
+    for policy in policies.values():
+        for key, value in policy(params, substep, [], state).items():
+            # Same as cadCAD's default policy_ops: values of the same key are added up
+            policy_input[key] = policy_input[key] + value if key in policy_input else value
+    return policy_input
+
+
+def apply_substep(variables: typing.Dict[str, typing.Callable], params, substep: int, timestep: int, previous_state: dict,
+                  policy_input: dict) -> dict:
+    state = previous_state.copy()
+    for f in variables.values():
+        key, value = f(params, substep, [], previous_state, policy_input)
+        state[key] = value
+    state['substep'], state['timestep'] = substep, timestep + 1
+    return state
+
+
+def is_price_update(policy_input: dict) -> bool:
+    # Only overwrites token_prices (and resets generated_fees), so a later price update supersedes it entirely. Not with an
+    # arbitrageur, which trades on it
+    return (policy_input.get('pool_update') is None and policy_input.get('external_price_update') is not None
+            and policy_input.get('arbitrage') is None)
+
+
+def at_timestep(state: dict, timestep: int) -> dict:
+    # Policies find their action on the tape from current_state['timestep']
+    return state if state['timestep'] == timestep else {**state, 'timestep': timestep}
+
+
+def simulate(initial_state: dict, partial_state_update_blocks: typing.List[dict], params: dict, time_seq: range,
+             simulation: int = 0, subset: int = 0, run: int = 1, records=None, checkpointer: Checkpointer = None,
+             compaction: typing.Optional[int] = None):
+    """
+    With compaction=k, runs of consecutive price updates are folded: a price-only timestep is applied and recorded only if
+    (timestep + 1) is a multiple of k or it is the last timestep, otherwise it is kept pending and only the latest pending one is
+    applied, without a row, before the next pool-changing action or a checkpoint. Rows keep their timestep, and every recorded row
+    is identical to the row of the same timestep without compaction. Needs a single partial state update block.
+    """
+    # records is a list, a StateRecorder or an OutputSink, states are append()ed to it
+    records = [] if records is None else records
+    # Index in records of the first row that isn't in a checkpoint yet
+    unsaved = len(records)
+    # Checkpoints are tied to the tape of the blocks
+    action_decoder = find_action_decoder(partial_state_update_blocks) if checkpointer is not None else None
+    initial_digest = initial_state_digest(initial_state) if checkpointer is not None else None
+    resumed = checkpointer.resume(subset, run, params, action_decoder, initial_digest) if checkpointer is not None else None
+    if resumed is None:
+        state = dict(initial_state)
+        # time_seq starts after 0 when initial_state is a later state of the tape, e.g. a keyframe (model/keyframes.py)
+        state.update(simulation=simulation, subset=subset, run=run, substep=0, timestep=time_seq[0] if len(time_seq) else 0)
+        records.append(state)
+    else:
+        state, _ = resumed
+        if checkpointer.load_records:
+            records.extend(checkpointer.read_records(subset, run))
+        unsaved = len(records)
+        # Nothing left for a finished run, unless the tape was extended since
+        time_seq = [timestep for timestep in time_seq if timestep >= state['timestep']]
+
+    blocks = [(block['policies'], block.get('variables', block.get('states'))) for block in partial_state_update_blocks]
+    if compaction is not None and (compaction < 1 or len(blocks) != 1):
+        raise Exception('compaction needs a sampling interval of at least 1 and a single partial state update block')
+    # (timestep, policy_input) of the latest price update that was neither applied nor superseded yet
+    pending = None
+    last_timestep = time_seq[-1] if len(time_seq) else None
+    for timestep in time_seq:
+        if compaction is None:
+            for substep, (policies, variables) in enumerate(blocks, start=1):
+                policy_input = aggregate_policies(policies, params, substep, state)
+                state = apply_substep(variables, params, substep, timestep, state, policy_input)
+                records.append(state)
+        else:
+            policies, variables = blocks[0]
+            policy_input = aggregate_policies(policies, params, 1, at_timestep(state, timestep))
+            if is_price_update(policy_input) and (timestep + 1) % compaction != 0 and timestep != last_timestep:
+                pending = (timestep, policy_input)
+            else:
+                if pending is not None and not is_price_update(policy_input):
+                    pending_timestep, pending_policy_input = pending
+                    state = apply_substep(variables, params, 1, pending_timestep, at_timestep(state, pending_timestep),
+                                          pending_policy_input)
+                    # Policies see the state with the folded prices
+                    policy_input = aggregate_policies(policies, params, 1, at_timestep(state, timestep))
+                pending = None
+                state = apply_substep(variables, params, 1, timestep, at_timestep(state, timestep), policy_input)
+                records.append(state)
+            if pending is not None and checkpointer is not None and checkpointer.is_due(timestep + 1):
+                # The pending price update is this timestep's, it is applied without a row so that the checkpoint has the state
+                # of timestep + 1
+                state = apply_substep(variables, params, 1, timestep, at_timestep(state, timestep), pending[1])
+                pending = None
+        if checkpointer is not None and checkpointer.is_due(timestep + 1):
+            checkpointer.save(subset, run, state, records[unsaved:], params, action_decoder, initial_digest)
+            unsaved = len(records)
+    if checkpointer is not None:
+        checkpointer.save(subset, run, state, records[unsaved:], params, action_decoder, initial_digest, done=True)
+    return records
+
+
+def run_replay(initial_state: dict, partial_state_update_blocks: typing.List[dict], sim_configs, columnar: bool = False,
+               checkpointer: Checkpointer = None, compaction: typing.Optional[int] = None,
+               sink: OutputSink = None) -> typing.Optional[pd.DataFrame]:
+    """
+    With columnar=True the states are written into a StateRecorder and the returned frame already has the post_processing() columns
+    (without the object columns), so it must not be post-processed again.
+    With a checkpointer, every run writes checkpoints to its directory and resumes from the latest one if there is one.
+    compaction folds runs of price updates, see simulate().
+    With a sink, the states are streamed to its files instead and None is returned, see model/output_sink.py.
+    """
+    if isinstance(sim_configs, dict):
+        sim_configs = [sim_configs]
+    if columnar and checkpointer is not None:
+        raise Exception('checkpoints are not supported with columnar recording')
+    if sink is not None and checkpointer is not None:
+        raise Exception('checkpoints are not supported with an output sink')
+    if columnar and sink is not None:
+        raise Exception('an output sink already records columns, columnar is not needed')
+
+    if sink is not None:
+        records = sink
+    elif columnar:
+        rows = sum(sim_config['N'] * (1 + len(sim_config['T']) * len(partial_state_update_blocks)) for sim_config in sim_configs)
+        records = StateRecorder.from_initial_state(initial_state, rows)
+    else:
+        records = []
+    for subset, sim_config in enumerate(sim_configs):
+        params = sim_config.get('M', {})
+        for run in range(1, sim_config['N'] + 1):
+            simulate(initial_state, partial_state_update_blocks, params, sim_config['T'], subset=subset, run=run, records=records,
+                     checkpointer=checkpointer, compaction=compaction)
+    if sink is not None:
+        sink.close()
+        return None
+    return records.to_dataframe() if columnar else pd.DataFrame(records)
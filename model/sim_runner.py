@@ -1,26 +1,241 @@
-import pandas as pd
+import typing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from copy import deepcopy
+from enum import Enum
 
-from cadCAD import configs
+import cadCAD
+import pandas as pd
 from cadCAD.configuration import Experiment
 from cadCAD.engine import ExecutionMode, ExecutionContext, Executor
 
+from model.checkpoints import Checkpointer
+from model.genesis_states import apply_pool_params
+from model.keyframes import KeyframeIndex
+from model.output_sink import OutputSink
+from model.partial_state_update_block import generate_partial_state_update_blocks
+from model.parts.system_policies import find_action_decoder
+from model.parts.utils import get_param
+from model.replay_engine import run_replay, simulate
+
+
+class SimulationEngine(Enum):
+    cadcad = "CADCAD"
+    # Deterministic fold over the action tape, see model/replay_engine.py
+    replay = "REPLAY"
+
+
+class SimulationRunner:
+    """
+    Runs simulations with its own list of cadCAD configs instead of the global cadCAD.configs, which Experiment.append_configs
+    adds to by default and Executor runs in full: with the global list, every run in a notebook kernel also re-ran all the earlier
+    ones. The list only holds the configs of the current call, so a runner can be reused for many scenarios in one process.
+    """
+
+    def __init__(self):
+        self.configs = []
+
+    def run(self, initial_state, partial_state_update_block, sim_configs, engine: str = SimulationEngine.cadcad.value,
+            columnar: bool = False, checkpointer: Checkpointer = None, compaction: typing.Optional[int] = None,
+            sink: OutputSink = None) -> typing.Optional[pd.DataFrame]:
+        if SimulationEngine(engine) == SimulationEngine.replay:
+            return run_replay(initial_state, partial_state_update_block, sim_configs, columnar=columnar, checkpointer=checkpointer,
+                              compaction=compaction, sink=sink)
+        if sink is not None:
+            raise Exception('output sinks are only available with the REPLAY engine')
+        if columnar:
+            raise Exception('columnar recording is only available with the REPLAY engine')
+        if checkpointer is not None:
+            raise Exception('checkpoints are only available with the REPLAY engine')
+        if compaction is not None:
+            raise Exception('compaction is only available with the REPLAY engine')
+
+        exp = Experiment()
+        # cadCAD 0.4.23 only uses config_list to number the simulations and still appends to the global list, the new configs are
+        # moved from there to this runner
+        first_config = len(cadCAD.configs)
+        exp.append_configs(
+            initial_state=initial_state,
+            partial_state_update_blocks=partial_state_update_block,
+            # append_configs sets N to 1 in the sim_configs it is given, which would break running them again
+            sim_configs=deepcopy(sim_configs),
+            config_list=self.configs
+        )
+        self.configs[:] = cadCAD.configs[first_config:]
+        del cadCAD.configs[first_config:]
+
+        # Do not use multi_proc, breaks ipdb.set_trace()
+        exec_mode = ExecutionMode()
+        single_proc_context = ExecutionContext(exec_mode.single_proc)
+        executor = Executor(single_proc_context, self.configs)
+
+        try:
+            raw_system_events, tensor_field, sessions = executor.execute()
+        finally:
+            self.configs.clear()
+
+        df = pd.DataFrame(raw_system_events)
+
+        return df
+
+
+def run(initial_state, partial_state_update_block, sim_configs, engine: str = SimulationEngine.cadcad.value, columnar: bool = False,
+        checkpointer: Checkpointer = None, compaction: typing.Optional[int] = None, sink: OutputSink = None):
+    return SimulationRunner().run(initial_state, partial_state_update_block, sim_configs, engine=engine, columnar=columnar,
+                                  checkpointer=checkpointer, compaction=compaction, sink=sink)
+
+
+def run_concurrently(simulations: typing.List[typing.Tuple[dict, typing.List[dict], typing.Any]],
+                     max_workers: typing.Optional[int] = None) -> typing.List[pd.DataFrame]:
+    """
+    Runs several (initial_state, partial_state_update_blocks, sim_configs) simulations, typically of different pools, on a thread
+    pool with the replay engine and returns their raw frames in the same order. Every generate_partial_state_update_blocks() call
+    has its own tape, so the simulations share the process (imports, parsed price feeds) but no simulation state. The cadCAD engine
+    isn't thread safe and can't be used here.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(run_replay, initial_state, partial_state_update_blocks, sim_configs)
+                   for initial_state, partial_state_update_blocks, sim_configs in simulations]
+        return [future.result() for future in futures]
+
+
+# Set in each sweep worker by _init_sweep_worker, so that every worker loads the tape once
+_worker_partial_state_update_blocks = None
+
+
+def _init_sweep_worker(path_to_action_json: str):
+    global _worker_partial_state_update_blocks
+    _worker_partial_state_update_blocks = generate_partial_state_update_blocks(path_to_action_json)['partial_state_update_blocks']
+
+
+def _run_sweep_job(job) -> typing.Optional[pd.DataFrame]:
+    initial_state, params, time_seq, subset, run, output = job
+    initial_state = apply_pool_params(initial_state, params, get_param(params, 'spot_price_reference'))
+    if output is None:
+        return pd.DataFrame(simulate(initial_state, _worker_partial_state_update_blocks, params, time_seq, subset=subset, run=run))
+    # Every job writes its own (subset, run) partition, so the workers never share a file
+    directory, row_group_size, file_format = output
+    sink = OutputSink.from_initial_state(directory, initial_state, row_group_size=row_group_size, file_format=file_format)
+    simulate(initial_state, _worker_partial_state_update_blocks, params, time_seq, subset=subset, run=run, records=sink)
+    sink.close()
+    return None
+
+
+def run_sweep(initial_state, path_to_action_json: str, sim_configs, processes: typing.Optional[int] = None,
+              output_directory: typing.Optional[str] = None, row_group_size: int = 50000,
+              file_format: str = 'parquet') -> typing.Optional[pd.DataFrame]:
+    """
+    Runs every parameter combination (subset) and Monte Carlo run of sim_configs on a process pool with the replay engine.
+    Each worker loads the action tape itself. Besides the model parameters, M can sweep 'swap_fee' and 'denorm_weights', which are
+    applied to the initial pool of each subset (see apply_pool_params). Returns the same raw frame as run() with every subset/run.
+    With an output_directory, every run is streamed to its partition of the directory instead (see model/output_sink.py) and
+    None is returned.
+    """
+    if isinstance(sim_configs, dict):
+        sim_configs = [sim_configs]
+    output = None if output_directory is None else (output_directory, row_group_size, file_format)
+    jobs = [(initial_state, sim_config['M'], sim_config['T'], subset, run, output)
+            for subset, sim_config in enumerate(sim_configs) for run in range(1, sim_config['N'] + 1)]
+
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_sweep_worker, initargs=(path_to_action_json,)) as executor:
+        results = list(executor.map(_run_sweep_job, jobs))
+    if output is not None:
+        return None
+    return pd.concat(results, ignore_index=True)
+
+
+def _run_fork_job(job) -> pd.DataFrame:
+    fork_state, params, time_seq, subset = job
+    records = simulate(fork_state, _worker_partial_state_update_blocks, params, time_seq, subset=subset)
+    # The first record is the fork state, which the shared prefix already has
+    return pd.DataFrame(records[1:])
+
+
+def run_forked_sweep(initial_state, path_to_action_json: str, params: dict, scenarios: typing.List[dict],
+                     time_seq: typing.Optional[range] = None, processes: typing.Optional[int] = None) -> pd.DataFrame:
+    """
+    Sweep over scenarios that only differ from params from some timestep on. A scenario is a dict {'at': timestep, 'params': {...},
+    'pool': {...}}: from timestep 'at', its 'params' override params and its 'pool' parameters ('swap_fee', 'denorm_weights', see
+    apply_pool_params) are applied to the pool. The prefix up to the last fork is simulated once with params, then every scenario
+    continues from the state at its fork on a process pool, so N scenarios cost T + N * (T - k) timesteps instead of N * T.
+    The fork timesteps are given rather than detected: params and pool parameters are constant over a run in this model, so an
+    override has no timestep of its own at which it takes effect, and 'at' is that timestep.
+
+    Returns the raw frame of run() with one subset per scenario, in the order of scenarios, each with its copy of the prefix.
+    """
+    if not scenarios:
+        raise Exception('run_forked_sweep needs at least one scenario')
+    result = generate_partial_state_update_blocks(path_to_action_json)
+    partial_state_update_blocks = result['partial_state_update_blocks']
+    time_seq = range(result['steps_number'] - 1) if time_seq is None else time_seq
+    for scenario in scenarios:
+        if not time_seq.start <= scenario['at'] <= time_seq.stop:
+            raise Exception(f"fork timestep {scenario['at']} is outside of {time_seq}")
+
+    # State update functions never modify the states they are given, so the branches share the prefix states
+    last_fork = max(scenario['at'] for scenario in scenarios)
+    prefix = simulate(initial_state, partial_state_update_blocks, params, range(time_seq.start, last_fork))
+    jobs = []
+    for subset, scenario in enumerate(scenarios):
+        fork_state = [state for state in prefix if state['timestep'] <= scenario['at']][-1]
+        scenario_params = {**params, **scenario.get('params', {})}
+        if scenario.get('pool'):
+            fork_state = apply_pool_params(fork_state, scenario['pool'], get_param(scenario_params, 'spot_price_reference'))
+        jobs.append((fork_state, scenario_params, range(scenario['at'], time_seq.stop), subset))
+
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_sweep_worker, initargs=(path_to_action_json,)) as executor:
+        branches = list(executor.map(_run_fork_job, jobs))
+    frames = []
+    for subset, (scenario, branch) in enumerate(zip(scenarios, branches)):
+        frames.append(pd.DataFrame([{**state, 'subset': subset} for state in prefix if state['timestep'] <= scenario['at']]))
+        frames.append(branch)
+    return pd.concat(frames, ignore_index=True)
+
+
+def _run_segment_job(job) -> pd.DataFrame:
+    seed, params, time_seq = job
+    return pd.DataFrame(simulate(seed, _worker_partial_state_update_blocks, params, time_seq))
+
 
-def run(initial_state, partial_state_update_block, sim_configs):
-    exp = Experiment()
-    exp.append_configs(
-        initial_state=initial_state,
-        partial_state_update_blocks=partial_state_update_block,
-        sim_configs=sim_configs
-    )
+def seam_drift(timestep: int, end_state: dict, seed: dict) -> dict:
+    """
+    Difference between the state a segment ended with and the REPLAY_OUTPUT state the next segment started from.
+    """
+    drift = {'timestep': timestep,
+             'pool_shares_drift': float(end_state['pool']['pool_shares'] - seed['pool']['pool_shares'])}
+    for symbol, token in seed['pool']['tokens'].items():
+        end_balance = end_state['pool']['tokens'][symbol].balance
+        drift[f'token_{symbol.lower()}_balance_drift'] = float(end_balance - token.balance)
+        drift[f'token_{symbol.lower()}_balance_relative_drift'] = float((end_balance - token.balance) / token.balance)
+    return drift
 
-    # Do not use multi_proc, breaks ipdb.set_trace()
-    exec_mode = ExecutionMode()
-    single_proc_context = ExecutionContext(exec_mode.single_proc)
-    executor = Executor(single_proc_context, configs)
 
-    raw_system_events, tensor_field, sessions = executor.execute()
+def run_segmented(initial_state, path_to_action_json: str, params: dict, segment_length: typing.Optional[int] = None,
+                  index: KeyframeIndex = None, processes: typing.Optional[int] = None) -> typing.Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Parallel-in-time replay of one tape. The tape is split into segments of segment_length timesteps that are simulated
+    concurrently on a process pool with the replay engine, each one from the REPLAY_OUTPUT state at its start taken from a
+    KeyframeIndex (built here with interval=segment_length if not given, segment_length must be a multiple of its interval).
 
-    df = pd.DataFrame(raw_system_events)
+    Returns the stitched raw frame, with the same rows as run() for a single run, and a seam report with one row per segment
+    boundary: how far the state simulated in the mode of params drifted from the chain state (REPLAY_OUTPUT) over the segment
+    before it. With REPLAY_OUTPUT params, every drift is 0 and the frame is the one of a serial run.
+    """
+    partial_state_update_blocks = generate_partial_state_update_blocks(path_to_action_json)['partial_state_update_blocks']
+    if index is None:
+        if segment_length is None:
+            raise Exception('pass a segment_length or a keyframe index')
+        index = KeyframeIndex.build(initial_state, partial_state_update_blocks, params, interval=segment_length)
+    index.check_tape(find_action_decoder(partial_state_update_blocks))
+    segment_length = index.interval if segment_length is None else segment_length
+    if segment_length % index.interval != 0:
+        raise Exception(f'segment_length must be a multiple of the keyframe interval ({index.interval})')
 
-    return df
+    starts = list(range(0, index.timesteps, segment_length))
+    jobs = [(index.keyframes[start], params, range(start, min(start + segment_length, index.timesteps))) for start in starts]
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_sweep_worker, initargs=(path_to_action_json,)) as executor:
+        segments = list(executor.map(_run_segment_job, jobs))
 
+    seams = [seam_drift(start, segment.iloc[-1], index.keyframes[start]) for start, segment in zip(starts[1:], segments)]
+    # Every segment after the first starts with its seed, the previous segment already has a row for that timestep
+    df = pd.concat([segments[0]] + [segment.iloc[1:] for segment in segments[1:]], ignore_index=True)
+    return df, pd.DataFrame(seams)
@@ -0,0 +1,106 @@
+"""
+Columnar recorder for the replay engine. Instead of keeping every state dict with its Token objects and unpacking them afterwards
+in post_processing(), each state is written into preallocated float64 columns as the simulation runs. to_dataframe() wraps the
+columns without copying and adds the derived columns, giving the same columns as post_processing(df, include_spot_prices=True)
+minus the object columns (pool, generated_fees, token_prices, spot_prices).
+"""
+import typing
+
+import numpy as np
+import pandas as pd
+
+
+class StateRecorder:
+    def __init__(self, token_symbols: typing.List[str], spot_price_symbols: typing.List[str], rows: int):
+        self.token_symbols = sorted(token_symbols)
+        self.spot_price_symbols = sorted(spot_price_symbols)
+        self.rows = rows
+        self.row = 0
+
+        self.action_type = [None] * rows
+        self.change_datetime = [None] * rows
+        self.index_columns = {key: np.zeros(rows, dtype=np.int64) for key in ['simulation', 'subset', 'run', 'substep', 'timestep']}
+        self.pool_columns = {key: np.zeros(rows, dtype=np.float64) for key in ['pool_shares', 'swap_fee']}
+        self.token_columns = {}
+        for symbol in self.token_symbols:
+            s = symbol.lower()
+            for key in [f'token_{s}_balance', f'token_{s}_denorm_weight', f'token_{s}_weight']:
+                self.token_columns[key] = np.zeros(rows, dtype=np.float64)
+        self.fee_columns = {f'generated_fees_{symbol.lower()}': np.zeros(rows, dtype=np.float64) for symbol in self.token_symbols}
+        self.price_columns = {f'token_{symbol.lower()}_price': np.zeros(rows, dtype=np.float64) for symbol in self.token_symbols}
+        self.spot_price_columns = {f'token_{symbol.lower()}_spot_price': np.zeros(rows, dtype=np.float64) for symbol in
+                                   self.spot_price_symbols}
+
+        # (symbol, balance, denorm_weight, weight, fees, price) column arrays, so that append() doesn't build keys per row
+        self._token_arrays = [(symbol,
+                               self.token_columns[f'token_{symbol.lower()}_balance'],
+                               self.token_columns[f'token_{symbol.lower()}_denorm_weight'],
+                               self.token_columns[f'token_{symbol.lower()}_weight'],
+                               self.fee_columns[f'generated_fees_{symbol.lower()}'],
+                               self.price_columns[f'token_{symbol.lower()}_price']) for symbol in self.token_symbols]
+        self._spot_price_arrays = [(symbol, self.spot_price_columns[f'token_{symbol.lower()}_spot_price'])
+                                   for symbol in self.spot_price_symbols]
+
+    @classmethod
+    def from_initial_state(cls, initial_state: dict, rows: int) -> 'StateRecorder':
+        return cls(list(initial_state['pool']['tokens'].keys()), list(initial_state['spot_prices'].keys()), rows)
+
+    def __len__(self):
+        return self.row
+
+    def clear(self):
+        # Reuses the columns, the frames returned by to_dataframe() before must not be used anymore
+        self.row = 0
+
+    def append(self, state: dict):
+        # Same interface as list.append, so the replay engine can record into either
+        i = self.row
+        if i >= self.rows:
+            raise Exception(f'StateRecorder is full ({self.rows} rows)')
+        pool = state['pool']
+        tokens = pool['tokens']
+        fees = pool['generated_fees']
+        prices = state['token_prices']
+        spot_prices = state['spot_prices']
+
+        self.action_type[i] = state['action_type']
+        self.change_datetime[i] = state['change_datetime']
+        for key, column in self.index_columns.items():
+            column[i] = state[key]
+        self.pool_columns['pool_shares'][i] = float(pool['pool_shares'])
+        self.pool_columns['swap_fee'][i] = float(pool['swap_fee'])
+        for symbol, balance, denorm_weight, weight, fee, price in self._token_arrays:
+            token = tokens[symbol]
+            balance[i] = float(token.balance)
+            denorm_weight[i] = float(token.denorm_weight)
+            weight[i] = float(token.weight)
+            fee[i] = float(fees[symbol])
+            price[i] = float(prices[symbol])
+        for symbol, spot_price in self._spot_price_arrays:
+            spot_price[i] = float(spot_prices[symbol])
+        self.row += 1
+
+    def to_dataframe(self) -> pd.DataFrame:
+        n = self.row
+        columns = {
+            'action_type': self.action_type[:n],
+            'change_datetime': pd.to_datetime(self.change_datetime[:n], utc=True),
+            **{key: column[:n] for key, column in self.index_columns.items()},
+            **{key: column[:n] for key, column in self.pool_columns.items()},
+            **{key: column[:n] for key, column in self.token_columns.items()},
+            **{key: column[:n] for key, column in self.fee_columns.items()},
+            **{key: column[:n] for key, column in self.price_columns.items()},
+            **{key: column[:n] for key, column in self.spot_price_columns.items()},
+        }
+        df = pd.DataFrame(columns, copy=False)
+
+        # Derived columns, computed the same way as post_processing()
+        symbols = [symbol.lower() for symbol in self.token_symbols]
+        for s in symbols:
+            df[f'token_{s}_value'] = df[f'token_{s}_balance'] * df[f'token_{s}_price']
+        df['tvl'] = df[[f'token_{s}_value' for s in symbols]].sum(axis=1)
+        df['invariant'] = 1
+        for s in symbols:
+            df['invariant'] *= (df[f'token_{s}_balance'] ** df[f'token_{s}_weight'])
+        df['total_token_balances'] = df[[f'token_{s}_balance' for s in symbols]].sum(axis=1)
+        return df
@@ -0,0 +1,134 @@
+import os
+import unittest
+from decimal import Decimal
+
+import pandas as pd
+from cadCAD import configs
+from cadCAD.configuration.utils import config_sim
+
+from model.genesis_states import generate_initial_state
+from model.models import Token
+from model.partial_state_update_block import generate_partial_state_update_blocks
+from model.parts.agent_policies import arbitrage_trades, optimal_arbitrage_amount_in, p_arbitrageur
+from model.parts.balancer_math import BalancerMath
+from model.parts.pool_state_updates import s_swap_exact_amount_in, updated_pool
+from model.parts.utils import post_processing
+from model.sim_runner import run, SimulationEngine
+
+INITIAL_STATE_JSON = os.path.join(os.path.dirname(__file__), '..', 'data',
+                                  '0x8b6e6e7b5b3801fed2cafd4b22b8a16c2f2db21a-initial_pool_states-prices.json')
+ACTIONS_JSON = os.path.join(os.path.dirname(__file__), 'data', '0x8b6e6e7b5b3801fed2cafd4b22b8a16c2f2db21a-actions-sample.json')
+
+
+def profit(amount_in: Decimal, balances: tuple, prices: tuple) -> Decimal:
+    amount_out = BalancerMath.calc_out_given_in(token_amount_in=amount_in, token_balance_in=balances[0], token_weight_in=Decimal('10'),
+                                                token_balance_out=balances[1], token_weight_out=Decimal('40'),
+                                                swap_fee=Decimal('0.003')).result
+    return prices[1] * amount_out - prices[0] * amount_in
+
+
+class TestArbitrage(unittest.TestCase):
+    def test_optimal_amount_in(self):
+        balances = (Decimal('1000000'), Decimal('2000'))
+        # The pool sells WETH at about 2006 DAI, the market price is 2500
+        prices = (Decimal('1'), Decimal('2500'))
+        amount_in = optimal_arbitrage_amount_in(balances[0], Decimal('10'), balances[1], Decimal('40'), Decimal('0.003'), *prices)
+        self.assertGreater(amount_in, 0)
+        self.assertGreater(profit(amount_in, balances, prices), profit(amount_in * Decimal('0.999'), balances, prices))
+        self.assertGreater(profit(amount_in, balances, prices), profit(amount_in * Decimal('1.001'), balances, prices))
+
+        amount_out = BalancerMath.calc_out_given_in(token_amount_in=amount_in, token_balance_in=balances[0], token_weight_in=Decimal('10'),
+                                                    token_balance_out=balances[1], token_weight_out=Decimal('40'),
+                                                    swap_fee=Decimal('0.003')).result
+        # The swap fee stays in the pool, so the spot price after the trade is the external price up to the fee
+        spot_price_after = BalancerMath.calc_spot_price(balances[0] + amount_in, Decimal('10'), balances[1] - amount_out, Decimal('40'),
+                                                        Decimal('0.003'))
+        self.assertLess(abs(spot_price_after / Decimal('2500') - 1), Decimal('0.003'))
+
+        # Within the fee of the external price there is nothing to gain in either direction
+        spot_price = BalancerMath.calc_spot_price(balances[0], Decimal('10'), balances[1], Decimal('40'), Decimal('0'))
+        for price in [spot_price, spot_price * Decimal('1.002')]:
+            self.assertEqual(optimal_arbitrage_amount_in(balances[0], Decimal('10'), balances[1], Decimal('40'), Decimal('0.003'),
+                                                         Decimal('1'), price), 0)
+            self.assertEqual(optimal_arbitrage_amount_in(balances[1], Decimal('40'), balances[0], Decimal('10'), Decimal('0.003'),
+                                                         price, Decimal('1')), 0)
+
+    def test_three_token_pool(self):
+        tokens = {
+            'DAI': Token(weight=Decimal('0.25'), denorm_weight=Decimal('10'), balance=Decimal('100000'), bound=True),
+            'WETH': Token(weight=Decimal('0.5'), denorm_weight=Decimal('20'), balance=Decimal('200'), bound=True),
+            'BAL': Token(weight=Decimal('0.25'), denorm_weight=Decimal('10'), balance=Decimal('5000'), bound=True),
+        }
+        state = {
+            'pool': {'tokens': tokens, 'swap_fee': Decimal('0.002'), 'generated_fees': {symbol: Decimal('0') for symbol in tokens}},
+            'token_prices': {'DAI': 1.0, 'WETH': 600.0, 'BAL': 25.0},
+            'action_type': 'external_price_update',
+        }
+        trades, pool = arbitrage_trades({}, 1, [], state['pool'], state['token_prices'])
+        self.assertEqual([(swap.token_in.symbol, swap.min_token_out.symbol) for swap, _ in trades],
+                         [('WETH', 'DAI'), ('DAI', 'BAL'), ('WETH', 'BAL')])
+        # The trades are applied once, one after the other, and their fees add up
+        expected = state['pool']
+        fees = {symbol: Decimal('0') for symbol in tokens}
+        for trade in trades:
+            expected = s_swap_exact_amount_in({}, 1, [], {'pool': expected}, *trade)
+            fees = {symbol: fee + expected['generated_fees'][symbol] for symbol, fee in fees.items()}
+        self.assertEqual(pool['tokens'], expected['tokens'])
+        self.assertEqual(pool['generated_fees'], fees)
+        self.assertEqual(arbitrage_trades({}, 1, [], state['pool'], {'DAI': 1.0}), ([], state['pool']))
+
+        # On a price update the pool is arbitraged against the new prices in the same substep
+        policy_input = {'external_price_update': state['token_prices'], 'action_type': 'external_price_update',
+                        **p_arbitrageur({}, 1, [], state)}
+        self.assertEqual(updated_pool({}, 1, [], state, policy_input)['tokens'], pool['tokens'])
+        policy_input = {'pool_update': None, 'action_type': 'swap', **p_arbitrageur({}, 1, [], state)}
+        self.assertEqual(updated_pool({}, 1, [], state, policy_input)['tokens'], state['pool']['tokens'])
+
+
+class TestArbitrageBlock(unittest.TestCase):
+    def setUp(self):
+        configs.clear()
+
+    def simulate(self, engine: str, compaction: int = None) -> pd.DataFrame:
+        initial_values = generate_initial_state(initial_values_json=INITIAL_STATE_JSON, spot_price_base_currency='DAI')
+        result = generate_partial_state_update_blocks(ACTIONS_JSON, arbitrage=True)
+        sim_configs = config_sim({'N': 1, 'T': range(result['steps_number'] - 1),
+                                  'M': {'spot_price_reference': ['DAI'], 'decoding_type': ['SIMPLIFIED']}})
+        return run(initial_values, result['partial_state_update_blocks'], sim_configs, engine=engine, compaction=compaction)
+
+    def test_pool_follows_external_prices(self):
+        df = self.simulate(SimulationEngine.replay.value)
+        # No extra rows, the arbitrage is in the row of the price update
+        self.assertEqual(len(df), 1 + 13)
+        self.assertEqual(df['substep'].iloc[1:].unique().tolist(), [1])
+        price_updates = df[df['action_type'] == 'external_price_update']
+        arbitrage = price_updates[[sum(fees.values()) > 0 for fees in price_updates['pool'].map(lambda pool: pool['generated_fees'])]]
+        self.assertEqual(len(arbitrage), 5)
+        for _, row in arbitrage.iterrows():
+            tokens = row['pool']['tokens']
+            prices = {symbol: Decimal(str(price)) for symbol, price in row['token_prices'].items()}
+            swap_fee = row['pool']['swap_fee']
+            # After the trade the pool price is at the external price in the direction of the trade, up to the fee
+            weth_in = BalancerMath.calc_spot_price(tokens['WETH'].balance, tokens['WETH'].denorm_weight, tokens['DAI'].balance,
+                                                   tokens['DAI'].denorm_weight, swap_fee)
+            dai_in = BalancerMath.calc_spot_price(tokens['DAI'].balance, tokens['DAI'].denorm_weight, tokens['WETH'].balance,
+                                                  tokens['WETH'].denorm_weight, swap_fee)
+            self.assertTrue(abs(weth_in / (prices['DAI'] / prices['WETH']) - 1) < swap_fee or
+                            abs(dai_in / (prices['WETH'] / prices['DAI']) - 1) < swap_fee)
+            self.assertGreater(sum(row['pool']['generated_fees'].values()), 0)
+
+    def test_compaction_keeps_arbitraged_price_updates(self):
+        object_columns = ['pool', 'token_prices', 'spot_prices', 'generated_fees']
+        full = self.simulate(SimulationEngine.replay.value)
+        compacted = self.simulate(SimulationEngine.replay.value, compaction=1000)
+        pd.testing.assert_frame_equal(post_processing(full).drop(columns=object_columns),
+                                      post_processing(compacted).drop(columns=object_columns))
+
+    def test_same_rows_with_cadcad(self):
+        object_columns = ['pool', 'token_prices', 'spot_prices', 'generated_fees']
+        pd.testing.assert_frame_equal(post_processing(self.simulate(SimulationEngine.replay.value)).drop(columns=object_columns),
+                                      post_processing(self.simulate(SimulationEngine.cadcad.value)).drop(columns=object_columns))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import random
+import unittest
+from decimal import Decimal
+
+import numpy as np
+
+from model.parts.balancer_constants import MAX_IN_RATIO, MAX_OUT_RATIO
+from model.parts.balancer_math import BalancerMath
+from model.parts.balancer_math_vectorized import BalancerMathVectorized, FLOAT64_RELATIVE_ERROR_BOUND
+
+
+def random_trades(n: int, seed: int = 42) -> dict:
+    rng = random.Random(seed)
+
+    def d(low, high):
+        return Decimal(repr(rng.uniform(low, high)))
+
+    trades = {k: [] for k in ['b_i', 'w_i', 'b_o', 'w_o', 'fee', 'pool_supply', 'total_weight', 'in_ratio', 'out_ratio', 'pool_ratio']}
+    for _ in range(n):
+        w_i, w_o = d(1, 25), d(1, 25)
+        trades['b_i'].append(Decimal(10) ** rng.randint(-3, 9) * d(1, 10))
+        trades['b_o'].append(Decimal(10) ** rng.randint(-3, 9) * d(1, 10))
+        trades['w_i'].append(w_i)
+        trades['w_o'].append(w_o)
+        trades['fee'].append(d(0.000001, 0.1))
+        trades['pool_supply'].append(d(1, 1000))
+        trades['total_weight'].append(w_i + w_o)
+        # Trade sizes from dust up to the contract's limits
+        trades['in_ratio'].append(MAX_IN_RATIO * Decimal(10) ** -rng.randint(0, 12) * d(0.01, 1))
+        trades['out_ratio'].append((MAX_OUT_RATIO - Decimal('1e-6')) * Decimal(10) ** -rng.randint(0, 12) * d(0.01, 1))
+        trades['pool_ratio'].append(Decimal('0.25') * Decimal(10) ** -rng.randint(0, 12) * d(0.01, 1))
+    return trades
+
+
+class TestBalancerMathVectorized(unittest.TestCase):
+    trades = random_trades(500)
+
+    def assert_close_to_decimal(self, batch, decimal_results):
+        expected = np.array([float(r.result) for r in decimal_results])
+        expected_fee = np.array([float(r.fee) for r in decimal_results])
+        np.testing.assert_allclose(batch.result, expected, rtol=FLOAT64_RELATIVE_ERROR_BOUND, atol=0)
+        np.testing.assert_allclose(batch.fee, expected_fee, rtol=FLOAT64_RELATIVE_ERROR_BOUND, atol=0)
+
+    def test_calc_spot_price(self):
+        t = self.trades
+        batch = BalancerMathVectorized.calc_spot_price(t['b_i'], t['w_i'], t['b_o'], t['w_o'], t['fee'])
+        expected = [float(BalancerMath.calc_spot_price(*args)) for args in zip(t['b_i'], t['w_i'], t['b_o'], t['w_o'], t['fee'])]
+        np.testing.assert_allclose(batch, expected, rtol=FLOAT64_RELATIVE_ERROR_BOUND, atol=0)
+
+    def test_calc_out_given_in(self):
+        t = self.trades
+        amounts_in = [b * r for b, r in zip(t['b_i'], t['in_ratio'])]
+        batch = BalancerMathVectorized.calc_out_given_in(amounts_in, t['b_i'], t['w_i'], t['b_o'], t['w_o'], t['fee'])
+        self.assert_close_to_decimal(batch, [BalancerMath.calc_out_given_in(*args) for args in
+                                             zip(amounts_in, t['b_i'], t['w_i'], t['b_o'], t['w_o'], t['fee'])])
+
+    def test_calc_in_given_out(self):
+        t = self.trades
+        amounts_out = [b * r for b, r in zip(t['b_o'], t['out_ratio'])]
+        batch = BalancerMathVectorized.calc_in_given_out(t['b_o'], t['b_i'], amounts_out, t['w_i'], t['w_o'], t['fee'])
+        self.assert_close_to_decimal(batch, [BalancerMath.calc_in_given_out(*args) for args in
+                                             zip(t['b_o'], t['b_i'], amounts_out, t['w_i'], t['w_o'], t['fee'])])
+
+    def test_calc_pool_out_given_single_in(self):
+        t = self.trades
+        amounts_in = [b * r for b, r in zip(t['b_i'], t['in_ratio'])]
+        batch = BalancerMathVectorized.calc_pool_out_given_single_in(t['b_i'], t['w_i'], t['pool_supply'], t['total_weight'], amounts_in,
+                                                                     t['fee'])
+        self.assert_close_to_decimal(batch, [BalancerMath.calc_pool_out_given_single_in(*args) for args in
+                                             zip(t['b_i'], t['w_i'], t['pool_supply'], t['total_weight'], amounts_in, t['fee'])])
+
+    def test_calc_single_in_given_pool_out(self):
+        t = self.trades
+        pool_amounts_out = [s * r for s, r in zip(t['pool_supply'], t['pool_ratio'])]
+        batch = BalancerMathVectorized.calc_single_in_given_pool_out(t['b_i'], t['w_i'], t['pool_supply'], t['total_weight'],
+                                                                     pool_amounts_out, t['fee'])
+        self.assert_close_to_decimal(batch, [BalancerMath.calc_single_in_given_pool_out(*args) for args in
+                                             zip(t['b_i'], t['w_i'], t['pool_supply'], t['total_weight'], pool_amounts_out, t['fee'])])
+
+    def test_calc_single_out_given_pool_in(self):
+        t = self.trades
+        pool_amounts_in = [s * r for s, r in zip(t['pool_supply'], t['pool_ratio'])]
+        batch = BalancerMathVectorized.calc_single_out_given_pool_in(t['b_o'], t['w_o'], t['pool_supply'], t['total_weight'],
+                                                                     pool_amounts_in, t['fee'])
+        self.assert_close_to_decimal(batch, [BalancerMath.calc_single_out_given_pool_in(*args) for args in
+                                             zip(t['b_o'], t['w_o'], t['pool_supply'], t['total_weight'], pool_amounts_in, t['fee'])])
+
+    def test_calc_pool_in_given_single_out(self):
+        t = self.trades
+        amounts_out = [b * r for b, r in zip(t['b_o'], t['out_ratio'])]
+        batch = BalancerMathVectorized.calc_pool_in_given_single_out(t['b_o'], t['w_o'], t['pool_supply'], t['total_weight'], amounts_out,
+                                                                     t['fee'])
+        self.assert_close_to_decimal(batch, [BalancerMath.calc_pool_in_given_single_out(*args) for args in
+                                             zip(t['b_o'], t['w_o'], t['pool_supply'], t['total_weight'], amounts_out, t['fee'])])
+
+    def test_scalars_broadcast_against_arrays(self):
+        amounts_in = np.array([1.0, 2.0, 3.0])
+        batch = BalancerMathVectorized.calc_out_given_in(amounts_in, 10, 20, 100, 20, 0)
+        self.assertEqual(batch.result.shape, (3,))
+        self.assertAlmostEqual(batch.result[0], 9.0909090909090909)
+        np.testing.assert_array_equal(batch.fee, np.zeros(3))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import unittest
+from decimal import Decimal
+
+from model.parts.balancer_math import BalancerMath
+from model.parts.balancer_math_wei import BONE, BalancerMathWei, bdiv, bmul, bpow, bpowi, bsub, from_wei, to_wei
+
+
+class TestBNum(unittest.TestCase):
+    def test_bmul_rounds_half_up(self):
+        self.assertEqual(bmul(1, BONE // 2), 1)
+        self.assertEqual(bmul(1, BONE // 2 - 1), 0)
+        self.assertEqual(bmul(3 * BONE, 2 * BONE), 6 * BONE)
+
+    def test_bdiv_rounds_half_up(self):
+        self.assertEqual(bdiv(1, 3), 333333333333333333)
+        self.assertEqual(bdiv(2, 3), 666666666666666667)
+        with self.assertRaisesRegex(Exception, 'ERR_DIV_ZERO'):
+            bdiv(1, 0)
+
+    def test_bsub_underflow(self):
+        with self.assertRaisesRegex(Exception, 'ERR_SUB_UNDERFLOW'):
+            bsub(1, 2)
+
+    def test_bmul_overflow(self):
+        with self.assertRaisesRegex(Exception, 'ERR_MUL_OVERFLOW'):
+            bmul(2 ** 200, 2 ** 60)
+
+    def test_bpowi(self):
+        self.assertEqual(bpowi(2 * BONE, 10), 1024 * BONE)
+        self.assertEqual(bpowi(5 * BONE, 0), BONE)
+
+    def test_bpow_fractional_exponent(self):
+        result = bpow(BONE // 2, BONE // 2)
+        self.assertAlmostEqual(from_wei(result), Decimal('0.5').sqrt(), 9)
+
+    def test_bpow_base_bounds(self):
+        with self.assertRaisesRegex(Exception, 'ERR_BPOW_BASE_TOO_LOW'):
+            bpow(0, BONE // 2)
+        with self.assertRaisesRegex(Exception, 'ERR_BPOW_BASE_TOO_HIGH'):
+            bpow(2 * BONE, BONE // 2)
+
+    def test_to_wei_from_wei(self):
+        self.assertEqual(to_wei(Decimal('67738.636173102396002749')), 67738636173102396002749)
+        self.assertEqual(from_wei(67738636173102396002749), Decimal('67738.636173102396002749'))
+
+
+class TestBalancerMathWei(unittest.TestCase):
+    # Balances of pool 0x8b6e6e7b5b3801fed2cafd4b22b8a16c2f2db21a at creation
+    dai_balance = Decimal('10000000')
+    weth_balance = Decimal('67738.636173102396002749')
+    dai_weight = Decimal('10')
+    weth_weight = Decimal('40')
+    pool_supply = Decimal('100')
+    swap_fee = Decimal('0.0025')
+
+    def assert_matches_decimal(self, wei_result, decimal_result, places=9):
+        self.assertAlmostEqual(from_wei(wei_result.result) / decimal_result.result, Decimal('1'), places)
+        self.assertAlmostEqual(from_wei(wei_result.fee), decimal_result.fee, places)
+
+    def test_calc_spot_price(self):
+        args = (self.dai_balance, self.dai_weight, self.weth_balance, self.weth_weight, self.swap_fee)
+        price = BalancerMathWei.calc_spot_price(*map(to_wei, args))
+        self.assertAlmostEqual(from_wei(price), BalancerMath.calc_spot_price(*args), 15)
+
+    def test_calc_out_given_in(self):
+        args = dict(token_amount_in=Decimal('11861.328308360000000000'), token_balance_in=self.dai_balance, token_weight_in=self.dai_weight,
+                    token_balance_out=self.weth_balance, token_weight_out=self.weth_weight, swap_fee=self.swap_fee)
+        self.assert_matches_decimal(BalancerMathWei.calc_out_given_in(**{k: to_wei(v) for k, v in args.items()}),
+                                    BalancerMath.calc_out_given_in(**args))
+
+    def test_calc_in_given_out(self):
+        args = dict(token_balance_out=self.weth_balance, token_balance_in=self.dai_balance, token_amount_out=Decimal('18.066'),
+                    token_weight_in=self.dai_weight, token_weight_out=self.weth_weight, swap_fee=self.swap_fee)
+        self.assert_matches_decimal(BalancerMathWei.calc_in_given_out(**{k: to_wei(v) for k, v in args.items()}),
+                                    BalancerMath.calc_in_given_out(**args))
+
+    def test_calc_pool_out_given_single_in(self):
+        args = dict(token_balance_in=self.weth_balance, token_weight_in=self.weth_weight, pool_supply=self.pool_supply,
+                    total_weight=self.dai_weight + self.weth_weight, token_amount_in=Decimal('12.5'), swap_fee=self.swap_fee)
+        self.assert_matches_decimal(BalancerMathWei.calc_pool_out_given_single_in(**{k: to_wei(v) for k, v in args.items()}),
+                                    BalancerMath.calc_pool_out_given_single_in(**args))
+
+    def test_calc_single_in_given_pool_out(self):
+        args = dict(token_balance_in=self.dai_balance, token_weight_in=self.dai_weight, pool_supply=self.pool_supply,
+                    total_weight=self.dai_weight + self.weth_weight, pool_amount_out=Decimal('0.75'), swap_fee=self.swap_fee)
+        self.assert_matches_decimal(BalancerMathWei.calc_single_in_given_pool_out(**{k: to_wei(v) for k, v in args.items()}),
+                                    BalancerMath.calc_single_in_given_pool_out(**args))
+
+    def test_calc_single_out_given_pool_in(self):
+        args = dict(token_balance_out=self.weth_balance, token_weight_out=self.weth_weight, pool_supply=self.pool_supply,
+                    total_weight=self.dai_weight + self.weth_weight, pool_amount_in=Decimal('3'), swap_fee=self.swap_fee)
+        self.assert_matches_decimal(BalancerMathWei.calc_single_out_given_pool_in(**{k: to_wei(v) for k, v in args.items()}),
+                                    BalancerMath.calc_single_out_given_pool_in(**args))
+
+    def test_calc_pool_in_given_single_out(self):
+        args = dict(token_balance_out=self.dai_balance, token_weight_out=self.dai_weight, pool_supply=self.pool_supply,
+                    total_weight=self.dai_weight + self.weth_weight, token_amount_out=Decimal('25000'), swap_fee=self.swap_fee)
+        self.assert_matches_decimal(BalancerMathWei.calc_pool_in_given_single_out(**{k: to_wei(v) for k, v in args.items()}),
+                                    BalancerMath.calc_pool_in_given_single_out(**args))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,7 +2,7 @@ import unittest
 from decimal import Decimal
 
 from model.parts.balancer_constants import EXIT_FEE
-from model.balancer_pool import BalancerPool
+from model.balancer_pool import BATCH_ERRORS, BalancerPool, OperationBatch
 
 
 class TestBalancerPool(unittest.TestCase):
@@ -147,6 +147,303 @@ class TestBalancerPool(unittest.TestCase):
         self.assertAlmostEqual(pool.get_balance('DAI'), Decimal('10.3'))
         self.assertAlmostEqual(pool.get_balance('WETH'), Decimal('4'))
 
+    def test_snapshot_rollback(self):
+        pool = BalancerPool()
+        pool.bind('WETH', Decimal('4'), Decimal('10'))
+        pool.bind('ETHIX', Decimal('12'), Decimal('10'))
+        pool.set_swap_fee(Decimal('0.001'))
+
+        snapshot = pool.snapshot()
+        result = pool.swap_exact_amount_in('WETH', Decimal('2'), 'ETHIX', Decimal('0'), Decimal('200000'))
+        self.assertAlmostEqual(result.token_amount_out, Decimal('3.997332444148049352'))
+        pool.join_swap_extern_amount_in('ETHIX', Decimal('1'), Decimal('0'))
+        nested = pool.snapshot()
+        pool.unbind('WETH')
+        pool.bind('DAI', Decimal('100'), Decimal('5'))
+        pool.rollback(nested)
+        self.assertEqual(list(pool._records), ['WETH', 'ETHIX'])
+        self.assertEqual(pool.get_balance('WETH'), Decimal('6'))
+        pool.rollback(snapshot)
+        self.assertEqual(pool.get_balance('WETH'), Decimal('4'))
+        self.assertEqual(pool.get_balance('ETHIX'), Decimal('12'))
+
+    def test_apply_batch_same_token_swaps(self):
+        operations = [
+            ('swap_exact_amount_in', 'WETH', 'WETH', Decimal('1'), Decimal('0'), Decimal('200000')),
+            ('swap_exact_amount_out', 'ETHIX', 'ETHIX', Decimal('2'), Decimal('100'), Decimal('200000')),
+            ('swap_exact_amount_in', 'WETH', 'WETH', Decimal('1'), Decimal('1000'), Decimal('200000')),
+            ('exit_swap_pool_amount_in', None, 'UNKNOWN', Decimal('2'), Decimal('0'), None),
+        ]
+
+        def bound_pool():
+            pool = BalancerPool()
+            pool.bind('WETH', Decimal('4'), Decimal('10'))
+            pool.bind('ETHIX', Decimal('12'), Decimal('10'))
+            pool.set_swap_fee(Decimal('0.001'))
+            return pool
+
+        pool = bound_pool()
+        result = pool.apply_batch(OperationBatch(*[list(column) for column in zip(*operations)]))
+        expected = bound_pool()
+        swap_in = expected.swap_exact_amount_in('WETH', Decimal('1'), 'WETH', Decimal('0'), Decimal('200000'))
+        swap_out = expected.swap_exact_amount_out('ETHIX', Decimal('100'), 'ETHIX', Decimal('2'), Decimal('200000'))
+        self.assertEqual(result.amount[:2].tolist(), [swap_in.token_amount_out, swap_out.token_amount_in])
+        self.assertEqual(result.spot_price_after[:2].tolist(), [swap_in.spot_price_after, swap_out.spot_price_after])
+        for token in ['WETH', 'ETHIX']:
+            self.assertEqual(pool.get_balance(token), expected.get_balance(token))
+        # Errors that aren't in BATCH_ERRORS get a code of their own
+        self.assertEqual(result.errors(), [None, None, 'ERR_LIMIT_OUT', 'UNKNOWN'])
+        self.assertEqual(result.error_table[len(BATCH_ERRORS):], ['UNKNOWN'])
+        self.assertEqual(pool.get_total_denorm_weight(), Decimal('20'))
+        self.assertEqual(pool.get_pool_token_supply(), Decimal('100'))
+        self.assertEqual(pool.factory_fees, Decimal('0'))
+        self.assertIsNone(pool._journal)
+        with self.assertRaises(Exception):
+            pool.rollback(snapshot)
+
+        # A trade that fails halfway can be undone as well
+        snapshot = pool.snapshot()
+        with self.assertRaisesRegex(Exception, 'ERR_LIMIT_PRICE'):
+            pool.swap_exact_amount_in('WETH', Decimal('1'), 'ETHIX', Decimal('0'), Decimal('0.4'))
+        pool.rollback(snapshot)
+        self.assertEqual(pool.get_balance('WETH'), Decimal('4'))
+
+        pool.snapshot()
+        pool.swap_exact_amount_in('WETH', Decimal('2'), 'ETHIX', Decimal('0'), Decimal('200000'))
+        pool.commit()
+        self.assertEqual(pool.get_balance('WETH'), Decimal('6'))
+        self.assertIsNone(pool._journal)
+
+    def test_nested_snapshots_without_writes_between(self):
+        pool = BalancerPool()
+        pool.bind('WETH', Decimal('4'), Decimal('10'))
+        pool.bind('ETHIX', Decimal('12'), Decimal('10'))
+        pool.set_swap_fee(Decimal('0.001'))
+
+        outer = pool.snapshot()
+        inner = pool.snapshot()
+        pool.commit(inner)
+        inner = pool.snapshot()
+        pool.rollback(inner)
+        # Closing the inner snapshots left the outer one open
+        pool.swap_exact_amount_in('WETH', Decimal('1'), 'ETHIX', Decimal('0'), Decimal('200000'))
+        pool.rollback(outer)
+        self.assertEqual(pool.get_balance('WETH'), Decimal('4'))
+        self.assertIsNone(pool._journal)
+
+        # A quote opens and closes its own snapshot inside the open one
+        outer = pool.snapshot()
+        quote = pool.quote_swap_exact_amount_in('WETH', Decimal('2'), 'ETHIX', Decimal('0'), Decimal('200000'))
+        result = pool.swap_exact_amount_in('WETH', Decimal('2'), 'ETHIX', Decimal('0'), Decimal('200000'))
+        self.assertEqual(result, quote)
+        pool.rollback(outer)
+        self.assertEqual(pool.get_balance('WETH'), Decimal('4'))
+        self.assertEqual(pool.get_balance('ETHIX'), Decimal('12'))
+
+    def test_apply_batch_same_token_swaps(self):
+        operations = [
+            ('swap_exact_amount_in', 'WETH', 'WETH', Decimal('1'), Decimal('0'), Decimal('200000')),
+            ('swap_exact_amount_out', 'ETHIX', 'ETHIX', Decimal('2'), Decimal('100'), Decimal('200000')),
+            ('swap_exact_amount_in', 'WETH', 'WETH', Decimal('1'), Decimal('1000'), Decimal('200000')),
+            ('exit_swap_pool_amount_in', None, 'UNKNOWN', Decimal('2'), Decimal('0'), None),
+        ]
+
+        def bound_pool():
+            pool = BalancerPool()
+            pool.bind('WETH', Decimal('4'), Decimal('10'))
+            pool.bind('ETHIX', Decimal('12'), Decimal('10'))
+            pool.set_swap_fee(Decimal('0.001'))
+            return pool
+
+        pool = bound_pool()
+        result = pool.apply_batch(OperationBatch(*[list(column) for column in zip(*operations)]))
+        expected = bound_pool()
+        swap_in = expected.swap_exact_amount_in('WETH', Decimal('1'), 'WETH', Decimal('0'), Decimal('200000'))
+        swap_out = expected.swap_exact_amount_out('ETHIX', Decimal('100'), 'ETHIX', Decimal('2'), Decimal('200000'))
+        self.assertEqual(result.amount[:2].tolist(), [swap_in.token_amount_out, swap_out.token_amount_in])
+        self.assertEqual(result.spot_price_after[:2].tolist(), [swap_in.spot_price_after, swap_out.spot_price_after])
+        for token in ['WETH', 'ETHIX']:
+            self.assertEqual(pool.get_balance(token), expected.get_balance(token))
+        # Errors that aren't in BATCH_ERRORS get a code of their own
+        self.assertEqual(result.errors(), [None, None, 'ERR_LIMIT_OUT', 'UNKNOWN'])
+        self.assertEqual(result.error_table[len(BATCH_ERRORS):], ['UNKNOWN'])
+        self.assertIsNone(pool._journal)
+        with self.assertRaisesRegex(Exception, 'ERR_NO_SNAPSHOT'):
+            pool.rollback(outer)
+        with self.assertRaisesRegex(Exception, 'ERR_NO_SNAPSHOT'):
+            pool.commit()
+
+    def test_quotes(self):
+        pool = BalancerPool()
+        pool.bind('WETH', Decimal('4'), Decimal('10'))
+        pool.bind('ETHIX', Decimal('12'), Decimal('10'))
+        pool.set_swap_fee(Decimal('0.001'))
+        version = pool._version
+
+        quote = pool.quote_swap_exact_amount_in('WETH', Decimal('2'), 'ETHIX', Decimal('0'), Decimal('200000'))
+        self.assertAlmostEqual(quote.token_amount_out, Decimal('3.997332444148049352'))
+        self.assertEqual(pool.get_balance('WETH'), Decimal('4'))
+        self.assertEqual(pool._version, version)
+        self.assertIsNone(pool._journal)
+        # The same quote is served from the cache until the pool changes, as a copy the caller can't change for others
+        quote.token_amount_out = Decimal('0')
+        cached = pool.quote_swap_exact_amount_in('WETH', Decimal('2'), 'ETHIX', Decimal('0'), Decimal('200000'))
+        self.assertEqual(len(pool._quotes), 1)
+        self.assertAlmostEqual(cached.token_amount_out, Decimal('3.997332444148049352'))
+        quote = cached
+        with self.assertRaisesRegex(Exception, 'ERR_MAX_IN_RATIO'):
+            pool.quote_swap_exact_amount_in('WETH', Decimal('3'), 'ETHIX', Decimal('0'), Decimal('200000'))
+        with self.assertRaisesRegex(Exception, 'ERR_MAX_OUT_RATIO'):
+            pool.quote_exit_swap_extern_amount_out('ETHIX', Decimal('5'), Decimal('100'))
+        self.assertEqual(pool.get_balance('ETHIX'), Decimal('12'))
+
+    def test_apply_batch_same_token_swaps(self):
+        operations = [
+            ('swap_exact_amount_in', 'WETH', 'WETH', Decimal('1'), Decimal('0'), Decimal('200000')),
+            ('swap_exact_amount_out', 'ETHIX', 'ETHIX', Decimal('2'), Decimal('100'), Decimal('200000')),
+            ('swap_exact_amount_in', 'WETH', 'WETH', Decimal('1'), Decimal('1000'), Decimal('200000')),
+            ('exit_swap_pool_amount_in', None, 'UNKNOWN', Decimal('2'), Decimal('0'), None),
+        ]
+
+        def bound_pool():
+            pool = BalancerPool()
+            pool.bind('WETH', Decimal('4'), Decimal('10'))
+            pool.bind('ETHIX', Decimal('12'), Decimal('10'))
+            pool.set_swap_fee(Decimal('0.001'))
+            return pool
+
+        pool = bound_pool()
+        result = pool.apply_batch(OperationBatch(*[list(column) for column in zip(*operations)]))
+        expected = bound_pool()
+        swap_in = expected.swap_exact_amount_in('WETH', Decimal('1'), 'WETH', Decimal('0'), Decimal('200000'))
+        swap_out = expected.swap_exact_amount_out('ETHIX', Decimal('100'), 'ETHIX', Decimal('2'), Decimal('200000'))
+        self.assertEqual(result.amount[:2].tolist(), [swap_in.token_amount_out, swap_out.token_amount_in])
+        self.assertEqual(result.spot_price_after[:2].tolist(), [swap_in.spot_price_after, swap_out.spot_price_after])
+        for token in ['WETH', 'ETHIX']:
+            self.assertEqual(pool.get_balance(token), expected.get_balance(token))
+        # Errors that aren't in BATCH_ERRORS get a code of their own
+        self.assertEqual(result.errors(), [None, None, 'ERR_LIMIT_OUT', 'UNKNOWN'])
+        self.assertEqual(result.error_table[len(BATCH_ERRORS):], ['UNKNOWN'])
+
+        self.assertEqual(pool.quote_join_swap_extern_amount_in('ETHIX', Decimal('1'), Decimal('0')),
+                         pool.quote_join_swap_extern_amount_in('ETHIX', Decimal('1'), Decimal('0')))
+        self.assertEqual(pool.get_pool_token_supply(), Decimal('100'))
+
+        result = pool.swap_exact_amount_in('WETH', Decimal('2'), 'ETHIX', Decimal('0'), Decimal('200000'))
+        self.assertEqual(result, quote)
+        self.assertGreater(pool._version, version)
+        self.assertLess(pool.quote_swap_exact_amount_in('WETH', Decimal('2'), 'ETHIX', Decimal('0'), Decimal('200000')).token_amount_out,
+                        quote.token_amount_out)
+
+        # Quotes inside an open snapshot leave it open with its writes
+        snapshot = pool.snapshot()
+        pool.swap_exact_amount_in('WETH', Decimal('1'), 'ETHIX', Decimal('0'), Decimal('200000'))
+        balance = pool.get_balance('WETH')
+        for _ in range(2):
+            inside = pool.quote_swap_exact_amount_in('WETH', Decimal('1'), 'ETHIX', Decimal('0'), Decimal('200000'))
+            self.assertEqual(pool.get_balance('WETH'), balance)
+            self.assertEqual(pool._snapshots, [0])
+        pool.rollback(snapshot)
+        self.assertEqual(pool.get_balance('WETH'), Decimal('6'))
+        self.assertIsNone(pool._journal)
+        # The quote of the rolled back pool isn't served any more
+        self.assertNotEqual(pool.quote_swap_exact_amount_in('WETH', Decimal('1'), 'ETHIX', Decimal('0'), Decimal('200000')), inside)
+
+        pool.quote_cache_size = 2
+        for amount in ['0.1', '0.2', '0.3']:
+            pool.quote_swap_exact_amount_out('ETHIX', Decimal('100'), 'WETH', Decimal(amount), Decimal('200000'))
+        self.assertEqual(len(pool._quotes), 2)
+
+    def test_apply_batch(self):
+        operations = [
+            ('swap_exact_amount_in', 'WETH', 'ETHIX', Decimal('1'), Decimal('0'), Decimal('200000')),
+            ('swap_exact_amount_in', 'WETH', 'ETHIX', Decimal('0.5'), Decimal('0'), Decimal('200000')),
+            ('swap_exact_amount_out', 'ETHIX', 'WETH', Decimal('0.3'), Decimal('100'), Decimal('200000')),
+            # ERR_MAX_IN_RATIO, ERR_LIMIT_OUT, ERR_LIMIT_PRICE (after the balances would change), ERR_LIMIT_IN
+            ('swap_exact_amount_in', 'WETH', 'ETHIX', Decimal('100'), Decimal('0'), Decimal('200000')),
+            ('swap_exact_amount_in', 'WETH', 'ETHIX', Decimal('1'), Decimal('1000'), Decimal('200000')),
+            ('swap_exact_amount_in', 'WETH', 'ETHIX', Decimal('1'), Decimal('0'), Decimal('0.8')),
+            ('swap_exact_amount_out', 'ETHIX', 'WETH', Decimal('0.3'), Decimal('0.1'), Decimal('200000')),
+            ('join_swap_extern_amount_in', 'ETHIX', None, Decimal('1'), Decimal('0'), None),
+            ('exit_swap_pool_amount_in', None, 'WETH', Decimal('2'), Decimal('0'), None),
+            ('exit_swap_extern_amount_out', None, 'WETH', Decimal('0.1'), Decimal('0'), None),
+            ('swap_exact_amount_in', 'WETH', 'DAI', Decimal('1'), Decimal('0'), Decimal('200000')),
+            ('bind', 'DAI', None, Decimal('1'), Decimal('1'), None),
+        ]
+
+        def bound_pool():
+            pool = BalancerPool()
+            pool.bind('WETH', Decimal('4'), Decimal('10'))
+            pool.bind('ETHIX', Decimal('12'), Decimal('10'))
+            pool.set_swap_fee(Decimal('0.001'))
+            return pool
+
+        pool = bound_pool()
+        result = pool.apply_batch(OperationBatch(*[list(column) for column in zip(*operations)]))
+        self.assertEqual(result.errors(), [None, None, None, 'ERR_MAX_IN_RATIO', 'ERR_LIMIT_OUT', 'ERR_LIMIT_PRICE', 'ERR_LIMIT_IN', None,
+                                           None, 'ERR_LIMIT_IN', 'ERR_NOT_BOUND', 'ERR_UNKNOWN_OPERATION'])
+        self.assertEqual(result.error_code.tolist(), [BATCH_ERRORS.index(error) for error in result.errors()])
+        self.assertEqual((result.amount.dtype, result.spot_price_after.dtype), (object, object))
+
+        # The same operations one by one, a failed operation is undone like a reverted transaction
+        expected = bound_pool()
+        for n, (kind, token_in, token_out, amount, limit_amount, max_price) in enumerate(operations[:10]):
+            snapshot = expected.snapshot()
+            try:
+                if kind.startswith('swap'):
+                    swap = getattr(expected, kind)(token_in, amount if kind == 'swap_exact_amount_in' else limit_amount, token_out,
+                                                   limit_amount if kind == 'swap_exact_amount_in' else amount, max_price)
+                    self.assertEqual(result.amount[n], getattr(swap, 'token_amount_out', None) or swap.token_amount_in)
+                    self.assertEqual(result.spot_price_after[n], swap.spot_price_after)
+                else:
+                    self.assertEqual(result.amount[n], getattr(expected, kind)(token_in or token_out, amount, limit_amount))
+                expected.commit()
+            except Exception as e:
+                self.assertEqual(result.errors()[n], e.args[0])
+                self.assertIsNone(result.amount[n])
+                expected.rollback(snapshot)
+        for token in ['WETH', 'ETHIX']:
+            self.assertEqual(pool.get_balance(token), expected.get_balance(token))
+        self.assertEqual(pool.get_pool_token_supply(), expected.get_pool_token_supply())
+
+        # A batch inside a snapshot of the caller can still be rolled back as a whole
+        pool = bound_pool()
+        snapshot = pool.snapshot()
+        pool.apply_batch(OperationBatch(*[list(column) for column in zip(*operations)]))
+        self.assertEqual(pool._snapshots, [0])
+        pool.rollback(snapshot)
+        self.assertEqual(pool.get_balance('WETH'), Decimal('4'))
+        self.assertEqual(pool.get_balance('ETHIX'), Decimal('12'))
+
+    def test_apply_batch_same_token_swaps(self):
+        operations = [
+            ('swap_exact_amount_in', 'WETH', 'WETH', Decimal('1'), Decimal('0'), Decimal('200000')),
+            ('swap_exact_amount_out', 'ETHIX', 'ETHIX', Decimal('2'), Decimal('100'), Decimal('200000')),
+            ('swap_exact_amount_in', 'WETH', 'WETH', Decimal('1'), Decimal('1000'), Decimal('200000')),
+            ('exit_swap_pool_amount_in', None, 'UNKNOWN', Decimal('2'), Decimal('0'), None),
+        ]
+
+        def bound_pool():
+            pool = BalancerPool()
+            pool.bind('WETH', Decimal('4'), Decimal('10'))
+            pool.bind('ETHIX', Decimal('12'), Decimal('10'))
+            pool.set_swap_fee(Decimal('0.001'))
+            return pool
+
+        pool = bound_pool()
+        result = pool.apply_batch(OperationBatch(*[list(column) for column in zip(*operations)]))
+        expected = bound_pool()
+        swap_in = expected.swap_exact_amount_in('WETH', Decimal('1'), 'WETH', Decimal('0'), Decimal('200000'))
+        swap_out = expected.swap_exact_amount_out('ETHIX', Decimal('100'), 'ETHIX', Decimal('2'), Decimal('200000'))
+        self.assertEqual(result.amount[:2].tolist(), [swap_in.token_amount_out, swap_out.token_amount_in])
+        self.assertEqual(result.spot_price_after[:2].tolist(), [swap_in.spot_price_after, swap_out.spot_price_after])
+        for token in ['WETH', 'ETHIX']:
+            self.assertEqual(pool.get_balance(token), expected.get_balance(token))
+        # Errors that aren't in BATCH_ERRORS get a code of their own
+        self.assertEqual(result.errors(), [None, None, 'ERR_LIMIT_OUT', 'UNKNOWN'])
+        self.assertEqual(result.error_table[len(BATCH_ERRORS):], ['UNKNOWN'])
+        self.assertEqual(pool.get_pool_token_supply(), Decimal('100'))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,193 @@
+import json
+import os
+import tempfile
+import unittest
+
+import pandas as pd
+from cadCAD.configuration.utils import config_sim
+
+from model.checkpoints import Checkpointer, initial_state_digest
+from model.genesis_states import generate_initial_state
+from model.partial_state_update_block import generate_partial_state_update_blocks
+from model.parts.system_policies import find_action_decoder
+from model.parts.utils import post_processing
+from model.replay_engine import simulate
+from model.sim_runner import run, SimulationEngine
+
+INITIAL_STATE_JSON = os.path.join(os.path.dirname(__file__), '..', 'data',
+                                  '0x8b6e6e7b5b3801fed2cafd4b22b8a16c2f2db21a-initial_pool_states-prices.json')
+ACTIONS_JSON = os.path.join(os.path.dirname(__file__), 'data', '0x8b6e6e7b5b3801fed2cafd4b22b8a16c2f2db21a-actions-sample.json')
+
+
+class Crash(Exception):
+    pass
+
+
+class TestCheckpoints(unittest.TestCase):
+    def setUp(self):
+        self.initial_values = generate_initial_state(initial_values_json=INITIAL_STATE_JSON, spot_price_base_currency='DAI')
+        result = generate_partial_state_update_blocks(ACTIONS_JSON)
+        self.partial_state_update_blocks = result['partial_state_update_blocks']
+        self.time_seq = range(result['steps_number'] - 1)
+        self.params = {'spot_price_reference': 'DAI', 'decoding_type': 'SIMPLIFIED'}
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def assert_same_records(self, expected, actual):
+        object_columns = ['pool', 'token_prices', 'spot_prices', 'generated_fees']
+        pd.testing.assert_frame_equal(post_processing(pd.DataFrame(expected)).drop(columns=object_columns),
+                                      post_processing(pd.DataFrame(actual)).drop(columns=object_columns))
+
+    def test_resume_after_crash(self):
+        expected = simulate(self.initial_values, self.partial_state_update_blocks, self.params, self.time_seq)
+
+        # Stop the first attempt at timestep 7, the latest checkpoint is then the one of timestep 6
+        def crash_at_7(params, substep, history, previous_state, policy_input):
+            if previous_state['timestep'] == 7:
+                raise Crash()
+            return 'action_type', policy_input['action_type']
+        crashing_blocks = [dict(block, variables=dict(block['variables'], action_type=crash_at_7)) for block in
+                           self.partial_state_update_blocks]
+        with self.assertRaises(Crash):
+            simulate(self.initial_values, crashing_blocks, self.params, self.time_seq, checkpointer=Checkpointer(self.directory.name, 3))
+        checkpoint = Checkpointer(self.directory.name, 3).load_checkpoint(0, 1)
+        self.assertEqual(checkpoint['state']['timestep'], 6)
+        self.assertEqual(checkpoint['tape_offset'], 7)
+        self.assertFalse(checkpoint['done'])
+
+        actual = simulate(self.initial_values, self.partial_state_update_blocks, self.params, self.time_seq,
+                          checkpointer=Checkpointer(self.directory.name, 3))
+        self.assert_same_records(expected, actual)
+
+        # A finished run is read back without simulating
+        finished = simulate(self.initial_values, crashing_blocks, self.params, self.time_seq,
+                            checkpointer=Checkpointer(self.directory.name, 3))
+        self.assert_same_records(expected, finished)
+
+    def test_interval_dividing_the_run_length(self):
+        self.assertEqual(len(self.time_seq) % 13, 0)
+        checkpointer = Checkpointer(self.directory.name, 13)
+        simulate(self.initial_values, self.partial_state_update_blocks, self.params, self.time_seq, checkpointer=checkpointer)
+        checkpointer = Checkpointer(self.directory.name, 13)
+        _, done = checkpointer.resume(0, 1, self.params, find_action_decoder(self.partial_state_update_blocks),
+                                      initial_state_digest(self.initial_values))
+        self.assertTrue(done)
+        self.assertEqual(len(checkpointer.read_records(0, 1)), len(self.time_seq) + 1)
+
+    def test_run_with_checkpoints(self):
+        sim_configs = config_sim({'N': 2, 'T': self.time_seq, 'M': {'spot_price_reference': ['DAI'], 'decoding_type': ['SIMPLIFIED']}})
+        df = run(self.initial_values, self.partial_state_update_blocks, sim_configs, engine=SimulationEngine.replay.value,
+                 checkpointer=Checkpointer(self.directory.name, 5))
+        self.assertEqual(sorted(os.listdir(self.directory.name)), ['subset-0-run-1', 'subset-0-run-2'])
+        resumed = run(self.initial_values, self.partial_state_update_blocks, sim_configs, engine=SimulationEngine.replay.value,
+                      checkpointer=Checkpointer(self.directory.name, 5))
+        self.assert_same_records(df, resumed)
+
+    def write_tape(self, actions: list) -> str:
+        path = os.path.join(self.directory.name, f'actions-{len(actions)}.json')
+        with open(path, 'w') as f:
+            json.dump(actions, f)
+        return path
+
+    def simulate_tape(self, path: str, checkpointer: Checkpointer = None, counter: list = None, initial_values: dict = None):
+        partial_state_update_blocks = generate_partial_state_update_blocks(path)['partial_state_update_blocks']
+        if counter is not None:
+            def count_action_type(params, substep, history, previous_state, policy_input):
+                counter.append(previous_state['timestep'])
+                return 'action_type', policy_input['action_type']
+            partial_state_update_blocks = [dict(block, variables=dict(block['variables'], action_type=count_action_type))
+                                           for block in partial_state_update_blocks]
+        steps_number = len(json.load(open(path))) - 1
+        initial_values = self.initial_values if initial_values is None else initial_values
+        return simulate(initial_values, partial_state_update_blocks, self.params, range(steps_number - 1), checkpointer=checkpointer)
+
+    def test_extended_tape_continues_from_final_state(self):
+        with open(ACTIONS_JSON) as f:
+            actions = json.load(f)
+        expected = self.simulate_tape(ACTIONS_JSON)
+
+        self.simulate_tape(self.write_tape(actions[:9]), Checkpointer(self.directory.name, 4))
+        played = []
+        actual = self.simulate_tape(self.write_tape(actions), Checkpointer(self.directory.name, 4), played)
+        self.assert_same_records(expected, actual)
+        # Timesteps 0..6 played the 7 actions after pool creation that both tapes have in common
+        self.assertEqual(played, list(range(7, len(actions) - 2)))
+
+    def test_resume_without_loading_records(self):
+        with open(ACTIONS_JSON) as f:
+            actions = json.load(f)
+        expected = self.simulate_tape(ACTIONS_JSON)
+        self.simulate_tape(self.write_tape(actions[:9]), Checkpointer(self.directory.name, 4))
+        actual = self.simulate_tape(self.write_tape(actions), Checkpointer(self.directory.name, 4, load_records=False))
+        # Only the rows after the final state of the shorter tape, the earlier ones are still in the chunks
+        self.assertEqual([state['timestep'] for state in actual], list(range(8, len(actions) - 1)))
+        self.assert_same_records(expected[8:], actual)
+        self.assert_same_records(expected, Checkpointer(self.directory.name, 4).read_records(0, 1))
+
+    def test_prefix_digest_ignores_later_actions(self):
+        with open(ACTIONS_JSON) as f:
+            actions = json.load(f)
+        # The first two entries have neither the columns nor the dtypes the later actions add to the parsed tape
+        short = find_action_decoder(generate_partial_state_update_blocks(self.write_tape(actions[:2]))['partial_state_update_blocks'])
+        full = find_action_decoder(generate_partial_state_update_blocks(ACTIONS_JSON)['partial_state_update_blocks'])
+        self.assertEqual(short.prefix_digest(1), full.prefix_digest(1))
+        self.assertIsNone(short.prefix_digest(2))
+        self.assertNotEqual(full.prefix_digest(1), full.prefix_digest(2))
+
+    def test_changed_tape_is_simulated_from_the_start(self):
+        with open(ACTIONS_JSON) as f:
+            actions = json.load(f)
+        self.simulate_tape(ACTIONS_JSON, Checkpointer(self.directory.name, 4))
+
+        actions[2]['action']['token_in']['amount'] = '1000'
+        played = []
+        self.simulate_tape(self.write_tape(actions), Checkpointer(self.directory.name, 4), played)
+        self.assertEqual(played, list(range(len(actions) - 2)))
+
+    def test_changed_initial_state_is_simulated_from_the_start(self):
+        self.simulate_tape(ACTIONS_JSON, Checkpointer(self.directory.name, 4))
+        played = []
+        self.simulate_tape(ACTIONS_JSON, Checkpointer(self.directory.name, 4), played)
+        self.assertEqual(played, [])
+
+        pool = dict(self.initial_values['pool'], tokens=dict(self.initial_values['pool']['tokens']))
+        pool['tokens']['DAI'] = pool['tokens']['DAI'].replace(balance=pool['tokens']['DAI'].balance * 2)
+        changes = [{'pool': pool}, {'pool': dict(pool, swap_fee=self.initial_values['pool']['swap_fee'] * 2)},
+                   {'token_prices': {**self.initial_values['token_prices'], 'WETH': 1.0}}]
+        for change in changes:
+            initial_values = {**self.initial_values, **change}
+            played = []
+            expected = self.simulate_tape(ACTIONS_JSON, initial_values=initial_values)
+            actual = self.simulate_tape(ACTIONS_JSON, Checkpointer(self.directory.name, 4), played, initial_values)
+            self.assertEqual(played, list(range(len(expected) - 1)))
+            self.assert_same_records(expected, actual)
+
+    def test_checkpoints_with_compaction(self):
+        full = simulate(self.initial_values, self.partial_state_update_blocks, self.params, self.time_seq)
+        compacted = simulate(self.initial_values, self.partial_state_update_blocks, self.params, self.time_seq, compaction=1000)
+        saved = []
+
+        class RecordingCheckpointer(Checkpointer):
+            def save(self, subset, run, state, records, *args, **kwargs):
+                saved.append(state)
+                super().save(subset, run, state, records, *args, **kwargs)
+
+        # The rows of timesteps 4 and 8 are price updates that compaction folds, the checkpoints due there are still made
+        self.assertEqual([full[timestep]['action_type'] for timestep in [4, 8]], ['external_price_update'] * 2)
+        self.assertNotIn(4, [state['timestep'] for state in compacted])
+        checkpointed = simulate(self.initial_values, self.partial_state_update_blocks, self.params, self.time_seq,
+                                checkpointer=RecordingCheckpointer(self.directory.name, 2), compaction=1000)
+        self.assert_same_records(compacted, checkpointed)
+        self.assertEqual([state['timestep'] for state in saved], list(range(2, len(self.time_seq) + 1, 2)) + [len(self.time_seq)])
+        # Every checkpoint has the state of its timestep without compaction
+        for state in saved:
+            self.assertEqual(state['pool'], full[state['timestep']]['pool'])
+            self.assertEqual(state['token_prices'], full[state['timestep']]['token_prices'])
+
+        resumed = simulate(self.initial_values, self.partial_state_update_blocks, self.params, self.time_seq,
+                           checkpointer=Checkpointer(self.directory.name, 2), compaction=1000)
+        self.assert_same_records(compacted, resumed)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import gc
+import unittest
+from decimal import Decimal
+
+from model.balancer_pool import BalancerPool
+from model.compact_balancer_pool import CompactBalancerPool, _layouts
+
+
+def bound_pools():
+    pools = BalancerPool(), CompactBalancerPool()
+    for pool in pools:
+        pool.bind('WETH', Decimal('40'), Decimal('10'))
+        pool.bind('DAI', Decimal('12000'), Decimal('10'))
+        pool.bind('BAL', Decimal('700'), Decimal('5'))
+        pool.set_swap_fee(Decimal('0.003'))
+    return pools
+
+
+class TestCompactBalancerPool(unittest.TestCase):
+    def assert_same_state(self, pool: BalancerPool, compact: CompactBalancerPool):
+        self.assertEqual(compact.tokens(), list(pool._records))
+        for token in pool._records:
+            self.assertEqual(compact.get_balance(token), pool.get_balance(token))
+            self.assertEqual(compact.get_denorm_weight(token), pool.get_denorm_weight(token))
+        self.assertEqual(compact.get_total_denorm_weight(), pool.get_total_denorm_weight())
+        self.assertEqual(compact.get_pool_token_supply(), pool.get_pool_token_supply())
+
+    def test_same_results_as_balancer_pool(self):
+        pool, compact = bound_pools()
+        operations = [
+            ('swap_exact_amount_in', dict(token_in='DAI', token_amount_in=Decimal('500'), token_out='WETH', min_amount_out=Decimal('0'),
+                                          max_price=Decimal('1000'))),
+            ('swap_exact_amount_out', dict(token_in='WETH', max_amount_in=Decimal('10'), token_out='BAL', token_amount_out=Decimal('20'),
+                                           max_price=Decimal('1000'))),
+            ('join_pool', dict(pool_amount_out=Decimal('5'), max_amounts_in={'WETH': Decimal('Infinity'), 'DAI': Decimal('Infinity'),
+                                                                             'BAL': Decimal('Infinity')})),
+            ('join_swap_extern_amount_in', dict(token_in='BAL', token_amount_in=Decimal('30'), min_pool_amount_out=Decimal('0'))),
+            ('join_swap_pool_amount_out', dict(token_in='DAI', pool_amount_out=Decimal('2'), max_amount_in=Decimal('100000'))),
+            ('exit_swap_pool_amount_in', dict(token_out='WETH', pool_amount_in=Decimal('3'), min_amount_out=Decimal('0'))),
+            ('exit_swap_extern_amount_out', dict(token_out='DAI', token_amount_out=Decimal('100'), max_pool_amount_in=Decimal('100'))),
+            ('exit_pool', dict(pool_amount_in=Decimal('10'), min_amounts_out={'WETH': Decimal('0'), 'DAI': Decimal('0'), 'BAL': Decimal('0')})),
+        ]
+        for method, kwargs in operations:
+            self.assertEqual(getattr(compact, method)(**kwargs), getattr(pool, method)(**kwargs), method)
+            self.assert_same_state(pool, compact)
+        self.assertEqual(compact.get_spot_price('DAI', 'WETH'), pool.get_spot_price('DAI', 'WETH'))
+        self.assertEqual(compact.get_spot_price_sans_fee('BAL', 'DAI'), pool.get_spot_price_sans_fee('BAL', 'DAI'))
+        self.assertEqual(compact.get_normal_weight('BAL'), pool.get_normal_weight('BAL'))
+
+    def test_errors(self):
+        pool, compact = bound_pools()
+        with self.assertRaisesRegex(Exception, 'ERR_IS_BOUND'):
+            compact.bind('DAI', Decimal('1'), Decimal('1'))
+        with self.assertRaisesRegex(Exception, 'ERR_MAX_IN_RATIO'):
+            compact.swap_exact_amount_in('WETH', Decimal('30'), 'DAI', Decimal('0'), Decimal('Infinity'))
+        with self.assertRaisesRegex(Exception, 'ERR_LIMIT_OUT'):
+            compact.swap_exact_amount_in('WETH', Decimal('1'), 'DAI', Decimal('1000'), Decimal('Infinity'))
+        # A failed swap leaves the pool as it was
+        self.assert_same_state(pool, compact)
+
+    def test_unbind_moves_the_last_token(self):
+        pool, compact = bound_pools()
+        self.assertEqual(compact.unbind('WETH'), pool.unbind('WETH'))
+        self.assertEqual(compact.token_id('BAL'), 0)
+        self.assertEqual(compact.token_id('DAI'), 1)
+        self.assertEqual(compact.get_balance('WETH'), 0)
+        self.assertEqual(compact.tokens(), ['BAL', 'DAI'])
+        self.assertEqual(compact.get_total_denorm_weight(), pool.get_total_denorm_weight())
+        with self.assertRaisesRegex(Exception, 'ERR_NOT_BOUND'):
+            compact.unbind('WETH')
+
+    def test_no_instance_dict(self):
+        _, compact = bound_pools()
+        self.assertFalse(hasattr(compact, '__dict__'))
+
+    def test_pools_with_the_same_tokens_share_their_layout(self):
+        _, first = bound_pools()
+        _, second = bound_pools()
+        self.assertIs(first._layout, second._layout)
+        second.unbind('BAL')
+        self.assertIsNot(first._layout, second._layout)
+        self.assertEqual(first.tokens(), ['WETH', 'DAI', 'BAL'])
+        self.assertEqual(first.token_id('BAL'), 2)
+
+    def test_unused_layouts_are_dropped(self):
+        pool = CompactBalancerPool()
+        pool.bind('UNUSED_A', Decimal('40'), Decimal('10'))
+        pool.bind('UNUSED_B', Decimal('40'), Decimal('10'))
+        self.assertIn(('UNUSED_A', 'UNUSED_B'), _layouts)
+        del pool
+        gc.collect()
+        self.assertNotIn(('UNUSED_A',), _layouts)
+        self.assertNotIn(('UNUSED_A', 'UNUSED_B'), _layouts)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+import json
+import os
+import tempfile
+import unittest
+from decimal import Decimal
+
+import pandas as pd
+
+from model.genesis_states import generate_initial_state
+from model.keyframes import KeyframeIndex, simulate_window, window_timesteps
+from model.partial_state_update_block import generate_partial_state_update_blocks
+from model.parts.system_policies import find_action_decoder
+from model.parts.utils import post_processing
+from model.replay_engine import simulate
+
+INITIAL_STATE_JSON = os.path.join(os.path.dirname(__file__), '..', 'data',
+                                  '0x8b6e6e7b5b3801fed2cafd4b22b8a16c2f2db21a-initial_pool_states-prices.json')
+ACTIONS_JSON = os.path.join(os.path.dirname(__file__), 'data', '0x8b6e6e7b5b3801fed2cafd4b22b8a16c2f2db21a-actions-sample.json')
+
+
+class TestKeyframes(unittest.TestCase):
+    def setUp(self):
+        self.initial_values = generate_initial_state(initial_values_json=INITIAL_STATE_JSON, spot_price_base_currency='DAI')
+        result = generate_partial_state_update_blocks(ACTIONS_JSON)
+        self.partial_state_update_blocks = result['partial_state_update_blocks']
+        self.time_seq = range(result['steps_number'] - 1)
+        self.index = KeyframeIndex.build(self.initial_values, self.partial_state_update_blocks, {'spot_price_reference': 'DAI'},
+                                         interval=4)
+
+    def full_run(self, decoding_type: str) -> pd.DataFrame:
+        params = {'spot_price_reference': 'DAI', 'decoding_type': decoding_type}
+        return pd.DataFrame(simulate(self.initial_values, self.partial_state_update_blocks, params, self.time_seq))
+
+    def assert_same_rows(self, expected: pd.DataFrame, actual: pd.DataFrame):
+        object_columns = ['pool', 'token_prices', 'spot_prices', 'generated_fees']
+        # The first row of a window comes from a keyframe, recorded as the initial state of the run
+        pd.testing.assert_frame_equal(post_processing(expected).drop(columns=object_columns + ['substep']).reset_index(drop=True),
+                                      post_processing(actual).drop(columns=object_columns + ['substep']).reset_index(drop=True))
+
+    def test_keyframes(self):
+        self.assertEqual(sorted(self.index.keyframes), [0, 4, 8, 12])
+        self.assertEqual(self.index.nearest(7)['timestep'], 4)
+        self.assertEqual(self.index.nearest(8)['timestep'], 8)
+        self.assertEqual(self.index.nearest(100)['timestep'], 12)
+
+    def test_keyframes_have_the_recorded_balances(self):
+        with open(ACTIONS_JSON) as f:
+            actions = [entry['action'] for entry in json.load(f)]
+        pool = self.initial_values['pool']
+        balances = {symbol: token.balance for symbol, token in pool['tokens'].items()}
+        pool_shares = Decimal(pool['pool_shares'])
+        # The keyframe of timestep t is the state after the first t actions of the tape, with the amounts recorded on it
+        for timestep, action in enumerate(actions[1:13], start=1):
+            for token in action.get('tokens_in', [action['token_in']] if 'token_in' in action else []):
+                balances[token['symbol']] += Decimal(token['amount'])
+            if 'token_out' in action:
+                balances[action['token_out']['symbol']] -= Decimal(action['token_out']['amount'])
+            pool_shares += Decimal(action.get('pool_amount_out', '0')) - Decimal(action.get('pool_amount_in', '0'))
+            if timestep in self.index.keyframes:
+                keyframe = self.index.keyframes[timestep]['pool']
+                self.assertEqual({symbol: token.balance for symbol, token in keyframe['tokens'].items()}, balances)
+                self.assertEqual(keyframe['pool_shares'], pool_shares)
+
+    def test_window_matches_full_replay_output_run(self):
+        full = self.full_run('REPLAY_OUTPUT')
+        params = {'spot_price_reference': 'DAI', 'decoding_type': 'REPLAY_OUTPUT'}
+        for start, end in [(0, 12), (5, 9), (8, 8)]:
+            window = simulate_window(self.index, self.partial_state_update_blocks, params, start, end)
+            self.assertEqual(window['timestep'].tolist(), list(range(start, end + 2)))
+            self.assert_same_rows(full[full['timestep'].between(start, end + 1)], window)
+
+    def test_window_in_simplified_mode_starts_from_keyframe(self):
+        params = {'spot_price_reference': 'DAI', 'decoding_type': 'SIMPLIFIED'}
+        window = simulate_window(self.index, self.partial_state_update_blocks, params, 4, 9)
+        self.assertIs(window['pool'].iloc[0], self.index.keyframes[4]['pool'])
+        expected = pd.DataFrame(simulate(self.index.keyframes[4], self.partial_state_update_blocks, params, range(4, 10)))
+        self.assert_same_rows(expected, window)
+
+    def test_window_timesteps(self):
+        action_decoder = find_action_decoder(self.partial_state_update_blocks)
+        self.assertEqual(window_timesteps(action_decoder, 3, 5), range(3, 6))
+        self.assertEqual(window_timesteps(action_decoder, '2020-12-07 14:09:14+00:00', '2020-12-07 14:37:14+00:00', by='timestamp'), range(4, 9))
+        # Naive timestamps are taken as UTC
+        self.assertEqual(window_timesteps(action_decoder, '2020-12-07 14:05', '2020-12-07 14:40', by='timestamp'), range(4, 9))
+        # Price updates between the blocks are included
+        self.assertEqual(window_timesteps(action_decoder, 1005, 1010, by='block_number'), range(5, 11))
+        with self.assertRaises(Exception):
+            window_timesteps(action_decoder, 2000, 3000, by='block_number')
+
+    def test_index_is_tied_to_its_tape(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'keyframes.pickle')
+            self.index.save(path)
+            index = KeyframeIndex.load(path)
+            self.assertEqual(sorted(index.keyframes), [0, 4, 8, 12])
+
+            with open(ACTIONS_JSON) as f:
+                actions = json.load(f)
+            actions[1]['action']['tokens'] = {'WETH': 600.0, 'DAI': 1.0}
+            other_tape = os.path.join(directory, 'actions.json')
+            with open(other_tape, 'w') as f:
+                json.dump(actions, f)
+            other_blocks = generate_partial_state_update_blocks(other_tape)['partial_state_update_blocks']
+            with self.assertRaisesRegex(Exception, 'another tape'):
+                simulate_window(index, other_blocks, {'spot_price_reference': 'DAI', 'decoding_type': 'SIMPLIFIED'}, 4, 9)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import os
+import tempfile
+import unittest
+
+import pandas as pd
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from cadCAD.configuration.utils import config_sim
+
+from model.genesis_states import generate_initial_state
+from model.output_sink import OutputSink, read_output
+from model.partial_state_update_block import generate_partial_state_update_blocks
+from model.sim_runner import run, run_sweep, SimulationEngine
+
+INITIAL_STATE_JSON = os.path.join(os.path.dirname(__file__), '..', 'data',
+                                  '0x8b6e6e7b5b3801fed2cafd4b22b8a16c2f2db21a-initial_pool_states-prices.json')
+ACTIONS_JSON = os.path.join(os.path.dirname(__file__), 'data', '0x8b6e6e7b5b3801fed2cafd4b22b8a16c2f2db21a-actions-sample.json')
+
+
+class TestOutputSink(unittest.TestCase):
+    def setUp(self):
+        self.initial_values = generate_initial_state(initial_values_json=INITIAL_STATE_JSON, spot_price_base_currency='DAI')
+        result = generate_partial_state_update_blocks(ACTIONS_JSON)
+        self.partial_state_update_blocks = result['partial_state_update_blocks']
+        self.sim_configs = config_sim({
+            'N': 2,
+            'T': range(result['steps_number'] - 1),
+            'M': {'spot_price_reference': ['DAI'], 'decoding_type': ['SIMPLIFIED']}
+        })
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def expected(self) -> pd.DataFrame:
+        return run(self.initial_values, self.partial_state_update_blocks, self.sim_configs, engine=SimulationEngine.replay.value,
+                   columnar=True)
+
+    def assert_same_rows(self, expected: pd.DataFrame, actual: pd.DataFrame):
+        actual = actual.astype({'subset': 'int64', 'run': 'int64'}).sort_values(['subset', 'run', 'timestep', 'substep'])
+        pd.testing.assert_frame_equal(expected.reset_index(drop=True), actual[expected.columns].reset_index(drop=True),
+                                      check_dtype=False)
+
+    def test_streams_row_groups_per_run(self):
+        for file_format in ['parquet', 'arrow']:
+            directory = os.path.join(self.directory.name, file_format)
+            sink = OutputSink.from_initial_state(directory, self.initial_values, row_group_size=4, file_format=file_format)
+            df = run(self.initial_values, self.partial_state_update_blocks, self.sim_configs, engine=SimulationEngine.replay.value,
+                     sink=sink)
+            self.assertIsNone(df)
+            self.assertEqual(sorted(os.listdir(os.path.join(directory, 'subset=0'))), ['run=1', 'run=2'])
+            self.assert_same_rows(self.expected(), read_output(directory, file_format=file_format))
+
+        # 14 rows per run in groups of at most 4
+        metadata = pq.ParquetFile(os.path.join(self.directory.name, 'parquet', 'subset=0', 'run=1', 'part-0.parquet')).metadata
+        self.assertEqual(metadata.num_rows, 14)
+        self.assertEqual(metadata.num_row_groups, 4)
+
+    def test_read_output_columns_and_filter(self):
+        sink = OutputSink.from_initial_state(self.directory.name, self.initial_values, row_group_size=4)
+        run(self.initial_values, self.partial_state_update_blocks, self.sim_configs, engine=SimulationEngine.replay.value, sink=sink)
+        df = read_output(self.directory.name, columns=['timestep', 'token_dai_balance'], filter=ds.field('run') == 2)
+        self.assertEqual(list(df.columns), ['timestep', 'token_dai_balance'])
+        expected = self.expected()
+        expected = expected[expected['run'] == 2]
+        self.assertEqual(df['token_dai_balance'].tolist(), expected['token_dai_balance'].tolist())
+
+    def test_sweep_to_output_directory(self):
+        self.assertIsNone(run_sweep(self.initial_values, ACTIONS_JSON, self.sim_configs, processes=2,
+                                    output_directory=self.directory.name, row_group_size=5))
+        self.assert_same_rows(self.expected(), read_output(self.directory.name))
+
+    def test_sink_requires_replay_engine(self):
+        sink = OutputSink.from_initial_state(self.directory.name, self.initial_values)
+        with self.assertRaises(Exception):
+            run(self.initial_values, self.partial_state_update_blocks, self.sim_configs, engine=SimulationEngine.cadcad.value,
+                sink=sink)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+import copy
+import unittest
+from decimal import Decimal
+
+from model.balancer_pool import BalancerPool
+from model.compact_balancer_pool import CompactBalancerPool
+from model.pool_registry import PoolRegistry
+
+
+def make_pool(tokens: dict, swap_fee: str = '0.003', pool_class=BalancerPool):
+    pool = pool_class()
+    for token, (balance, denorm) in tokens.items():
+        pool.bind(token, Decimal(balance), Decimal(denorm))
+    pool.set_swap_fee(Decimal(swap_fee))
+    return pool
+
+
+class TestPoolRegistry(unittest.TestCase):
+    def test_pair_index(self):
+        registry = PoolRegistry()
+        registry.add('a', make_pool({'WETH': ('10', '10'), 'DAI': ('20000', '10')}))
+        registry.add('b', make_pool({'WETH': ('5', '10'), 'DAI': ('10000', '10'), 'BAL': ('1000', '10')},
+                                    pool_class=CompactBalancerPool))
+        self.assertEqual(registry.pools_for_pair('WETH', 'DAI'), ['a', 'b'])
+        self.assertEqual(registry.pools_for_pair('DAI', 'BAL'), ['b'])
+        with self.assertRaises(Exception):
+            registry.add('a', make_pool({'WETH': ('1', '1'), 'DAI': ('1', '1')}))
+
+        registry.pools['a'].bind('BAL', Decimal('100'), Decimal('10'))
+        registry.reindex('a')
+        self.assertEqual(registry.pools_for_pair('BAL', 'WETH'), ['b', 'a'])
+
+        registry.remove('b')
+        self.assertEqual(registry.pools_for_pair('WETH', 'DAI'), ['a'])
+        registry.remove('a')
+        self.assertEqual(registry._pair_pools, {})
+        self.assertEqual(registry._neighbours, {})
+
+    def test_split_across_pools(self):
+        registry = PoolRegistry()
+        registry.add('a', make_pool({'WETH': ('10', '10'), 'DAI': ('20000', '10')}))
+        registry.add('b', make_pool({'WETH': ('10', '10'), 'DAI': ('20000', '10')}))
+        route = registry.route('DAI', 'WETH', Decimal('2000'))
+        self.assertEqual([leg.amount_in for leg in route.legs], [Decimal('1000'), Decimal('1000')])
+        single = registry.pools['a'].quote_swap_exact_amount_in('DAI', Decimal('2000'), 'WETH', Decimal('0'), Decimal('Infinity'))
+        self.assertGreater(route.amount_out, single.token_amount_out)
+        # Quoting leaves the pools as they were
+        self.assertEqual(registry.pools['a'].get_balance('DAI'), Decimal('20000'))
+
+    def test_multi_hop(self):
+        registry = PoolRegistry()
+        registry.add('dai-weth', make_pool({'DAI': ('20000', '10'), 'WETH': ('10', '10')}))
+        registry.add('weth-bal', make_pool({'WETH': ('10', '10'), 'BAL': ('1000', '10')}))
+        registry.add('bal-uni', make_pool({'BAL': ('1000', '10'), 'UNI': ('500', '10')}))
+        expected = copy.deepcopy(registry.pools)
+
+        route = registry.route('DAI', 'UNI', Decimal('100'))
+        self.assertEqual(len(route.legs), 1)
+        self.assertEqual(route.legs[0].hops, [('dai-weth', 'DAI', 'WETH'), ('weth-bal', 'WETH', 'BAL'), ('bal-uni', 'BAL', 'UNI')])
+        # The same trade done hop by hop on copies of the pools, one slice at a time
+        amount_out = Decimal('0')
+        for _ in range(10):
+            amount = Decimal('10')
+            for pool_id, token_in, token_out in route.legs[0].hops:
+                amount = expected[pool_id].swap_exact_amount_in(token_in, amount, token_out, Decimal('0'), Decimal('Infinity')).token_amount_out
+            amount_out += amount
+        self.assertEqual(route.amount_out, amount_out)
+
+        self.assertEqual(registry.candidate_paths('DAI', 'UNI', max_hops=2), [])
+        with self.assertRaisesRegex(Exception, 'ERR_NO_ROUTE'):
+            registry.route('DAI', 'UNI', Decimal('100'), max_hops=2)
+
+    def test_direct_and_multi_hop_paths_are_split(self):
+        registry = PoolRegistry()
+        registry.add('dai-bal', make_pool({'DAI': ('1000', '10'), 'BAL': ('100', '10')}))
+        registry.add('dai-weth', make_pool({'DAI': ('200000', '10'), 'WETH': ('100', '10')}))
+        registry.add('weth-bal', make_pool({'WETH': ('100', '10'), 'BAL': ('10000', '10')}))
+        route = registry.route('DAI', 'BAL', Decimal('1000'), parts=20)
+        self.assertEqual({tuple(pool_id for pool_id, _, _ in leg.hops) for leg in route.legs}, {('dai-bal',), ('dai-weth', 'weth-bal')})
+        self.assertEqual(sum(leg.amount_in for leg in route.legs), Decimal('1000'))
+        direct = registry.pools['dai-bal'].quote_swap_exact_amount_in('DAI', Decimal('400'), 'BAL', Decimal('0'), Decimal('Infinity'))
+        self.assertGreater(route.amount_out, direct.token_amount_out)
+
+    def test_pools_of_a_hop_share_a_large_order(self):
+        registry = PoolRegistry()
+        registry.add('dai-weth', make_pool({'DAI': ('2000000', '10'), 'WETH': ('1000', '10')}))
+        registry.add('weth-bal-1', make_pool({'WETH': ('10', '10'), 'BAL': ('1000', '10')}))
+        registry.add('weth-bal-2', make_pool({'WETH': ('10', '10'), 'BAL': ('1000', '10')}))
+        route = registry.route('DAI', 'BAL', Decimal('4000'))
+        self.assertEqual([leg.hops for leg in route.legs], [[('dai-weth', 'DAI', 'WETH'), ('weth-bal-1', 'WETH', 'BAL')],
+                                                            [('dai-weth', 'DAI', 'WETH'), ('weth-bal-2', 'WETH', 'BAL')]])
+        self.assertEqual([leg.amount_in for leg in route.legs], [Decimal('2000'), Decimal('2000')])
+        # More out than through the first pool alone
+        single = PoolRegistry()
+        single.add('dai-weth', make_pool({'DAI': ('2000000', '10'), 'WETH': ('1000', '10')}))
+        single.add('weth-bal-1', make_pool({'WETH': ('10', '10'), 'BAL': ('1000', '10')}))
+        self.assertGreater(route.amount_out, single.route('DAI', 'BAL', Decimal('4000')).amount_out)
+
+    def test_legs_add_up_to_amount_in(self):
+        registry = PoolRegistry()
+        registry.add('a', make_pool({'WETH': ('10', '10'), 'DAI': ('20000', '10')}))
+        registry.add('b', make_pool({'WETH': ('10', '10'), 'DAI': ('20000', '10')}))
+        # 100 / 3 doesn't divide exactly, the last slice takes the remainder
+        route = registry.route('DAI', 'WETH', Decimal('100'), parts=3)
+        self.assertEqual(sum(leg.amount_in for leg in route.legs), Decimal('100'))
+        self.assertEqual(route.amount_out, sum(leg.amount_out for leg in route.legs))
+
+    def test_candidate_paths_are_cached_per_pair(self):
+        registry = PoolRegistry()
+        registry.add('dai-weth', make_pool({'DAI': ('20000', '10'), 'WETH': ('10', '10')}))
+        registry.add('weth-bal', make_pool({'WETH': ('10', '10'), 'BAL': ('1000', '10')}))
+        paths = registry._candidate_paths('DAI', 'BAL', 3)
+        self.assertIs(registry._candidate_paths('DAI', 'BAL', 3), paths)
+        first = registry.route('DAI', 'BAL', Decimal('100'))
+
+        # Trades outside the registry are seen by the next route
+        registry.pools['weth-bal'].swap_exact_amount_in('WETH', Decimal('2'), 'BAL', Decimal('0'), Decimal('Infinity'))
+        self.assertLess(registry.route('DAI', 'BAL', Decimal('100')).amount_out, first.amount_out)
+        self.assertIs(registry._candidate_paths('DAI', 'BAL', 3), paths)
+
+        registry.add('dai-bal', make_pool({'DAI': ('20000', '10'), 'BAL': ('2000', '10')}))
+        self.assertEqual(registry.candidate_paths('DAI', 'BAL'), [[('dai-bal', 'DAI', 'BAL')],
+                                                                  [('dai-weth', 'DAI', 'WETH'), ('weth-bal', 'WETH', 'BAL')]])
+        registry.remove('dai-weth')
+        self.assertEqual(registry.candidate_paths('DAI', 'BAL'), [[('dai-bal', 'DAI', 'BAL')]])
+        registry.pools['weth-bal'].bind('DAI', Decimal('20000'), Decimal('10'))
+        registry.reindex('weth-bal')
+        self.assertEqual(registry.candidate_paths('DAI', 'BAL'), [[('dai-bal', 'DAI', 'BAL')], [('weth-bal', 'DAI', 'BAL')],
+                                                                  [('weth-bal', 'DAI', 'WETH'), ('weth-bal', 'WETH', 'BAL')]])
+
+
+if __name__ == '__main__':
+    unittest.main()
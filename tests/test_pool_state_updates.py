@@ -2,12 +2,13 @@ import unittest
 from decimal import Decimal
 
 from model.models import Token
+from model.parts.balancer_math import BalancerMath
 from model.parts.pool_method_entities import SwapExactAmountInInput, TokenAmount, SwapExactAmountInOutput, JoinParamsInput, JoinParamsOutput, \
     JoinSwapExternAmountInInput, JoinSwapExternAmountInOutput, ExitSwapPoolAmountInInput, ExitSwapPoolAmountInOutput, ExitPoolInput, ExitPoolOutput, \
     PoolMethodParamsDecoder
 from model.parts.pool_state_updates import s_swap_plot_output, s_join_pool_plot_output, s_join_swap_plot_output, s_exit_swap_plot_output, \
     s_exit_pool_plot_output, s_swap_exact_amount_in, s_join_pool, s_join_swap_extern_amount_in, s_swap_exact_amount_out, s_exit_swap_pool_amount_in, \
-    s_exit_pool
+    s_exit_pool, s_update_pool, s_update_spot_prices, calculate_spot_prices, calculate_spot_price_matrix, set_token_balance, copy_pool
 
 
 class TestPlotOutputSystemPolicies(unittest.TestCase):
@@ -440,5 +441,97 @@ class TestSystemPolicies(unittest.TestCase):
         self.assertAlmostEqual(answer['tokens']['DAI'].balance, initial_dai_balance - Decimal('124.378005824396584765'), 2)
         self.assertAlmostEqual(answer['pool_shares'], initial_pool_shares - Decimal('0.001191587214967108'))
 
+    def test_pool_updates_share_untouched_tokens(self):
+        pool = {
+            'tokens': {
+                'WETH': Token(bound=True, weight=Decimal('0.4'), denorm_weight=Decimal('20'), balance=Decimal('67738.636173102396002749')),
+                'DAI': Token(bound=True, weight=Decimal('0.2'), denorm_weight=Decimal('10'), balance=Decimal('10000000')),
+                'BAL': Token(bound=True, weight=Decimal('0.4'), denorm_weight=Decimal('20'), balance=Decimal('500000')),
+            },
+            'generated_fees': {'WETH': Decimal('0'), 'DAI': Decimal('0'), 'BAL': Decimal('0')},
+            'pool_shares': Decimal('100'),
+            'swap_fee': Decimal('0.0025')
+        }
+        previous_state = {'pool': pool}
+        action = {'type': 'swap',
+                  'token_in': {'amount': '11861.328308360999600128', 'symbol': 'DAI'},
+                  'token_out': {'amount': '40.043469399786911688', 'symbol': 'WETH'}}
+        policy_input = {'pool_update': PoolMethodParamsDecoder.swap_exact_amount_in_simplified(action)}
+        params = {'decoding_type': 'SIMPLIFIED', 'spot_price_reference': 'DAI'}
+
+        _, answer = s_update_pool(params, 1, [], previous_state, policy_input)
+        # The previous state is left as is, only the swapped tokens are new objects
+        self.assertEqual(pool['tokens']['DAI'].balance, Decimal('10000000'))
+        self.assertEqual(pool['generated_fees']['DAI'], Decimal('0'))
+        self.assertIsNot(answer['tokens']['DAI'], pool['tokens']['DAI'])
+        self.assertIsNot(answer['tokens']['WETH'], pool['tokens']['WETH'])
+        self.assertIs(answer['tokens']['BAL'], pool['tokens']['BAL'])
+        self.assertGreater(answer['generated_fees']['DAI'], 0)
+
+        # Spot prices are those of the pool after the update of the same substep
+        _, spot_prices = s_update_spot_prices(params, 1, [], previous_state, policy_input)
+        self.assertEqual(spot_prices, calculate_spot_prices(answer, 'DAI'))
+        self.assertNotEqual(spot_prices, calculate_spot_prices(pool, 'DAI'))
+
+        with self.assertRaises(AttributeError):
+            answer['tokens']['DAI'].balance = Decimal('0')
+
+
+class TestSpotPrices(unittest.TestCase):
+    pool = {
+        'tokens': {
+            'WETH': Token(bound=True, weight=Decimal('0.4'), denorm_weight=Decimal('20'), balance=Decimal('67738.636173102396002749')),
+            'DAI': Token(bound=True, weight=Decimal('0.2'), denorm_weight=Decimal('10'), balance=Decimal('10000000')),
+            'BAL': Token(bound=True, weight=Decimal('0.3'), denorm_weight=Decimal('15'), balance=Decimal('500000')),
+            'UNI': Token(bound=True, weight=Decimal('0.1'), denorm_weight=Decimal('5'), balance=Decimal('250000')),
+        },
+        'swap_fee': Decimal('0.0025')
+    }
+
+    @staticmethod
+    def spot_price(pool, token_in, token_out):
+        tokens = pool['tokens']
+        return BalancerMath.calc_spot_price(tokens[token_in].balance, tokens[token_in].weight, tokens[token_out].balance,
+                                            tokens[token_out].weight, pool['swap_fee'])
+
+    def updated(self, **balances):
+        pool = copy_pool(self.pool)
+        for symbol, balance in balances.items():
+            set_token_balance(pool, symbol, Decimal(balance))
+        return pool
+
+    def test_spot_prices_only_recomputed_for_changed_tokens(self):
+        before = calculate_spot_prices(self.pool, 'DAI')
+        pool = self.updated(WETH='67000')
+        after = calculate_spot_prices(pool, 'DAI')
+        self.assertIs(after['BAL'], before['BAL'])
+        self.assertIs(after['UNI'], before['UNI'])
+        self.assertEqual(after['WETH'], self.spot_price(pool, 'DAI', 'WETH'))
+        self.assertNotEqual(after['WETH'], before['WETH'])
+
+        # A changed reference token changes every price
+        pool = self.updated(DAI='10010000')
+        after = calculate_spot_prices(pool, 'DAI')
+        self.assertEqual(after, {token: self.spot_price(pool, 'DAI', token) for token in ['WETH', 'BAL', 'UNI']})
+
+    def test_spot_price_matrix(self):
+        matrix = calculate_spot_price_matrix(self.pool)
+        for token_in in self.pool['tokens']:
+            self.assertEqual(matrix[token_in], calculate_spot_prices(self.pool, token_in))
+
+        pool = self.updated(WETH='67000', BAL='510000')
+        updated_matrix = calculate_spot_price_matrix(pool)
+        self.assertIs(updated_matrix['DAI']['UNI'], matrix['DAI']['UNI'])
+        for token_in in pool['tokens']:
+            for token_out in pool['tokens']:
+                if token_in != token_out:
+                    self.assertEqual(updated_matrix[token_in][token_out], self.spot_price(pool, token_in, token_out))
+
+    def test_spot_price_matrix_token_limit(self):
+        pool = {'tokens': {f'T{i}': self.pool['tokens']['DAI'] for i in range(9)}, 'swap_fee': Decimal('0.0025')}
+        with self.assertRaisesRegex(Exception, 'ERR_MAX_TOKENS'):
+            calculate_spot_price_matrix(pool)
+
+
 if __name__ == '__main__':
     unittest.main()
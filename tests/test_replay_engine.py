@@ -0,0 +1,110 @@
+import os
+import unittest
+
+import pandas as pd
+from cadCAD import configs
+from cadCAD.configuration.utils import config_sim
+
+from model.genesis_states import generate_initial_state
+from model.partial_state_update_block import generate_partial_state_update_blocks
+from model.parts.utils import post_processing
+from model.sim_runner import run, SimulationEngine
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+INITIAL_STATE_JSON = os.path.join(os.path.dirname(__file__), '..', 'data',
+                                  '0x8b6e6e7b5b3801fed2cafd4b22b8a16c2f2db21a-initial_pool_states-prices.json')
+# Short synthetic tape with every action type, see tests/data
+ACTIONS_JSON = os.path.join(DATA_DIR, '0x8b6e6e7b5b3801fed2cafd4b22b8a16c2f2db21a-actions-sample.json')
+
+
+def simulate(decoding_type: str, engine: str, columnar: bool = False, compaction: int = None) -> pd.DataFrame:
+    parameters = {
+        'spot_price_reference': ['DAI'],
+        'decoding_type': [decoding_type]
+    }
+    initial_values = generate_initial_state(initial_values_json=INITIAL_STATE_JSON, spot_price_base_currency='DAI')
+    result = generate_partial_state_update_blocks(ACTIONS_JSON)
+    sim_configs = config_sim({
+        'N': 1,
+        'T': range(result['steps_number'] - 1),
+        'M': parameters
+    })
+    return run(initial_values, result['partial_state_update_blocks'], sim_configs, engine=engine, columnar=columnar,
+               compaction=compaction)
+
+
+class TestReplayEngine(unittest.TestCase):
+    def setUp(self):
+        # Experiment.append_configs adds to cadCAD's global config list
+        configs.clear()
+
+    def assert_same_as_cadcad(self, decoding_type: str):
+        expected = simulate(decoding_type, SimulationEngine.cadcad.value)
+        actual = simulate(decoding_type, SimulationEngine.replay.value)
+        self.assertEqual(list(expected.columns), list(actual.columns))
+        self.assertEqual(len(expected), len(actual))
+
+        expected, actual = post_processing(expected), post_processing(actual)
+        object_columns = ['pool', 'token_prices', 'spot_prices', 'generated_fees']
+        pd.testing.assert_frame_equal(expected.drop(columns=object_columns), actual.drop(columns=object_columns))
+
+    def test_simplified(self):
+        self.assert_same_as_cadcad('SIMPLIFIED')
+
+    def test_contract_call(self):
+        self.assert_same_as_cadcad('CONTRACT_CALL')
+
+    def test_replay_output(self):
+        self.assert_same_as_cadcad('REPLAY_OUTPUT')
+
+    def test_columnar_recorder_matches_post_processing(self):
+        for decoding_type in ['SIMPLIFIED', 'CONTRACT_CALL', 'REPLAY_OUTPUT']:
+            expected = post_processing(simulate(decoding_type, SimulationEngine.replay.value), include_spot_prices=True)
+            actual = simulate(decoding_type, SimulationEngine.replay.value, columnar=True)
+            pd.testing.assert_frame_equal(expected.drop(columns=['pool', 'token_prices', 'spot_prices', 'generated_fees']), actual)
+
+    def test_columnar_requires_replay_engine(self):
+        with self.assertRaises(Exception):
+            simulate('SIMPLIFIED', SimulationEngine.cadcad.value, columnar=True)
+
+    def test_compaction_keeps_pool_changing_and_sampled_rows(self):
+        for decoding_type in ['SIMPLIFIED', 'CONTRACT_CALL', 'REPLAY_OUTPUT']:
+            full = simulate(decoding_type, SimulationEngine.replay.value, columnar=True)
+            for compaction in [1, 3, 1000]:
+                compacted = simulate(decoding_type, SimulationEngine.replay.value, columnar=True, compaction=compaction)
+                # Every row is the row of the same timestep without compaction
+                expected = full.set_index('timestep', drop=False).loc[compacted['timestep']].reset_index(drop=True)
+                pd.testing.assert_frame_equal(expected, compacted)
+
+                price_updates = full[full['action_type'] == 'external_price_update']['timestep']
+                kept = set(price_updates[(price_updates % compaction == 0) | (price_updates == full['timestep'].max())])
+                self.assertEqual(set(compacted[compacted['action_type'] == 'external_price_update']['timestep']), kept)
+                self.assertEqual(len(compacted[compacted['action_type'] != 'external_price_update']),
+                                 len(full[full['action_type'] != 'external_price_update']))
+
+    def test_spot_price_matrix(self):
+        initial_values = generate_initial_state(initial_values_json=INITIAL_STATE_JSON, spot_price_base_currency='DAI',
+                                                spot_price_matrix=True)
+        result = generate_partial_state_update_blocks(ACTIONS_JSON, spot_price_matrix=True)
+        sim_configs = config_sim({'N': 1, 'T': range(result['steps_number'] - 1),
+                                  'M': {'spot_price_reference': ['DAI'], 'decoding_type': ['SIMPLIFIED']}})
+        df = run(initial_values, result['partial_state_update_blocks'], sim_configs, engine=SimulationEngine.replay.value)
+        for spot_prices, matrix in zip(df['spot_prices'][1:], df['spot_price_matrix'][1:]):
+            self.assertEqual(matrix['DAI'], spot_prices)
+
+        df = post_processing(df, include_spot_prices=True, include_spot_price_matrix=True)
+        pd.testing.assert_series_equal(df['token_weth_spot_price_in_dai'], df['token_weth_spot_price'], check_names=False)
+
+    def test_initial_state_is_not_mutated(self):
+        initial_values = generate_initial_state(initial_values_json=INITIAL_STATE_JSON, spot_price_base_currency='DAI')
+        balances = {symbol: token.balance for symbol, token in initial_values['pool']['tokens'].items()}
+        result = generate_partial_state_update_blocks(ACTIONS_JSON)
+        sim_configs = config_sim({'N': 2, 'T': range(result['steps_number'] - 1), 'M': {'spot_price_reference': ['DAI'], 'decoding_type': ['SIMPLIFIED']}})
+        df = run(initial_values, result['partial_state_update_blocks'], sim_configs, engine=SimulationEngine.replay.value)
+
+        self.assertEqual(balances, {symbol: token.balance for symbol, token in initial_values['pool']['tokens'].items()})
+        self.assertEqual(sorted(df['run'].unique()), [1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
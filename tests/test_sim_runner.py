@@ -0,0 +1,209 @@
+import json
+import os
+import tempfile
+import unittest
+from decimal import Decimal
+
+import pandas as pd
+from cadCAD import configs
+from cadCAD.configuration.utils import config_sim
+
+from model.genesis_states import apply_pool_params, generate_initial_state
+from model.partial_state_update_block import generate_partial_state_update_blocks
+from model.parts.utils import post_processing
+from model.replay_engine import simulate
+from model.sim_runner import (run, run_concurrently, run_forked_sweep, run_segmented, run_sweep, SimulationEngine,
+                              SimulationRunner)
+
+INITIAL_STATE_JSON = os.path.join(os.path.dirname(__file__), '..', 'data',
+                                  '0x8b6e6e7b5b3801fed2cafd4b22b8a16c2f2db21a-initial_pool_states-prices.json')
+ACTIONS_JSON = os.path.join(os.path.dirname(__file__), 'data', '0x8b6e6e7b5b3801fed2cafd4b22b8a16c2f2db21a-actions-sample.json')
+
+
+class TestSimulationRunner(unittest.TestCase):
+    def setUp(self):
+        configs.clear()
+
+    def test_runs_only_its_own_configs(self):
+        initial_values = generate_initial_state(initial_values_json=INITIAL_STATE_JSON, spot_price_base_currency='DAI')
+        result = generate_partial_state_update_blocks(ACTIONS_JSON)
+        sim_configs = config_sim({
+            'N': 2,
+            'T': range(result['steps_number'] - 1),
+            'M': {'spot_price_reference': ['DAI'], 'decoding_type': ['SIMPLIFIED']}
+        })
+        runner = SimulationRunner()
+        first = runner.run(initial_values, result['partial_state_update_blocks'], sim_configs)
+        second = runner.run(initial_values, result['partial_state_update_blocks'], sim_configs)
+        self.assertEqual(len(first), 2 * result['steps_number'])
+        self.assertEqual(sorted(set(zip(second['subset'], second['run']))), [(0, 1), (0, 2)])
+        object_columns = ['pool', 'token_prices', 'spot_prices', 'generated_fees']
+        pd.testing.assert_frame_equal(post_processing(first).drop(columns=object_columns),
+                                      post_processing(second).drop(columns=object_columns))
+        self.assertEqual(sim_configs[0]['N'], 2)
+        self.assertEqual(configs, [])
+        self.assertEqual(runner.configs, [])
+
+
+class TestRunConcurrently(unittest.TestCase):
+    def test_tapes_side_by_side(self):
+        initial_values = generate_initial_state(initial_values_json=INITIAL_STATE_JSON, spot_price_base_currency='DAI')
+        with tempfile.TemporaryDirectory() as directory:
+            with open(ACTIONS_JSON) as f:
+                actions = json.load(f)
+            # Another pool history: the same tape without its last swaps
+            other_tape = os.path.join(directory, 'actions.json')
+            with open(other_tape, 'w') as f:
+                json.dump(actions[:10], f)
+            simulations = []
+            for path in [ACTIONS_JSON, other_tape, ACTIONS_JSON]:
+                result = generate_partial_state_update_blocks(path)
+                sim_configs = config_sim({'N': 1, 'T': range(result['steps_number'] - 1),
+                                          'M': {'spot_price_reference': ['DAI'], 'decoding_type': ['SIMPLIFIED']}})
+                simulations.append((initial_values, result['partial_state_update_blocks'], sim_configs))
+
+            results = run_concurrently(simulations, max_workers=3)
+        self.assertEqual([len(df) for df in results], [14, 9, 14])
+        object_columns = ['pool', 'token_prices', 'spot_prices', 'generated_fees']
+        for (initial_state, partial_state_update_blocks, sim_configs), df in zip(simulations, results):
+            expected = run(initial_state, partial_state_update_blocks, sim_configs, engine=SimulationEngine.replay.value)
+            pd.testing.assert_frame_equal(post_processing(expected).drop(columns=object_columns),
+                                          post_processing(df).drop(columns=object_columns))
+
+
+class TestRunSweep(unittest.TestCase):
+    def setUp(self):
+        configs.clear()
+        self.initial_values = generate_initial_state(initial_values_json=INITIAL_STATE_JSON, spot_price_base_currency='DAI')
+        self.steps_number = generate_partial_state_update_blocks(ACTIONS_JSON)['steps_number']
+
+    def test_fee_sweep_matches_serial_runs(self):
+        sim_configs = config_sim({
+            'N': 2,
+            'T': range(self.steps_number - 1),
+            'M': {'spot_price_reference': ['DAI', 'DAI'], 'decoding_type': ['SIMPLIFIED', 'SIMPLIFIED'], 'swap_fee': ['0.0025', '0.01']}
+        })
+        df = run_sweep(self.initial_values, ACTIONS_JSON, sim_configs, processes=2)
+        self.assertEqual(len(df), 4 * self.steps_number)
+        self.assertEqual(sorted(df.groupby(['subset', 'run']).groups.keys()), [(0, 1), (0, 2), (1, 1), (1, 2)])
+
+        for subset, sim_config in enumerate(sim_configs):
+            initial_values = apply_pool_params(self.initial_values, sim_config['M'], 'DAI')
+            result = generate_partial_state_update_blocks(ACTIONS_JSON)
+            expected = run(initial_values, result['partial_state_update_blocks'], dict(sim_config, N=1), engine=SimulationEngine.replay.value)
+            actual = df[(df['subset'] == subset) & (df['run'] == 2)].reset_index(drop=True)
+            object_columns = ['pool', 'token_prices', 'spot_prices', 'generated_fees']
+            pd.testing.assert_frame_equal(post_processing(expected).drop(columns=object_columns + ['subset', 'run']),
+                                          post_processing(actual).drop(columns=object_columns + ['subset', 'run']))
+
+        fees = post_processing(df).groupby('subset')['generated_fees_dai'].sum()
+        self.assertGreater(fees[1], fees[0])
+
+    def test_apply_pool_params(self):
+        initial_values = apply_pool_params(self.initial_values, {'denorm_weights': {'DAI': '25', 'WETH': '25'}, 'swap_fee': '0.01'}, 'DAI')
+        tokens = initial_values['pool']['tokens']
+        self.assertEqual(tokens['DAI'].weight, Decimal('0.5'))
+        self.assertEqual(tokens['WETH'].weight, Decimal('0.5'))
+        self.assertEqual(initial_values['pool']['swap_fee'], Decimal('0.01'))
+        # The original initial state is left as is
+        self.assertEqual(self.initial_values['pool']['tokens']['DAI'].denorm_weight, Decimal('10'))
+        self.assertEqual(self.initial_values['pool']['swap_fee'], Decimal('0.0025'))
+        self.assertEqual(self.initial_values['pool']['total_denorm_weight'], Decimal('50'))
+
+        # Changing one denorm weight updates the total and every normalized weight
+        pool = apply_pool_params(self.initial_values, {'denorm_weights': {'DAI': '20'}}, 'DAI')['pool']
+        self.assertEqual(pool['total_denorm_weight'], Decimal('60'))
+        self.assertEqual(pool['tokens']['DAI'].weight, Decimal('20') / Decimal('60'))
+        self.assertEqual(pool['tokens']['WETH'].weight, Decimal('40') / Decimal('60'))
+
+
+class TestRunSegmented(unittest.TestCase):
+    def setUp(self):
+        self.initial_values = generate_initial_state(initial_values_json=INITIAL_STATE_JSON, spot_price_base_currency='DAI')
+        result = generate_partial_state_update_blocks(ACTIONS_JSON)
+        self.partial_state_update_blocks = result['partial_state_update_blocks']
+        self.time_seq = range(result['steps_number'] - 1)
+
+    def assert_same_rows(self, expected: pd.DataFrame, actual: pd.DataFrame):
+        object_columns = ['pool', 'token_prices', 'spot_prices', 'generated_fees']
+        pd.testing.assert_frame_equal(post_processing(expected).drop(columns=object_columns),
+                                      post_processing(actual).drop(columns=object_columns))
+
+    def test_replay_output_segments_have_no_drift(self):
+        params = {'spot_price_reference': 'DAI', 'decoding_type': 'REPLAY_OUTPUT'}
+        df, seams = run_segmented(self.initial_values, ACTIONS_JSON, params, segment_length=4, processes=2)
+        self.assertEqual(seams['timestep'].tolist(), [4, 8, 12])
+        self.assertTrue((seams.drop(columns=['timestep']) == 0).all().all())
+        self.assert_same_rows(pd.DataFrame(simulate(self.initial_values, self.partial_state_update_blocks, params, self.time_seq)), df)
+
+    def test_seam_report(self):
+        params = {'spot_price_reference': 'DAI', 'decoding_type': 'SIMPLIFIED'}
+        df, seams = run_segmented(self.initial_values, ACTIONS_JSON, params, segment_length=8, processes=2)
+        self.assertEqual(df['timestep'].tolist(), list(range(14)))
+        # The first segment starts from the initial state, so it matches a serial run up to the seam
+        serial = pd.DataFrame(simulate(self.initial_values, self.partial_state_update_blocks, params, self.time_seq))
+        self.assert_same_rows(serial.iloc[:9], df.iloc[:9])
+
+        chain = pd.DataFrame(simulate(self.initial_values, self.partial_state_update_blocks,
+                                      {**params, 'decoding_type': 'REPLAY_OUTPUT'}, self.time_seq))
+        self.assertEqual(seams['timestep'].tolist(), [8])
+        expected = serial['pool'][8]['tokens']['WETH'].balance - chain['pool'][8]['tokens']['WETH'].balance
+        self.assertEqual(seams['token_weth_balance_drift'][0], float(expected))
+        self.assertNotEqual(expected, 0)
+
+    def test_contract_call_drifts_from_recorded_output(self):
+        params = {'spot_price_reference': 'DAI', 'decoding_type': 'CONTRACT_CALL'}
+        _, seams = run_segmented(self.initial_values, ACTIONS_JSON, params, segment_length=4, processes=2)
+        # Recomputing the amounts of the contract calls doesn't give exactly the amounts recorded on chain
+        self.assertTrue((seams.drop(columns=['timestep']) != 0).any().any())
+        # The first segment starts from the initial state like a serial run, the later ones from the chain state at their start
+        serial = simulate(self.initial_values, self.partial_state_update_blocks, params, range(4))
+        chain = simulate(self.initial_values, self.partial_state_update_blocks, {**params, 'decoding_type': 'REPLAY_OUTPUT'}, range(4))
+        expected = serial[4]['pool']['tokens']['WETH'].balance - chain[4]['pool']['tokens']['WETH'].balance
+        self.assertEqual(seams['token_weth_balance_drift'][0], float(expected))
+        self.assertNotEqual(expected, 0)
+
+
+class TestRunForkedSweep(unittest.TestCase):
+    def setUp(self):
+        self.initial_values = generate_initial_state(initial_values_json=INITIAL_STATE_JSON, spot_price_base_currency='DAI')
+        result = generate_partial_state_update_blocks(ACTIONS_JSON)
+        self.partial_state_update_blocks = result['partial_state_update_blocks']
+        self.time_seq = range(result['steps_number'] - 1)
+        self.params = {'spot_price_reference': 'DAI', 'decoding_type': 'SIMPLIFIED'}
+
+    def serial(self, initial_state, params, time_seq) -> pd.DataFrame:
+        return pd.DataFrame(simulate(initial_state, self.partial_state_update_blocks, params, time_seq))
+
+    def assert_same_rows(self, expected: pd.DataFrame, actual: pd.DataFrame):
+        object_columns = ['pool', 'token_prices', 'spot_prices', 'generated_fees']
+        pd.testing.assert_frame_equal(post_processing(expected).drop(columns=object_columns + ['subset']).reset_index(drop=True),
+                                      post_processing(actual).drop(columns=object_columns + ['subset']).reset_index(drop=True))
+
+    def test_forks_match_serial_runs(self):
+        scenarios = [
+            {'at': 0, 'params': {'decoding_type': 'CONTRACT_CALL'}},
+            {'at': 5},
+            {'at': 9, 'pool': {'swap_fee': '0.01'}},
+        ]
+        df = run_forked_sweep(self.initial_values, ACTIONS_JSON, self.params, scenarios, processes=2)
+        self.assertEqual(df.groupby('subset').size().tolist(), [14, 14, 14])
+        base = self.serial(self.initial_values, self.params, self.time_seq)
+
+        self.assert_same_rows(self.serial(self.initial_values, {**self.params, 'decoding_type': 'CONTRACT_CALL'}, self.time_seq),
+                              df[df['subset'] == 0])
+        self.assert_same_rows(base, df[df['subset'] == 1])
+
+        forked = df[df['subset'] == 2].reset_index(drop=True)
+        self.assert_same_rows(base.iloc[:10], forked.iloc[:10])
+        fork_state = apply_pool_params(base.iloc[9].to_dict(), {'swap_fee': '0.01'}, 'DAI')
+        self.assert_same_rows(self.serial(fork_state, self.params, range(9, 13)).iloc[1:], forked.iloc[10:])
+        self.assertEqual(forked['pool'].iloc[-1]['swap_fee'], Decimal('0.01'))
+
+    def test_no_scenarios(self):
+        with self.assertRaisesRegex(Exception, 'at least one scenario'):
+            run_forked_sweep(self.initial_values, ACTIONS_JSON, self.params, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import os
+import unittest
+
+from model.partial_state_update_block import generate_partial_state_update_blocks
+from model.parts.pool_method_entities import SwapExactAmountInInput
+from model.parts.system_policies import ActionDecoder, ActionDecodingType, find_action_decoder
+
+ACTIONS_JSON = os.path.join(os.path.dirname(__file__), 'data', '0x8b6e6e7b5b3801fed2cafd4b22b8a16c2f2db21a-actions-sample.json')
+
+
+class TestActionDecoder(unittest.TestCase):
+    def setUp(self):
+        self.action_decoder = ActionDecoder(ACTIONS_JSON)
+
+    def test_tape_is_compiled_once_per_decoding_type(self):
+        params = {'decoding_type': 'SIMPLIFIED'}
+        self.action_decoder.p_action_decoder(params, 1, [], {'timestep': 0})
+        tape = self.action_decoder.tapes[ActionDecodingType.simplified]
+        self.assertEqual(len(tape), len(self.action_decoder))
+
+        self.action_decoder.p_action_decoder(params, 1, [], {'timestep': 1})
+        self.assertIs(self.action_decoder.tapes[ActionDecodingType.simplified], tape)
+        self.assertNotIn(ActionDecodingType.contract_call, self.action_decoder.tapes)
+
+    def test_timestep_plays_next_action(self):
+        for decoding_type in ['SIMPLIFIED', 'CONTRACT_CALL', 'REPLAY_OUTPUT']:
+            # Sample tape: pool_creation, external_price_update, swap, ...
+            policy_input = self.action_decoder.p_action_decoder({'decoding_type': decoding_type}, 1, [], {'timestep': 1})
+            self.assertEqual(policy_input['action_type'], 'swap')
+            self.assertEqual(policy_input['change_datetime_update'], self.action_decoder.action_df['timestamp'][2])
+            swap_input, swap_output = policy_input['pool_update']
+            self.assertIsInstance(swap_input, SwapExactAmountInInput)
+            self.assertEqual(swap_input.token_in.symbol, 'DAI')
+
+    def test_blocks_have_their_own_decoder(self):
+        first = generate_partial_state_update_blocks(ACTIONS_JSON)['partial_state_update_blocks']
+        first_decoder = find_action_decoder(first)
+        first_decoder.p_action_decoder({'decoding_type': 'SIMPLIFIED'}, 1, [], {'timestep': 0})
+        second_decoder = find_action_decoder(generate_partial_state_update_blocks(ACTIONS_JSON)['partial_state_update_blocks'])
+        self.assertIsNot(first_decoder, second_decoder)
+        self.assertEqual(second_decoder.tapes, {})
+        self.assertIn(ActionDecodingType.simplified, first_decoder.tapes)
+        with self.assertRaises(Exception):
+            find_action_decoder([{'policies': {}, 'variables': {}}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,11 @@
 import pprint
 import unittest
+from decimal import Decimal
+
 import pandas as pd
 from pandas._testing import assert_frame_equal
 
+from model.models import Token
 from model.parts.utils import *
 
 
@@ -44,6 +47,32 @@ class TestUtils(unittest.TestCase):
 
         assert_frame_equal(result, expected_df)
 
+    def test_post_processing_unpacks_tokens_prices_and_fees(self):
+        def state(dai_balance, weth_balance, dai_fee):
+            return {
+                'pool': {'tokens': {'DAI': Token(weight='0.2', denorm_weight='10', balance=Decimal(dai_balance), bound=True),
+                                    'WETH': Token(weight='0.8', denorm_weight='40', balance=Decimal(weth_balance), bound=True)},
+                         'generated_fees': {'DAI': dai_fee, 'WETH': '0.0'}, 'pool_shares': Decimal('100'), 'swap_fee': '0.0025'},
+                'change_datetime': '2020-12-07T13:34:14+00:00',
+                'token_prices': {'DAI': 1.0, 'WETH': 600.0},
+                'spot_prices': {'WETH': Decimal('600.5')},
+            }
+        # Rows selected out of a bigger frame keep their index labels
+        df = pd.DataFrame([state('10000000', '67738.5', '0.0'), state('10010000', '67700', Decimal('25'))], index=[3, 7])
+        result = post_processing(df, include_spot_prices=True)
+
+        self.assertEqual(list(result.index), [3, 7])
+        self.assertEqual(result.loc[7, 'token_dai_balance'], 10010000.0)
+        self.assertEqual(result.loc[7, 'token_weth_weight'], 0.8)
+        self.assertEqual(result.loc[7, 'generated_fees_dai'], 25.0)
+        self.assertEqual(result.loc[7, 'token_weth_value'], 67700 * 600.0)
+        self.assertEqual(result.loc[7, 'tvl'], 10010000.0 + 67700 * 600.0)
+        self.assertEqual(result.loc[7, 'total_token_balances'], 10010000.0 + 67700)
+        self.assertAlmostEqual(result.loc[3, 'invariant'], 10000000 ** 0.2 * 67738.5 ** 0.8)
+        self.assertEqual(result.loc[3, 'token_weth_spot_price'], 600.5)
+        self.assertEqual(result['swap_fee'].dtype, 'float64')
+        self.assertEqual(str(result['change_datetime'].dt.tz), 'UTC')
+
 
 if __name__ == '__main__':
     unittest.main()